@@ -1,3 +1,9 @@
+-- Baseline schema: migration version 1 (see migrate.py). Running this file
+-- directly drops and recreates every table; on an existing database apply
+-- the files in migrations/ with `flask --app main migrate` instead, and put
+-- new schema changes there rather than here.
+DROP VIEW IF EXISTS CarSalesSummaryLive;
+DROP TABLE IF EXISTS CarSalesSummary;
 DROP TABLE IF EXISTS Make;
 DROP TABLE IF EXISTS Model;
 DROP TABLE IF EXISTS Salesperson;
@@ -6,12 +12,19 @@ DROP TABLE IF EXISTS CarSales;
 
 CREATE TABLE Salesperson (
     UserName VARCHAR(10) PRIMARY KEY,
-    Password VARCHAR(20) NOT NULL,
+    Password VARCHAR(20),
     FirstName VARCHAR(50) NOT NULL,
     LastName VARCHAR(50) NOT NULL,
-	UNIQUE(FirstName, LastName)
+    -- Salted hash (werkzeug "method$salt$hash"); replaces Password, which is
+    -- only kept for rows not yet migrated (flask --app main hash-passwords)
+    PasswordHash VARCHAR(255),
+	UNIQUE(FirstName, LastName),
+    CHECK (Password IS NOT NULL OR PasswordHash IS NOT NULL)
 );
 
+-- checkLogin looks salespeople up case-insensitively
+CREATE UNIQUE INDEX Salesperson_UserNameLower_idx ON Salesperson (LOWER(UserName));
+
 INSERT INTO Salesperson VALUES 
 ('jdoe', 'Pass1234', 'John', 'Doe'),
 ('brown', 'Passwxyz', 'Bob', 'Brown'),
@@ -136,4 +149,185 @@ BEGIN
     WHERE cs.IsSold = TRUE
     GROUP BY cs.MakeCode;
 END;
-$$ LANGUAGE plpgsql;
\ No newline at end of file
+$$ LANGUAGE plpgsql;
+
+-- Summary table backing the /summary page, one row per make/model.
+-- Kept current by the carsales_summary_maintain trigger below.
+CREATE TABLE CarSalesSummary (
+    MakeCode VARCHAR(10) NOT NULL,
+    ModelCode VARCHAR(10) NOT NULL,
+    AvailableUnits INTEGER NOT NULL DEFAULT 0,
+    SoldUnits INTEGER NOT NULL DEFAULT 0,
+    AllPrices NUMERIC(14,2) NOT NULL DEFAULT 0,
+    SoldPrices NUMERIC(14,2) NOT NULL DEFAULT 0,
+    LastSaleDate DATE,
+    PRIMARY KEY (MakeCode, ModelCode)
+);
+
+-- Used to find the new latest sale date when the current one is removed
+CREATE INDEX CarSales_MakeModelSaleDate_idx ON CarSales (MakeCode, ModelCode, SaleDate);
+
+-- The live aggregate the summary table must always agree with
+CREATE VIEW CarSalesSummaryLive AS
+SELECT
+    cs.MakeCode,
+    cs.ModelCode,
+    (COUNT(*) FILTER (WHERE cs.IsSold = FALSE))::INTEGER AS AvailableUnits,
+    (COUNT(*) FILTER (WHERE cs.IsSold = TRUE))::INTEGER AS SoldUnits,
+    COALESCE(SUM(cs.Price), 0) AS AllPrices,
+    COALESCE(SUM(cs.Price) FILTER (WHERE cs.IsSold = TRUE), 0) AS SoldPrices,
+    MAX(cs.SaleDate) AS LastSaleDate
+FROM CarSales cs
+GROUP BY cs.MakeCode, cs.ModelCode;
+
+-- Add (p_sign = 1) or remove (p_sign = -1) one car's contribution to its summary row
+CREATE OR REPLACE FUNCTION carsales_summary_apply(
+    p_make VARCHAR, p_model VARCHAR, p_sign INTEGER,
+    p_price NUMERIC, p_sold BOOLEAN, p_saledate DATE)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO CarSalesSummary AS s
+        (MakeCode, ModelCode, AvailableUnits, SoldUnits, AllPrices, SoldPrices, LastSaleDate)
+    VALUES (
+        p_make, p_model,
+        CASE WHEN p_sold THEN 0 ELSE p_sign END,
+        CASE WHEN p_sold THEN p_sign ELSE 0 END,
+        p_sign * p_price,
+        CASE WHEN p_sold THEN p_sign * p_price ELSE 0 END,
+        CASE WHEN p_sign > 0 THEN p_saledate END)
+    ON CONFLICT (MakeCode, ModelCode) DO UPDATE SET
+        AvailableUnits = s.AvailableUnits + EXCLUDED.AvailableUnits,
+        SoldUnits = s.SoldUnits + EXCLUDED.SoldUnits,
+        AllPrices = s.AllPrices + EXCLUDED.AllPrices,
+        SoldPrices = s.SoldPrices + EXCLUDED.SoldPrices,
+        LastSaleDate = GREATEST(s.LastSaleDate, EXCLUDED.LastSaleDate);
+
+    -- Removing the latest sale date means looking up the next latest one
+    IF p_sign < 0 AND p_saledate IS NOT NULL THEN
+        UPDATE CarSalesSummary s
+        SET LastSaleDate = (
+            SELECT MAX(cs.SaleDate) FROM CarSales cs
+            WHERE cs.MakeCode = p_make AND cs.ModelCode = p_model)
+        WHERE s.MakeCode = p_make AND s.ModelCode = p_model
+          AND s.LastSaleDate = p_saledate;
+    END IF;
+
+    DELETE FROM CarSalesSummary
+    WHERE MakeCode = p_make AND ModelCode = p_model
+      AND AvailableUnits = 0 AND SoldUnits = 0;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION carsales_summary_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM carsales_summary_apply(OLD.MakeCode, OLD.ModelCode, -1,
+                                       OLD.Price, OLD.IsSold, OLD.SaleDate);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM carsales_summary_apply(NEW.MakeCode, NEW.ModelCode, 1,
+                                       NEW.Price, NEW.IsSold, NEW.SaleDate);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER carsales_summary_maintain
+AFTER INSERT OR UPDATE OR DELETE ON CarSales
+FOR EACH ROW EXECUTE FUNCTION carsales_summary_trigger();
+
+-- Tell the web workers that car sales changed so they drop their cached
+-- summary and search results (see RESULT_CACHE_LISTEN in database.py).
+-- Notifications are delivered on commit, once per transaction.
+CREATE OR REPLACE FUNCTION carsales_notify_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('sag_carsales_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER carsales_notify_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON CarSales
+FOR EACH STATEMENT EXECUTE FUNCTION carsales_notify_changed();
+
+-- Search results also show make, model and people names
+CREATE TRIGGER make_notify_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Make
+FOR EACH STATEMENT EXECUTE FUNCTION carsales_notify_changed();
+
+CREATE TRIGGER model_notify_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Model
+FOR EACH STATEMENT EXECUTE FUNCTION carsales_notify_changed();
+
+CREATE TRIGGER customer_notify_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Customer
+FOR EACH STATEMENT EXECUTE FUNCTION carsales_notify_changed();
+
+CREATE TRIGGER salesperson_notify_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Salesperson
+FOR EACH STATEMENT EXECUTE FUNCTION carsales_notify_changed();
+
+-- Rebuild the summary table from scratch (e.g. after a TRUNCATE or bulk fix-up)
+CREATE OR REPLACE FUNCTION rebuild_carsales_summary()
+RETURNS INTEGER AS $$
+DECLARE
+    n INTEGER;
+BEGIN
+    -- Block writers so no trigger update is lost while rebuilding
+    LOCK TABLE CarSales IN SHARE MODE;
+    DELETE FROM CarSalesSummary;
+    INSERT INTO CarSalesSummary
+        (MakeCode, ModelCode, AvailableUnits, SoldUnits, AllPrices, SoldPrices, LastSaleDate)
+    SELECT MakeCode, ModelCode, AvailableUnits, SoldUnits, AllPrices, SoldPrices, LastSaleDate
+    FROM CarSalesSummaryLive;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- List every make/model where the summary table disagrees with the live aggregate
+CREATE OR REPLACE FUNCTION verify_carsales_summary()
+RETURNS TABLE (MakeCode VARCHAR, ModelCode VARCHAR, Problem TEXT) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        COALESCE(l.MakeCode, s.MakeCode),
+        COALESCE(l.ModelCode, s.ModelCode),
+        CASE
+            WHEN s.MakeCode IS NULL THEN 'missing from summary'
+            WHEN l.MakeCode IS NULL THEN 'no matching car sales'
+            ELSE 'aggregates differ'
+        END
+    FROM CarSalesSummaryLive l
+    FULL OUTER JOIN CarSalesSummary s
+        ON s.MakeCode = l.MakeCode AND s.ModelCode = l.ModelCode
+    WHERE s.MakeCode IS NULL OR l.MakeCode IS NULL
+       OR (s.AvailableUnits, s.SoldUnits, s.AllPrices, s.SoldPrices, s.LastSaleDate)
+          IS DISTINCT FROM
+          (l.AvailableUnits, l.SoldUnits, l.AllPrices, l.SoldPrices, l.LastSaleDate)
+    ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_carsales_summary();
+
+-- Search indexes for findCarSales: trigram indexes serve the '%keyword%'
+-- matches on people names, and the code/foreign-key indexes let matching
+-- makes, models and people be joined back to their car sales.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX Customer_FullName_trgm_idx ON Customer
+    USING GIN (LOWER(FirstName || ' ' || LastName) gin_trgm_ops);
+CREATE INDEX Salesperson_FullName_trgm_idx ON Salesperson
+    USING GIN (LOWER(FirstName || ' ' || LastName) gin_trgm_ops);
+CREATE INDEX CarSales_ModelCode_idx ON CarSales (ModelCode);
+CREATE INDEX CarSales_BuyerID_idx ON CarSales (BuyerID);
+CREATE INDEX CarSales_SalespersonID_idx ON CarSales (SalespersonID);
+
+-- Name resolution for updateCarSale: match the normalised full-name expression
+-- used in its lookups so they are index scans rather than table scans
+CREATE INDEX Customer_FullNameNorm_idx ON Customer
+    (LOWER(TRIM(FirstName || ' ' || LastName)));
+CREATE INDEX Salesperson_FullNameNorm_idx ON Salesperson
+    (LOWER(TRIM(FirstName || ' ' || LastName)));
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+import instrument
+
+#####################################################
+##  Application factory
+#####################################################
+
+'''
+Builds the Flask app ready to serve: routes imported, every template in
+templates/ compiled, and (optionally) the connection pool opened on a
+background thread so the first requests do not pay for it. Each phase is
+timed; the breakdown is printed and exported on /metrics as
+sag_startup_phase_seconds.
+
+Under gunicorn with preload_app (see gunicorn.conf.py) create_app runs once
+in the master, so every forked worker starts with the imports and compiled
+templates already in memory; only the pool is warmed per worker, after the
+fork (post_fork calls warmInBackground).
+'''
+
+# A worker that takes longer than this to become ready is reported
+STARTUP_BUDGET_MS = float(os.environ.get('SAG_STARTUP_BUDGET_MS', '1000'))
+# Open the pool in the background as soon as the app is created
+WARM_POOL = os.environ.get('SAG_WARM_POOL', '1') == '1'
+# Directory for compiled template bytecode shared between processes; unset disables it
+TEMPLATE_CACHE_DIR = os.environ.get('SAG_TEMPLATE_CACHE_DIR', '')
+
+_app = None
+_lock = threading.Lock()
+
+
+class ConfigurationError(Exception):
+    pass
+
+
+@contextmanager
+def _phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        instrument.recordStartup(name, time.perf_counter() - started)
+
+'''
+Compile every template up front so no request pays for it. Returns the number compiled.
+'''
+def precompileTemplates(app):
+    env = app.jinja_env
+    names = app.jinja_loader.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+'''
+Open this process's pool (and change listener) on a daemon thread
+'''
+def warmInBackground():
+    def warm():
+        import database
+        with _phase('pool warm (background)'):
+            database.getPool()
+            if database.RESULT_CACHE_LISTEN and database.RESULT_CACHE_SIZE > 0:
+                database.getListener()
+    threading.Thread(target=warm, name='sag-warm', daemon=True).start()
+
+'''
+Print the startup breakdown, warning when `total` seconds is over budget
+'''
+def reportStartup(total, label='Startup'):
+    phases = ", ".join("{} {:.1f}ms".format(name, seconds * 1000)
+                       for name, seconds in instrument.startupPhases())
+    level = "[WARN]" if total * 1000 > STARTUP_BUDGET_MS else "[INFO]"
+    print("{} {} {:.1f}ms (budget {:.0f}ms): {}".format(level, label, total * 1000,
+                                                         STARTUP_BUDGET_MS, phases))
+
+'''
+Return the application, creating it on the first call.
+
+:param precompile: Compile all templates now rather than on first use.
+:param warm: Open the connection pool in the background; defaults to SAG_WARM_POOL.
+:param randomSecret: Without SAG_SECRET_KEY, sign sessions with a random key for
+    this process (the development server) instead of refusing to start.
+'''
+def create_app(precompile=True, warm=None, randomSecret=False):
+    global _app
+    with _lock:
+        if _app is not None:
+            return _app
+        started = time.perf_counter()
+
+        with _phase('import routes'):
+            import routes
+        app = routes.app
+        if not app.secret_key:
+            if not randomSecret:
+                raise ConfigurationError(
+                    "SAG_SECRET_KEY is not set. It signs the session cookie that holds the "
+                    "login, so every worker must share one secret value.")
+            app.secret_key = secrets.token_hex()
+            print("[WARN] SAG_SECRET_KEY is not set; using a random key for this process. "
+                  "Restarting it logs every user out.")
+
+        if TEMPLATE_CACHE_DIR:
+            from jinja2 import FileSystemBytecodeCache
+            os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+        with _phase('bundle assets'):
+            import assets
+            assets.ensureBuilt()
+
+        if precompile:
+            with _phase('compile templates'):
+                precompileTemplates(app)
+
+        if WARM_POOL if warm is None else warm:
+            warmInBackground()
+
+        _app = app
+        reportStartup(time.perf_counter() - started)
+        return app
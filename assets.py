@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import gzip
+import hashlib
+import json
+import os
+import re
+
+#####################################################
+##  Static asset bundles
+#####################################################
+
+'''
+Minified, bundled, precompressed and content-hashed static assets.
+
+build() concatenates each bundle's sources from static/, minifies them and
+writes static/dist/<name>.<hash>.<ext> with .gz (and, when the optional
+`brotli` module is installed, .br) siblings, plus a manifest.json naming the
+current file of each bundle. The hash is of the bundle's contents, so a
+file name never changes meaning and can be cached forever: routes.py serves
+these with `Cache-Control: immutable` and top.html links them through
+asset_urls(). Files from earlier builds are kept (pages already in a browser
+may still link them) until `build-assets --clean`.
+
+JavaScript is minified with the optional `rjsmin` module; without it the
+sources are only concatenated (jquery.js is already minified).
+'''
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# Bundle name -> sources under static/, in load order
+BUNDLES = {
+    'site.css': ['css/pure.css', 'css/grid.css', 'css/main.css'],
+    'site.js': ['scripts/jquery.js', 'scripts/live.js'],
+}
+
+# Precompressed variants, in order of preference: (encoding, file suffix)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*(?!!).*?\*/)', re.DOTALL)
+
+_BUNDLE_FILE = re.compile(r'^[\w-]+\.[0-9a-f]{12}\.(css|js)$')
+
+_manifest = None
+_version = ''
+
+'''
+Conservative CSS minifier: drops comments (except /*! licences) and
+whitespace around braces, semicolons and commas; strings are left intact.
+'''
+def minifyCss(text):
+    parts = []
+    last = 0
+    for match in _CSS_TOKENS.finditer(text):
+        parts.append(_squeezeCss(text[last:match.start()]))
+        if match.group(1):
+            parts.append(match.group(1))
+        last = match.end()
+    parts.append(_squeezeCss(text[last:]))
+    return ''.join(parts).strip()
+
+def _squeezeCss(text):
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r' ?([{};,]) ?', r'\1', text)
+    text = re.sub(r': ', ':', text)
+    return text.replace(';}', '}')
+
+def minifyJs(text):
+    try:
+        import rjsmin
+    except ImportError:
+        return text
+    return rjsmin.jsmin(text, keep_bang_comments=True)
+
+
+def _compressors():
+    compressors = {'gzip': lambda data: gzip.compress(data, 9, mtime=0)}
+    try:
+        import brotli
+        compressors['br'] = lambda data: brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return compressors
+
+
+def _write(path, data):
+    # Per-process name: workers started without preload_app may build at once
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+'''
+Build every bundle into DIST_DIR and write the manifest. Returns the manifest:
+bundle name -> {'file', 'bytes', 'sourceBytes', <encoding>: compressed bytes}.
+'''
+def build(clean=False):
+    os.makedirs(DIST_DIR, exist_ok=True)
+    compressors = _compressors()
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        texts = []
+        for source in sources:
+            with open(os.path.join(STATIC_DIR, source), encoding='utf-8') as f:
+                texts.append(f.read())
+        if name.endswith('.css'):
+            body = '\n'.join(minifyCss(text) for text in texts)
+        else:
+            # A source without a trailing semicolon must not run into the next one
+            body = ';\n'.join(minifyJs(text).strip() for text in texts)
+        data = body.encode('utf-8')
+
+        stem, ext = os.path.splitext(name)
+        fileName = '%s.%s%s' % (stem, hashlib.sha256(data).hexdigest()[:12], ext)
+        entry = {'file': fileName, 'bytes': len(data),
+                 'sourceBytes': sum(len(text.encode('utf-8')) for text in texts)}
+        _write(os.path.join(DIST_DIR, fileName), data)
+        for encoding, suffix in ENCODINGS:
+            if encoding in compressors:
+                compressed = compressors[encoding](data)
+                _write(os.path.join(DIST_DIR, fileName + suffix), compressed)
+                entry[encoding] = len(compressed)
+        manifest[name] = entry
+
+    # The manifest goes last, so it never names a file that is not written yet
+    _write(MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    if clean:
+        keep = {entry['file'] + suffix for entry in manifest.values()
+                for suffix in [''] + [s for _, s in ENCODINGS]}
+        keep.add(os.path.basename(MANIFEST_PATH))
+        for fileName in os.listdir(DIST_DIR):
+            if fileName not in keep:
+                os.remove(os.path.join(DIST_DIR, fileName))
+    _use(manifest)
+    return manifest
+
+
+def _use(manifest):
+    global _manifest, _version
+    _manifest = manifest
+    _version = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest() \
+        if manifest else ''
+
+# True when the manifest is missing or older than any source
+def _stale():
+    try:
+        built = os.path.getmtime(MANIFEST_PATH)
+    except OSError:
+        return True
+    return any(os.path.getmtime(os.path.join(STATIC_DIR, source)) > built
+               for sources in BUNDLES.values() for source in sources)
+
+'''
+Load the manifest, building the bundles first if they are missing or out of
+date. Without a usable build (e.g. a read-only static/), pages fall back to
+linking the source files.
+'''
+def ensureBuilt():
+    try:
+        if _stale():
+            build()
+            return
+        with open(MANIFEST_PATH, encoding='utf-8') as f:
+            _use(json.load(f))
+    except (OSError, ValueError) as e:
+        print("[WARN] Static assets are not bundled:", e)
+        _use(None)
+
+'''
+File name of a bundle's current build, or None if it is not built
+'''
+def bundleFile(name):
+    entry = (_manifest or {}).get(name)
+    return entry['file'] if entry else None
+
+'''
+True for a hashed bundle file name (from this build or an earlier one);
+nothing else in DIST_DIR is served
+'''
+def isBundleFile(fileName):
+    return bool(_BUNDLE_FILE.match(fileName))
+
+'''
+Changes whenever any bundle does; part of the page ETags, since pages link the hashed names
+'''
+def version():
+    return _version
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import os
+import threading
+import time
+from bisect import bisect_left
+
+import database
+
+#####################################################
+##  Search autocomplete
+#####################################################
+
+'''
+Prefix suggestions for the car sales search box, served from memory.
+
+Makes, models, customers and salespeople are loaded once per worker into a
+PrefixIndex. When one of those tables changes, its notify trigger (see
+SAGschema.sql) marks the index stale and it is rebuilt on a background
+thread while the old one keeps answering. If change notifications are not
+being received the index is rebuilt every REFRESH_SECONDS instead.
+'''
+
+# Rebuild interval when LISTEN is unavailable
+REFRESH_SECONDS = float(os.environ.get('SAG_AUTOCOMPLETE_REFRESH', '300'))
+MAX_SUGGESTIONS = 20
+# Longest wait between attempts to load the index while the database is failing
+RETRY_MAX_SECONDS = 60.0
+
+# Tables whose notifications (payload = table name) make the index stale
+SOURCE_TABLES = ('make', 'model', 'customer', 'salesperson')
+
+'''
+A sorted array of lower-cased keys for bisecting. Every term is indexed under
+its whole label and under each later word, so "smi" finds "Olivia Smith".
+Terms are (value, label, kind): `value` is what goes in the search box.
+'''
+class PrefixIndex:
+    __slots__ = ('_keys', '_terms', '_positions')
+
+    def __init__(self, terms):
+        self._terms = list(terms)
+        pairs = []
+        for position, (value, label, kind) in enumerate(self._terms):
+            words = label.lower().split()
+            for start in range(len(words)):
+                pairs.append((' '.join(words[start:]), position))
+            if value.lower() != label.lower():
+                pairs.append((value.lower(), position))
+        pairs.sort()
+        self._keys = [key for key, _ in pairs]
+        self._positions = [position for _, position in pairs]
+
+    def __len__(self):
+        return len(self._terms)
+
+    def suggest(self, prefix, limit=10):
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix:
+            return []
+        found, seen = [], set()
+        i = bisect_left(self._keys, prefix)
+        keys, positions = self._keys, self._positions
+        while i < len(keys) and len(found) < limit and keys[i].startswith(prefix):
+            position = positions[i]
+            if position not in seen:
+                seen.add(position)
+                value, label, kind = self._terms[position]
+                found.append({'value': value, 'label': label, 'kind': kind})
+            i += 1
+        return found
+
+
+_lock = threading.Lock()
+_index = None
+_indexPid = None
+_subscribedPid = None
+_builtAt = 0.0
+_stale = False
+_rebuilding = False
+# After a failed load no new attempt is made before _retryAt
+_failures = 0
+_retryAt = 0.0
+
+
+def _build():
+    global _index, _indexPid, _builtAt, _stale, _failures, _retryAt
+    # Clear the flag first: a change during the load marks it stale again
+    _stale = False
+    started = time.monotonic()
+    terms = database.getSearchTerms()
+    if terms is None:
+        # Keep answering from the old index, if any, and back off before retrying
+        _stale = True
+        _failures += 1
+        _retryAt = time.monotonic() + min(RETRY_MAX_SECONDS, 2 ** (_failures - 1))
+        return
+    _index = PrefixIndex(terms)
+    _indexPid = os.getpid()
+    _builtAt = started
+    _failures = 0
+    _retryAt = 0.0
+
+
+def _rebuildInBackground():
+    global _rebuilding
+    with _lock:
+        if _rebuilding:
+            return
+        _rebuilding = True
+
+    def run():
+        global _rebuilding
+        try:
+            _build()
+        finally:
+            _rebuilding = False
+    threading.Thread(target=run, name='sag-autocomplete', daemon=True).start()
+
+
+def _onChange(channel, payload):
+    global _stale
+    if payload in SOURCE_TABLES:
+        _stale = True
+        _rebuildInBackground()
+
+# Subscribe _onChange to this process's listener, once per process
+def _subscribe():
+    global _subscribedPid
+    with _lock:
+        if _subscribedPid != os.getpid():
+            database.getListener().subscribe(database.CHANGE_CHANNEL, _onChange)
+            _subscribedPid = os.getpid()
+
+'''
+Suggestions whose label (or any word of it) or value starts with `prefix`,
+as a list of {'value', 'label', 'kind'} dicts. Until this process has loaded
+the index there are no suggestions; a failed load is retried with backoff,
+and only one thread waits for it.
+'''
+def suggest(prefix, limit=10):
+    limit = max(1, min(limit, MAX_SUGGESTIONS))
+    if database.RESULT_CACHE_LISTEN and _subscribedPid != os.getpid():
+        _subscribe()
+    now = time.monotonic()
+    if _indexPid != os.getpid():
+        if now >= _retryAt and not _rebuilding and _lock.acquire(blocking=False):
+            try:
+                if _indexPid != os.getpid() and time.monotonic() >= _retryAt:
+                    _build()
+            finally:
+                _lock.release()
+        if _indexPid != os.getpid():
+            return []
+    elif now >= _retryAt and (_stale or (now - _builtAt > REFRESH_SECONDS and
+                                         not (database.RESULT_CACHE_LISTEN and
+                                              database.getListener().connected))):
+        _rebuildInBackground()
+    return _index.suggest(prefix, limit)
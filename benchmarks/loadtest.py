@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+'''
+Load test the SAG routes and compare against a stored baseline.
+
+Typical run against a synthetic dataset:
+
+    python -m benchmarks.synthetic --cars 2000000
+    python -m benchmarks.loadtest --mode client --duration 30 --save-baseline baseline.json
+    ... change something ...
+    python -m benchmarks.loadtest --mode client --duration 30 --baseline baseline.json
+
+`--mode client` drives the app in-process through the Flask test client.
+`--mode http` drives a running server (see --url) with concurrent workers,
+each holding its own login session. Both report requests/sec and latency
+percentiles per route; with --baseline the run fails (exit 1) when a route
+is slower than the baseline by more than --tolerance.
+
+Redirects are not followed. A request counts as an error when it fails, is
+redirected to /login, or leaves an 'error' flash message (pending in the
+session cookie, or rendered into the page). The run stops if the login fails.
+'''
+import argparse
+import base64
+import http.cookiejar
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from flask.sessions import session_json_serializer
+
+import database
+from benchmarks import synthetic
+
+# Route name -> relative weight in the request mix
+ROUTE_MIX = {
+    'summary': 4,
+    'search': 4,
+    'blank_search': 2,
+    'new_carsale': 1,
+    'update_carsale': 1,
+}
+
+SEARCH_TERMS = ['olivia', 'bench1', 'm01', 'smith', 'x00', 'wilson', 'toy', 'grace']
+
+# How top.html renders a page that shows an 'error' flash message
+ERROR_FLASH_MARKER = b'<ul class="flashes" style="background-color: #B00">'
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class Recorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, route, elapsed, ok):
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, wallSeconds):
+        result = {}
+        for route, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            result[route] = {
+                'requests': len(ordered),
+                'errors': self.errors.get(route, 0),
+                'rps': len(ordered) / wallSeconds if wallSeconds else 0.0,
+                'p50_ms': _percentile(ordered, 0.50) * 1000,
+                'p95_ms': _percentile(ordered, 0.95) * 1000,
+                'p99_ms': _percentile(ordered, 0.99) * 1000,
+            }
+        return result
+
+
+# Contents of a Flask session cookie. The signature is not checked: the load
+# test only reads back the flash messages of its own session.
+def _sessionData(cookie):
+    if not cookie:
+        return {}
+    payload = cookie[1:] if cookie.startswith('.') else cookie
+    payload = payload.split('.')[0]
+    data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+    if cookie.startswith('.'):
+        data = zlib.decompress(data)
+    try:
+        return session_json_serializer.loads(data.decode('utf-8'))
+    except ValueError:
+        return {}
+
+def _errorFlashed(cookie):
+    flashes = _sessionData(cookie).get('_flashes') or []
+    return any(category == 'error' for category, _ in flashes)
+
+'''
+True when a response shows the request worked: not an HTTP error, not sent
+back to /login and no 'error' flash, whether rendered into the body or left
+in the session for the page a redirect leads to. `cookieBefore` is the
+session sent with the request: an error it was already carrying (counted
+against the earlier request) is not counted again when this page shows it.
+'''
+def succeeded(status, location, body, cookie, cookieBefore=None):
+    if status is None or status >= 400:
+        return False
+    if status in (301, 302, 303, 307, 308) and urllib.parse.urlsplit(location or '').path == '/login':
+        return False
+    if ERROR_FLASH_MARKER in (body or b'') and not _errorFlashed(cookieBefore):
+        return False
+    return not _errorFlashed(cookie)
+
+
+def _carSaleIdRange():
+    with database.pooledConnection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT MIN(CarSaleID), MAX(CarSaleID) FROM CarSales")
+        low, high = cursor.fetchone()
+        cursor.execute("""
+            SELECT c.FirstName || ' ' || c.LastName, sp.FirstName || ' ' || sp.LastName
+            FROM Customer c, Salesperson sp LIMIT 1
+        """)
+        customer, salesperson = cursor.fetchone()
+    return (low or 1, high or 1), customer, salesperson
+
+
+def _requestFor(route, rnd, context):
+    # Returns (method, path, form data)
+    if route == 'summary':
+        return 'GET', '/summary', None
+    if route == 'search':
+        return 'POST', '/list_carsales', {'search': rnd.choice(SEARCH_TERMS)}
+    if route == 'blank_search':
+        return 'POST', '/list_carsales', {'search': ''}
+    if route == 'new_carsale':
+        return 'POST', '/new_carsale', {'make': 'MB', 'model': 'cclass', 'builtyear': '2020',
+                                        'odometer': str(rnd.randrange(100000)),
+                                        'price': '%.2f' % rnd.uniform(10000, 90000)}
+    if route == 'update_carsale':
+        low, high = context['ids']
+        return 'POST', '/update_carsale', {'carsale_id': str(rnd.randint(low, high)),
+                                           'customer': context['customer'],
+                                           'salesperson': context['salesperson'],
+                                           'sale_date': time.strftime('%Y-%m-%d')}
+    raise ValueError(route)
+
+
+def _routeSchedule(rnd):
+    routes = [r for r, weight in ROUTE_MIX.items() for _ in range(weight)]
+    while True:
+        yield rnd.choice(routes)
+
+
+def runClient(args, context, recorder):
+    from application import create_app
+
+    client = create_app(randomSecret=True).test_client()
+
+    def session():
+        cookie = client.get_cookie('session')
+        return cookie.value if cookie else None
+
+    def call(route, method, path, data):
+        before = session()
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data, follow_redirects=False)
+        elapsed = time.perf_counter() - started
+        ok = succeeded(response.status_code, response.headers.get('Location'), response.data,
+                       session(), before)
+        recorder.record(route, elapsed, ok)
+        return ok
+
+    if not call('login', 'POST', '/login', {'id': args.user, 'password': args.password}):
+        raise SystemExit("Login failed for user {}".format(args.user))
+
+    rnd = random.Random(args.seed)
+    schedule = _routeSchedule(rnd)
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        route = next(schedule)
+        method, path, data = _requestFor(route, rnd, context)
+        call(route, method, path, data)
+
+
+# Hands redirects back to the caller (as an HTTPError) instead of following them
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def _httpWorker(args, context, recorder, workerId, deadline):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), _NoRedirect())
+
+    def session():
+        return next((c.value for c in jar if c.name == 'session'), None)
+
+    def call(route, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        before = session()
+        started = time.perf_counter()
+        status = location = content = None
+        try:
+            with opener.open(urllib.request.Request(args.url + path, data=body, method=method),
+                             timeout=args.timeout) as response:
+                status, location, content = response.status, response.headers.get('Location'), response.read()
+        except urllib.error.HTTPError as e:
+            status, location, content = e.code, e.headers.get('Location'), e.read()
+        except (urllib.error.URLError, OSError):
+            pass
+        elapsed = time.perf_counter() - started
+        ok = succeeded(status, location, content, session(), before)
+        recorder.record(route, elapsed, ok)
+        return ok
+
+    if not call('login', 'POST', '/login', {'id': args.user, 'password': args.password}):
+        raise RuntimeError("Login failed for user {} (worker {})".format(args.user, workerId))
+    rnd = random.Random(args.seed + workerId)
+    schedule = _routeSchedule(rnd)
+    while time.perf_counter() < deadline:
+        route = next(schedule)
+        call(route, *_requestFor(route, rnd, context))
+
+
+def runHttp(args, context, recorder):
+    deadline = time.perf_counter() + args.duration
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for future in [executor.submit(_httpWorker, args, context, recorder, i, deadline)
+                       for i in range(args.workers)]:
+            future.result()
+
+
+def printReport(title, report, baseline=None):
+    print(title)
+    print("  {:<16} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, r in report.items():
+        line = "  {:<16} {:>9} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            route, r['requests'], r['errors'], r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'])
+        if baseline and route in baseline and baseline[route]['p95_ms']:
+            change = (r['p95_ms'] / baseline[route]['p95_ms'] - 1) * 100
+            line += "  p95 {:+.0f}%".format(change)
+        print(line)
+
+
+def regressions(report, baseline, tolerance):
+    found = []
+    for route, r in report.items():
+        base = baseline.get(route)
+        if not base:
+            continue
+        if base['p95_ms'] and r['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            found.append("{}: p95 {:.1f}ms vs baseline {:.1f}ms".format(route, r['p95_ms'], base['p95_ms']))
+        if base['rps'] and route != 'login' and r['rps'] < base['rps'] * (1 - tolerance):
+            found.append("{}: {:.1f} req/s vs baseline {:.1f}".format(route, r['rps'], base['rps']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['client', 'http', 'both'], default='client')
+    parser.add_argument('--url', default='http://127.0.0.1:5001')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent HTTP workers')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per mode')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--user', default='s00000000')
+    parser.add_argument('--password', default=synthetic.PASSWORD)
+    parser.add_argument('--seed', type=int, default=9120)
+    parser.add_argument('--generate', type=int, metavar='CARS',
+                        help='load a synthetic dataset with this many cars first')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--save-baseline', help='write this run as a JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed fractional slowdown before a route counts as a regression')
+    args = parser.parse_args()
+
+    if args.generate:
+        synthetic.generate(args.generate, customers=max(1000, args.generate // 50),
+                           salespeople=200, makes=40, modelsPerMake=25, seed=args.seed)
+
+    ids, customer, salesperson = _carSaleIdRange()
+    context = {'ids': ids, 'customer': customer, 'salesperson': salesperson}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    modes = ['client', 'http'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        recorder = Recorder()
+        started = time.perf_counter()
+        (runClient if mode == 'client' else runHttp)(args, context, recorder)
+        results[mode] = recorder.report(time.perf_counter() - started)
+        printReport("[{}]".format(mode), results[mode], baseline and baseline.get(mode))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved report to", args.save_baseline)
+
+    if baseline:
+        found = [mode + " " + r for mode in results
+                 for r in regressions(results[mode], baseline.get(mode, {}), args.tolerance)]
+        for r in found:
+            print("REGRESSION", r)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''
+Compare the registered hot queries run as plain SQL with the same queries
+run as prepared statements (statements.py).
+
+Works on the seed data or a synthetic dataset (python -m benchmarks.synthetic):
+
+    python -m benchmarks.prepared_benchmark --repeat 500
+
+Each query is timed end to end from the client, alternating unprepared and
+prepared runs on one connection. The planning column is the server's own
+Planning Time for the unprepared query (EXPLAIN ANALYZE), which is the part
+prepared statements stop paying once PostgreSQL switches to a generic plan.
+The update statements are left out so the benchmark never writes.
+'''
+import argparse
+import statistics
+import time
+
+import database
+import statements
+
+
+def _sampleParams(cursor):
+    cursor.execute("SELECT UserName, LOWER(FirstName || ' ' || LastName) FROM Salesperson LIMIT 1")
+    login, salesperson = cursor.fetchone()
+    cursor.execute("SELECT LOWER(FirstName || ' ' || LastName) FROM Customer LIMIT 1")
+    customer = cursor.fetchone()[0]
+    cursor.execute("SELECT MIN(CarSaleID) FROM CarSales")
+    carsaleId = cursor.fetchone()[0]
+    return [
+        (database.LOGIN_STATEMENT, {'login': login.upper()}),
+        (database.SUMMARY_STATEMENT, None),
+        (database.SEARCH_FIRST_PAGE_STATEMENT, {'kw': '%toy%', 'limit': 51}),
+        (database.RESOLVE_NAMES_STATEMENT, {'customer': customer, 'salesperson': salesperson}),
+        (database.CAR_SALE_STATEMENT, {'carsale_id': carsaleId}),
+    ]
+
+
+def _planningMs(cursor, statement, params):
+    cursor.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + statement.sql, params)
+    return cursor.fetchone()[0][0]['Planning Time']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    statements.ENABLED = True
+    conn = database.openConnection()
+    if conn is None:
+        raise SystemExit("Could not connect to the database")
+    try:
+        with conn.cursor() as cursor:
+            cases = _sampleParams(cursor)
+            conn.rollback()
+            print("{:<28} {:>12} {:>12} {:>9} {:>12}".format(
+                'statement', 'plain ms', 'prepared ms', 'saving', 'planning ms'))
+
+            for statement, params in cases:
+                plain, prepared = [], []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    cursor.execute(statement.sql, params)
+                    cursor.fetchall()
+                    plain.append(time.perf_counter() - started)
+
+                    started = time.perf_counter()
+                    statements.execute(cursor, statement, params)
+                    cursor.fetchall()
+                    prepared.append(time.perf_counter() - started)
+                    conn.rollback()
+
+                plainMs = statistics.median(plain) * 1000
+                preparedMs = statistics.median(prepared) * 1000
+                planning = _planningMs(cursor, statement, params)
+                conn.rollback()
+                print("{:<28} {:>12.3f} {:>12.3f} {:>8.0f}% {:>12.3f}".format(
+                    statement.name, plainMs, preparedMs,
+                    100 * (plainMs - preparedMs) / max(plainMs, 1e-9), planning))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Compare the memory and CPU cost of turning search result rows into the old
+per-row dicts against records.CarSaleRecord.
+
+    python -m benchmarks.records_benchmark --rows 200000
+
+No database is needed: rows shaped like database.SEARCH_QUERY's are
+generated in memory. For each approach it reports the time to map the rows,
+the memory the mapped result holds, and the time to read every field once
+through Jinja's attribute lookup (what rendering list_carsales.html does).
+'''
+import argparse
+import gc
+import random
+import statistics
+import time
+import tracemalloc
+from datetime import date, timedelta
+from decimal import Decimal
+
+import jinja2
+
+from records import CarSaleRecord
+
+
+# How database.py built each search result before records.py
+def legacyCarSale(row):
+    return {
+        'carsale_id': row[0],
+        'make': row[1],
+        'model': row[2],
+        'builtYear': row[3],
+        'odometer': row[4],
+        'price': float(row[5]),
+        'isSold': 'True' if row[6] else 'False',
+        # The query formatted the date with TO_CHAR
+        'sale_date': row[7],
+        'buyer': row[8],
+        'salesperson': row[9]
+    }
+
+
+def makeRows(count, seed):
+    rnd = random.Random(seed)
+    today = date.today()
+    legacy, raw = [], []
+    for i in range(count):
+        sold = rnd.random() < 0.6
+        saleDate = today - timedelta(days=rnd.randrange(1000)) if sold else None
+        base = (i + 1, 'MB', 'cclass', rnd.randrange(2000, 2025), rnd.randrange(200000),
+                Decimal('%.2f' % rnd.uniform(5000, 200000)), sold)
+        people = ('Olivia Smith', 'John Doe') if sold else ('N/A', 'N/A')
+        legacy.append(base + (saleDate.strftime('%d-%m-%Y') if sold else None,) + people)
+        raw.append(base + (saleDate,) + people)
+    return legacy, raw
+
+
+def measure(rows, mapper, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        mapper(rows)
+        timings.append(time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    mapped = mapper(rows)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return statistics.median(timings), held, mapped
+
+
+def readAll(mapped, fields, repeat):
+    # `{{ i.price }}` in a template is environment.getattr(i, 'price')
+    lookup = jinja2.Environment().getattr
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for row in mapped:
+            for name in fields:
+                lookup(row, name)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=9120)
+    args = parser.parse_args()
+
+    legacyRows, rawRows = makeRows(args.rows, args.seed)
+    fields = CarSaleRecord._fields
+    results = []
+    for name, rows, mapper in (
+            ('dict', legacyRows, lambda rows: [legacyCarSale(row) for row in rows]),
+            ('CarSaleRecord', rawRows, lambda rows: list(map(CarSaleRecord, rows)))):
+        mapSeconds, held, mapped = measure(rows, mapper, args.repeat)
+        readSeconds = readAll(mapped, fields, args.repeat)
+        results.append((name, mapSeconds, held, readSeconds))
+        del mapped
+
+    print("{:,} rows".format(args.rows))
+    print("{:<14} {:>10} {:>12} {:>12} {:>10}".format('approach', 'map ms', 'held MiB', 'bytes/row', 'read ms'))
+    for name, mapSeconds, held, readSeconds in results:
+        print("{:<14} {:>10.1f} {:>12.1f} {:>12.0f} {:>10.1f}".format(
+            name, mapSeconds * 1000, held / 2 ** 20, held / args.rows, readSeconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''
+Compare findCarSales against the original LIKE-based search.
+
+Load a large dataset first (python -m benchmarks.synthetic --cars 1000000),
+then run:
+
+    python -m benchmarks.search_benchmark --repeat 5
+
+Both queries run against the same database and their result sets are
+checked against each other for every search term.
+'''
+import argparse
+import statistics
+import time
+from datetime import date
+
+import database
+
+# The search query as it was before the indexed search subsystem (returning the
+# raw SaleDate, which the search query now leaves to records.CarSaleRecord to format)
+LEGACY_QUERY = """
+SELECT
+    cs.CarSaleID,
+    cs.MakeCode,
+    cs.ModelCode,
+    cs.BuiltYear,
+    cs.Odometer,
+    cs.Price,
+    cs.IsSold,
+    cs.SaleDate,
+    COALESCE(c.FirstName || ' ' || c.LastName, 'N/A') AS Buyer,
+    COALESCE(sp.FirstName || ' ' || sp.LastName, 'N/A') AS Salesperson
+FROM CarSales cs
+LEFT JOIN Customer c ON cs.BuyerID = c.CustomerID
+LEFT JOIN Salesperson sp ON cs.SalespersonID = sp.Username
+WHERE
+    (
+        LOWER(cs.MakeCode) LIKE %(kw)s OR
+        LOWER(cs.ModelCode) LIKE %(kw)s OR
+        LOWER(COALESCE(c.FirstName || ' ' || c.LastName, '')) LIKE %(kw)s OR
+        LOWER(COALESCE(sp.FirstName || ' ' || sp.LastName, '')) LIKE %(kw)s
+    )
+    AND (
+        cs.IsSold = FALSE OR
+        (cs.IsSold = TRUE AND cs.SaleDate >= CURRENT_DATE - INTERVAL '3 years')
+    )
+ORDER BY
+    cs.IsSold ASC,
+    cs.SaleDate ASC NULLS FIRST,
+    cs.MakeCode ASC,
+    cs.ModelCode ASC;
+"""
+
+DEFAULT_TERMS = ['Thompson1234', 'bench7', 'm012x', 'toy', 'Olivia', 'zzz-no-match']
+
+
+def _time(cursor, query, keyword, repeat):
+    samples = []
+    rows = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute(query, {'kw': keyword})
+        rows = cursor.fetchall()
+        samples.append(time.perf_counter() - started)
+    return samples, rows
+
+
+def _sortKey(row):
+    # Rows that tie on the ORDER BY columns may come back in any order
+    return (row[6], row[7] or date.min, row[1], row[2], row[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('terms', nargs='*', default=DEFAULT_TERMS)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with database.pooledConnection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM CarSales")
+        print("CarSales rows: {:,}".format(cursor.fetchone()[0]))
+        print("{:<16} {:>8} {:>12} {:>12} {:>8}".format('term', 'rows', 'LIKE ms', 'indexed ms', 'speedup'))
+
+        for term in args.terms:
+            keyword = f"%{term.lower()}%"
+            legacy, legacyRows = _time(cursor, LEGACY_QUERY, keyword, args.repeat)
+            indexed, indexedRows = _time(cursor, database.SEARCH_QUERY, keyword, args.repeat)
+
+            if sorted(legacyRows, key=_sortKey) != sorted(indexedRows, key=_sortKey):
+                print("  MISMATCH for {!r}: {} vs {} rows".format(term, len(legacyRows), len(indexedRows)))
+
+            legacyMs = statistics.median(legacy) * 1000
+            indexedMs = statistics.median(indexed) * 1000
+            print("{:<16} {:>8} {:>12.1f} {:>12.1f} {:>7.1f}x".format(
+                term, len(indexedRows), legacyMs, indexedMs, legacyMs / max(indexedMs, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
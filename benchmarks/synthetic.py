@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''
+Generate a synthetic SAG dataset matching SAGschema.sql.
+
+Run SAGschema.sql first, then for example:
+
+    python -m benchmarks.synthetic --cars 1000000
+
+Rows are loaded with COPY on top of the seed data. The CarSales triggers are
+disabled during the load and the summary table is rebuilt afterwards.
+'''
+import argparse
+import io
+import random
+import time
+from datetime import date, timedelta
+
+import database
+
+FIRST_NAMES = ['Olivia', 'Noah', 'Amelia', 'Jack', 'Isla', 'William', 'Mia', 'Oliver',
+               'Ava', 'Leo', 'Grace', 'Henry', 'Chloe', 'Lucas', 'Zoe', 'Thomas',
+               'Ruby', 'James', 'Ella', 'Ethan', 'Sophie', 'Liam', 'Harper', 'Max']
+LAST_NAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Nguyen',
+              'Johnson', 'Martin', 'White', 'Anderson', 'Walker', 'Thompson', 'Kelly',
+              'Ryan', 'Lee', 'Harris', 'King', 'Clarke', 'Young', 'Wright', 'Chen']
+
+# Password given to every generated salesperson
+PASSWORD = 'Bench1234'
+
+
+def _copy(cursor, table, columns, rows, chunk=50000):
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write('\t'.join('\\N' if v is None else str(v) for v in row))
+        buf.write('\n')
+        count += 1
+        if count % chunk == 0:
+            buf.seek(0)
+            cursor.copy_from(buf, table, columns=columns)
+            buf = io.StringIO()
+    buf.seek(0)
+    cursor.copy_from(buf, table, columns=columns)
+    return count
+
+
+def generate(cars, customers, salespeople, makes, modelsPerMake, soldRatio=0.6, seed=9120):
+    rnd = random.Random(seed)
+    today = date.today()
+
+    with database.pooledConnection() as conn, conn.cursor() as cursor:
+        started = time.perf_counter()
+
+        makeCodes = ['M%03d' % i for i in range(makes)]
+        _copy(cursor, 'make', ('makecode', 'makename'),
+              ((code, 'Bench Make %d' % i) for i, code in enumerate(makeCodes)))
+
+        models = []
+        for i, make in enumerate(makeCodes):
+            for j in range(modelsPerMake):
+                models.append(('m%03dx%03d' % (i, j), make))
+        _copy(cursor, 'model', ('modelcode', 'modelname', 'makecode'),
+              ((code, 'Bench Model %s' % code, make) for code, make in models))
+
+        customerIds = ['b%08d' % i for i in range(customers)]
+        _copy(cursor, 'customer', ('customerid', 'firstname', 'lastname', 'mobile'),
+              ((cid, rnd.choice(FIRST_NAMES), '%s%d' % (rnd.choice(LAST_NAMES), i),
+                '04%08d' % rnd.randrange(10 ** 8))
+               for i, cid in enumerate(customerIds)))
+
+        salesIds = ['s%08d' % i for i in range(salespeople)]
+        _copy(cursor, 'salesperson', ('username', 'password', 'firstname', 'lastname'),
+              ((sid, PASSWORD, FIRST_NAMES[i % len(FIRST_NAMES)], 'Bench%d' % i)
+               for i, sid in enumerate(salesIds)))
+
+        def carRows():
+            for _ in range(cars):
+                model, make = rnd.choice(models)
+                built = rnd.randint(2000, today.year)
+                if rnd.random() < soldRatio:
+                    saleDate = today - timedelta(days=rnd.randrange(365 * 10))
+                    yield (make, model, built, rnd.randrange(250000),
+                           '%.2f' % rnd.uniform(5000, 200000), 't',
+                           rnd.choice(customerIds), rnd.choice(salesIds), saleDate.isoformat())
+                else:
+                    yield (make, model, built, rnd.randrange(250000),
+                           '%.2f' % rnd.uniform(5000, 200000), 'f', None, None, None)
+
+        cursor.execute("ALTER TABLE CarSales DISABLE TRIGGER USER")
+        _copy(cursor, 'carsales',
+              ('makecode', 'modelcode', 'builtyear', 'odometer', 'price', 'issold',
+               'buyerid', 'salespersonid', 'saledate'),
+              carRows())
+        cursor.execute("ALTER TABLE CarSales ENABLE TRIGGER USER")
+        cursor.execute("SELECT rebuild_carsales_summary()")
+        # The daily rollup exists once migration 0004 is applied
+        cursor.execute("SELECT to_regproc('rebuild_sales_daily') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT rebuild_sales_daily()")
+        # The change trigger was disabled too; tell running workers to drop their caches
+        cursor.execute("SELECT pg_notify('sag_carsales_changed', 'carsales')")
+        conn.commit()
+
+        cursor.execute("ANALYZE")
+        conn.commit()
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cars', type=int, default=100000)
+    parser.add_argument('--customers', type=int, default=20000)
+    parser.add_argument('--salespeople', type=int, default=200)
+    parser.add_argument('--makes', type=int, default=40)
+    parser.add_argument('--models-per-make', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=9120)
+    args = parser.parse_args()
+
+    elapsed = generate(args.cars, args.customers, args.salespeople,
+                       args.makes, args.models_per_make, seed=args.seed)
+    print("Loaded {:,} car sales in {:.1f}s".format(args.cars, elapsed))
+
+
+if __name__ == '__main__':
+    main()
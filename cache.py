@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+#####################################################
+##  In-process cache
+#####################################################
+
+'''
+A thread-safe, size-bounded LRU cache whose entries expire after `ttl` seconds.
+
+get() returns `default` for missing or expired keys. Entries can be dropped
+one at a time with invalidate() or all at once with clear().
+'''
+class TTLCache:
+
+    def __init__(self, maxSize=1024, ttl=300.0):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()      # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxSize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+'''
+An LRU cache of query results that is invalidated as a whole by bumping a
+data version, e.g. when a write to the underlying tables commits.
+
+Entries are stored under the version that was current when the query
+started, so a result loaded while a write commits is never served afterwards.
+Each entry carries a fingerprint of the result, usable as an HTTP ETag: it
+is the same in every worker process for the same data.
+'''
+class ResultCache:
+
+    def __init__(self, maxSize=256, ttl=60.0):
+        self._entries = TTLCache(maxSize=maxSize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.version = 0
+        self.invalidations = 0
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    '''
+    Return (result, fingerprint) for `key`, calling `load()` on a miss.
+    Exceptions from `load()` propagate and nothing is cached.
+    '''
+    def get(self, key, load):
+        version = self.version
+        entry = self._entries.get((version, key))
+        if entry is None:
+            result = load()
+            entry = (result, fingerprint(result))
+            with self._lock:
+                if self.version == version:
+                    self._entries.set((version, key), entry)
+        return entry
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self.invalidations += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def fingerprint(value):
+    data = json.dumps(value, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
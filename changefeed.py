@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import database
+
+#####################################################
+##  Live change feed
+#####################################################
+
+'''
+Server-sent events for car sales added and sold.
+
+The row triggers of migration 0005 send a JSON notification on
+EVENT_CHANNEL for every car inserted or sold. Each worker receives them on
+its existing LISTEN thread (database.getListener) and the EventHub copies
+each one onto the queue of every open stream, so there is one database
+connection per worker however many browsers are watching.
+
+An open stream holds a request thread, so each worker serves at most
+MAX_STREAMS of them, always leaving it a thread for other requests, and ends
+each after STREAM_SECONDS; the browser then reconnects, sending the id of the
+last event it saw. Event ids come from a database sequence in the trigger
+payload, so every worker knows every event by the same id and the browser may
+reconnect to any of them. Events still in that worker's history are replayed;
+otherwise the stream starts with a `reset` event and the page reloads itself. A `reset` is also sent when the listener
+reconnects (notifications may have been missed) and to a stream whose queue
+overflows.
+'''
+
+# NOTIFY channel of the carsales_notify_row trigger in migration 0005
+EVENT_CHANNEL = 'sag_carsales_events'
+
+# Request threads per worker (gunicorn.conf.py)
+THREADS = int(os.environ.get('SAG_THREADS', '4'))
+# Open event streams allowed per worker; each holds a request thread, so at
+# least one thread is always left for pages and form posts
+MAX_STREAMS = max(0, min(int(os.environ.get('SAG_EVENT_STREAMS', max(1, THREADS // 2))),
+                         THREADS - 1))
+# A stream is closed (and the browser reconnects) after this many seconds
+STREAM_SECONDS = float(os.environ.get('SAG_EVENT_STREAM_SECONDS', '300'))
+# Comment line sent on an idle stream, so dead connections are noticed
+KEEPALIVE_SECONDS = 15.0
+# Events kept for replay to reconnecting browsers
+HISTORY_SIZE = 256
+# Events a slow stream may fall behind before it is reset
+QUEUE_SIZE = 100
+
+_RESET = object()
+
+
+class EventHub:
+
+    def __init__(self, maxStreams=MAX_STREAMS, historySize=HISTORY_SIZE, queueSize=QUEUE_SIZE):
+        self.maxStreams = maxStreams
+        self.queueSize = queueSize
+        self._lock = threading.Lock()
+        self._history = deque(maxlen=historySize)
+        self._streams = set()
+
+    def publish(self, channel, payload):
+        try:
+            eventId = str(json.loads(payload)['event_id'])
+        except (ValueError, TypeError, KeyError) as e:
+            print("[WARN] Ignoring car sale event without an id:", e)
+            return
+        with self._lock:
+            event = (eventId, payload)
+            self._history.append(event)
+            streams = list(self._streams)
+        for stream in streams:
+            self._put(stream, event)
+
+    '''
+    Tell every open stream to reload, e.g. after notifications may have been lost
+    '''
+    def reset(self, channel=None, payload=None):
+        with self._lock:
+            self._history.clear()
+            streams = list(self._streams)
+        for stream in streams:
+            self._put(stream, _RESET)
+
+    def _put(self, stream, event):
+        try:
+            stream.put_nowait(event)
+        except queue.Full:
+            # The browser is too far behind to catch up from deltas
+            with stream.mutex:
+                stream.queue.clear()
+            stream.put_nowait(_RESET)
+
+    '''
+    Register a stream, returning its queue (None when MAX_STREAMS are open).
+    Events after `lastEventId` still in the history are queued first; a reset
+    is queued instead when they are not.
+    '''
+    def open(self, lastEventId=None):
+        stream = queue.Queue(maxsize=self.queueSize)
+        with self._lock:
+            if len(self._streams) >= self.maxStreams:
+                return None
+            if lastEventId:
+                ids = [eventId for eventId, _ in self._history]
+                if lastEventId in ids:
+                    for event in list(self._history)[ids.index(lastEventId) + 1:]:
+                        stream.put_nowait(event)
+                else:
+                    stream.put_nowait(_RESET)
+            self._streams.add(stream)
+        return stream
+
+    def close(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+
+_hub = None
+_hubPid = None
+_hubLock = threading.Lock()
+
+'''
+This process's hub, subscribed to EVENT_CHANNEL on first use
+'''
+def getHub():
+    global _hub, _hubPid
+    if _hub is None or _hubPid != os.getpid():
+        with _hubLock:
+            if _hub is None or _hubPid != os.getpid():
+                hub = EventHub()
+                listener = database.getListener()
+                listener.subscribe(EVENT_CHANNEL, hub.publish)
+                listener.onReconnect(hub.reset)
+                _hub = hub
+                _hubPid = os.getpid()
+    return _hub
+
+'''
+The text/event-stream body for one open stream. The WSGI server calls
+close() when the response ends, even if the body was never iterated.
+'''
+class EventStream:
+
+    def __init__(self, hub, events):
+        self._hub = hub
+        self._events = events
+
+    def __iter__(self):
+        events = self._events
+        yield 'retry: 5000\n\n'
+        deadline = time.monotonic() + STREAM_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = events.get(timeout=min(KEEPALIVE_SECONDS, remaining))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is _RESET:
+                yield 'event: reset\ndata: {}\n\n'
+            else:
+                eventId, payload = event
+                yield 'id: %s\nevent: carsale\ndata: %s\n\n' % (eventId, payload)
+
+    def close(self):
+        self._hub.close(self._events)
+
+'''
+Open an EventStream for one browser, or return None when this worker
+already has MAX_STREAMS open.
+'''
+def openStream(lastEventId=None):
+    hub = getHub()
+    events = hub.open(lastEventId)
+    return EventStream(hub, events) if events is not None else None
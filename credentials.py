@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+#####################################################
+##  Password hashing
+#####################################################
+
+'''
+Salted password hashes for Salesperson logins.
+
+Hashes use werkzeug's "method$salt$hash" format. The method string carries
+the work factor (e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"), so it
+can be raised later: stored hashes made with an older method are re-hashed
+on the next successful login (see needsRehash).
+
+Hashing is deliberately slow, so it runs on a small per-process thread pool
+rather than on however many request threads happen to be logging in. At most
+HASH_WORKERS hashes run at once and at most HASH_BACKLOG more are queued;
+a login that finds the queue full gives up after HASH_WAIT seconds with
+CredentialsBusy instead of tying up its request thread.
+'''
+
+# werkzeug hash method including its work factor
+PASSWORD_METHOD = os.environ.get('SAG_PASSWORD_METHOD', 'scrypt:32768:8:1')
+# Concurrent hash computations per worker process
+HASH_WORKERS = int(os.environ.get('SAG_PASSWORD_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+# Logins allowed to queue for a hashing thread before new ones are refused
+HASH_BACKLOG = int(os.environ.get('SAG_PASSWORD_BACKLOG', '32'))
+# Longest a login waits for a queue slot
+HASH_WAIT = float(os.environ.get('SAG_PASSWORD_WAIT', '5'))
+
+
+'''
+Raised when too many logins are already waiting for password verification
+'''
+class CredentialsBusy(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_executor = None
+_executorPid = None
+_slots = None
+_dummyHash = None
+
+
+def _getExecutor():
+    global _executor, _executorPid, _slots
+    if _executor is None or _executorPid != os.getpid():
+        with _lock:
+            if _executor is None or _executorPid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS,
+                                               thread_name_prefix='sag-password')
+                _slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_BACKLOG)
+                _executorPid = os.getpid()
+    return _executor
+
+
+def _run(fn, *args):
+    executor = _getExecutor()
+    slots = _slots
+    if not slots.acquire(timeout=HASH_WAIT):
+        raise CredentialsBusy("Too many logins in progress")
+    try:
+        future = executor.submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda f: slots.release())
+    return future.result()
+
+
+'''
+Hash a password with PASSWORD_METHOD (on the calling thread)
+'''
+def hashPassword(password):
+    return generate_password_hash(password, method=PASSWORD_METHOD)
+
+'''
+True when a stored hash was made with a different method or work factor
+'''
+def needsRehash(passwordHash):
+    return passwordHash.split('$', 1)[0] != PASSWORD_METHOD
+
+
+def _verify(passwordHash, plaintext, password):
+    if passwordHash:
+        ok = check_password_hash(passwordHash, password)
+    elif plaintext is not None:
+        # Legacy row from before hashing
+        ok = hmac.compare_digest(plaintext.encode('utf-8'), password.encode('utf-8'))
+    else:
+        return False, None
+    if ok and (not passwordHash or needsRehash(passwordHash)):
+        return True, hashPassword(password)
+    return ok, None
+
+
+def _verifyDummy(password):
+    global _dummyHash
+    if _dummyHash is None:
+        _dummyHash = hashPassword('sag-no-such-user')
+    check_password_hash(_dummyHash, password)
+    return False, None
+
+'''
+Check a password against a Salesperson row's stored credentials on the
+hashing pool. `passwordHash` and `plaintext` are the row's PasswordHash and
+legacy Password columns; pass None for both when there is no such user, so
+the response takes as long as for a real one.
+
+Returns (matched, new hash). The new hash is set when the password matched
+a legacy plaintext row or a hash made with an older method, and should be
+stored in place of the old credentials.
+
+Raises CredentialsBusy when the pool's queue is full.
+'''
+def verifyPassword(passwordHash, plaintext, password):
+    if passwordHash is None and plaintext is None:
+        return _run(_verifyDummy, password)
+    return _run(_verify, passwordHash, plaintext, password)
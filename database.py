@@ -1,226 +1,814 @@
 #!/usr/bin/env python3
+import base64
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+from psycopg2.extras import execute_values
 from datetime import datetime, date
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from dbpool import ConnectionPool, PoolError, PoolTimeout
+from cache import ResultCache, TTLCache, fingerprint
+from listener import ChangeListener
+from records import CarSaleRecord, SummaryRecord
+import credentials
+import instrument
+import statements
+from instrument import operation
 #####################################################
 ##  Database Connection
 #####################################################
 
 '''
-Connect to the database using the connection string
+Connection settings shared by the sync and async data-access layers
 '''
-def openConnection():
+def connectionParams():
     # connection parameters - ENTER YOUR LOGIN AND PASSWORD HERE
+    # (or set SAG_DB_HOST / SAG_DB_USER / SAG_DB_PASSWORD)
+
+    myHost = os.environ.get('SAG_DB_HOST', "")
+    userid = os.environ.get('SAG_DB_USER', "")
+    passwd = os.environ.get('SAG_DB_PASSWORD', "")
 
-    myHost = ""
-    userid = ""
-    passwd = ""
+    return {'dbname': userid, 'user': userid, 'password': passwd, 'host': myHost}
 
+'''
+Connect to the database using the connection string
+'''
+def openConnection(dsn=None):
     # Create a connection to the database
     conn = None
     try:
         # Parses the config file and connects using the connect string
-        conn = psycopg2.connect(database=userid,
-                                    user=userid,
-                                    password=passwd,
-                                    host=myHost)
+        if dsn:
+            conn = psycopg2.connect(dsn, cursor_factory=instrument.InstrumentedCursor)
+        else:
+            conn = psycopg2.connect(**connectionParams(),
+                                    cursor_factory=instrument.InstrumentedCursor)
 
     except psycopg2.Error as sqle:
-        print("psycopg2.Error : " + sqle.pgerror)
+        print("psycopg2.Error : " + str(sqle.pgerror or sqle))
     
     # return the connection to use
     return conn
 
+#####################################################
+##  Connection Pool
+#####################################################
+
+# Pool settings; override through the environment when deploying
+POOL_MIN_SIZE = int(os.environ.get('SAG_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.environ.get('SAG_POOL_MAX_SIZE', '10'))
+POOL_MAX_LIFETIME = float(os.environ.get('SAG_POOL_MAX_LIFETIME', '1800'))
+POOL_CHECKOUT_TIMEOUT = float(os.environ.get('SAG_POOL_CHECKOUT_TIMEOUT', '10'))
+
+# Opt-in diagnostics: log the stored-function totals after summaries and inserts.
+# Off by default so the hot path only runs the queries it needs.
+DIAGNOSTICS = os.environ.get('SAG_DB_DIAGNOSTICS', '') == '1'
+
+_pool = None
+_poolPid = None
+_poolLock = threading.Lock()
+
+'''
+Return the process-wide connection pool, creating it on first use.
+Each worker process gets its own pool: connections are never shared across
+a fork.
+'''
+def getPool():
+    global _pool, _poolPid
+    if _pool is None or _poolPid != os.getpid():
+        with _poolLock:
+            if _pool is None or _poolPid != os.getpid():
+                pool = ConnectionPool(openConnection,
+                                      minSize=POOL_MIN_SIZE,
+                                      maxSize=POOL_MAX_SIZE,
+                                      maxLifetime=POOL_MAX_LIFETIME,
+                                      checkoutTimeout=POOL_CHECKOUT_TIMEOUT)
+                try:
+                    pool.warm()
+                except psycopg2.Error as e:
+                    print("[WARN] Could not pre-open pooled connections:", e)
+                _pool = pool
+                _poolPid = os.getpid()
+    return _pool
+
+'''
+Borrow a pooled connection for the duration of a `with` block.
+Uncommitted work is rolled back when the connection goes back to the pool.
+Without `pool` the connection comes from the primary.
+'''
+@contextmanager
+def pooledConnection(pool=None):
+    if pool is None:
+        pool = getPool()
+    started = time.perf_counter()
+    try:
+        conn = pool.getconn()
+    except Exception:
+        instrument.recordAcquire(time.perf_counter() - started, error=True)
+        raise
+    instrument.recordAcquire(time.perf_counter() - started)
+
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, discard=broken or bool(conn.closed))
+
+'''
+Pool metrics: in-use count, checkout wait time and checkout failures
+'''
+def getPoolStats():
+    return getPool().stats()
+
+'''
+Close all pooled connections, e.g. on shutdown
+'''
+def closePool():
+    global _pool, _replicas
+    with _poolLock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+        for replica in _replicas or []:
+            replica.pool.closeall()
+        _replicas = None
+
+#####################################################
+##  Read replicas
+#####################################################
+
+# Comma-separated libpq DSNs of read replicas; empty sends every query to the primary
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('SAG_DB_REPLICA_DSNS', '').split(',') if dsn.strip()]
+# How long a replica is skipped after a failed checkout
+REPLICA_RETRY_AFTER = float(os.environ.get('SAG_DB_REPLICA_RETRY_AFTER', '30'))
+# Reads go to the primary for this long after the same user's own write,
+# so they see it even if the replicas lag behind
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('SAG_READ_YOUR_WRITES_SECONDS', '5'))
+
+class _Replica:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.downUntil = 0.0
+        self.pool = ConnectionPool(lambda: openConnection(dsn),
+                                   minSize=0,
+                                   maxSize=POOL_MAX_SIZE,
+                                   maxLifetime=POOL_MAX_LIFETIME,
+                                   checkoutTimeout=POOL_CHECKOUT_TIMEOUT)
+
+_replicas = None
+_replicasPid = None
+_nextReplica = itertools.count()
+
+# Wall-clock time until which reads in this context stick to the primary
+_primaryUntil = contextvars.ContextVar('sag_primary_until', default=0.0)
+
+def _getReplicas():
+    global _replicas, _replicasPid
+    if _replicas is None or _replicasPid != os.getpid():
+        with _poolLock:
+            if _replicas is None or _replicasPid != os.getpid():
+                _replicas = [_Replica(dsn) for dsn in REPLICA_DSNS]
+                _replicasPid = os.getpid()
+    return _replicas
+
+'''
+Record that this context just committed a write: its reads stay on the
+primary for READ_YOUR_WRITES_SECONDS and this process's cached results are
+dropped straight away, without waiting for the change notification
+'''
+def markWrite():
+    _primaryUntil.set(time.time() + READ_YOUR_WRITES_SECONDS)
+    invalidateResultCache()
+
+'''
+Get/set the read-your-writes deadline, so the web layer can carry it between
+a user's requests (see routes.py)
+'''
+def getPrimaryUntil():
+    return _primaryUntil.get()
+
+def setPrimaryUntil(until):
+    _primaryUntil.set(float(until or 0.0))
+
+'''
+Borrow a connection for read-only queries: from the next healthy replica
+in round-robin order, or from the primary when there are no healthy replicas
+or this context wrote recently.
+'''
+@contextmanager
+def readConnection():
+    replicas = _getReplicas()
+    if not replicas or time.time() < _primaryUntil.get():
+        with pooledConnection() as conn:
+            yield conn
+        return
+
+    now = time.monotonic()
+    start = next(_nextReplica)
+    for i in range(len(replicas)):
+        replica = replicas[(start + i) % len(replicas)]
+        if replica.downUntil > now:
+            continue
+        try:
+            conn = replica.pool.getconn()
+        except PoolTimeout as e:
+            # Every connection to it is busy; the replica itself is fine
+            print("[WARN] Replica busy, trying the next one:", e)
+            continue
+        except (PoolError, psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # Could not connect (PoolError), or a connection broke on checkout
+            print(f"[WARN] Replica unavailable, skipping for {REPLICA_RETRY_AFTER:.0f}s:", e)
+            replica.downUntil = now + REPLICA_RETRY_AFTER
+            continue
+        except psycopg2.Error as e:
+            print("[WARN] Replica checkout failed, trying the next one:", e)
+            continue
+
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            replica.pool.putconn(conn, discard=broken or bool(conn.closed))
+        return
+
+    # Every replica is down: fall back to the primary
+    with pooledConnection() as conn:
+        yield conn
+
+'''
+Pool metrics for each replica, in SAG_DB_REPLICA_DSNS order
+'''
+def getReplicaStats():
+    return [dict(replica.pool.stats(), healthy=replica.downUntil <= time.monotonic())
+            for replica in _getReplicas()]
+
+#####################################################
+##  Result cache
+#####################################################
+
+# Cached summary / search results per worker; 0 disables the cache
+RESULT_CACHE_SIZE = int(os.environ.get('SAG_RESULT_CACHE_SIZE', '256'))
+RESULT_CACHE_TTL = float(os.environ.get('SAG_RESULT_CACHE_TTL', '60'))
+# Listen for the change notifications sent by the CarSales triggers, so a write
+# committed by any worker (or by psql) invalidates every worker's cache. With
+# this off only writes made through this process invalidate it.
+RESULT_CACHE_LISTEN = os.environ.get('SAG_RESULT_CACHE_LISTEN', '1') == '1'
+
+# NOTIFY channel of the carsales_notify_changed triggers in SAGschema.sql
+CHANGE_CHANNEL = 'sag_carsales_changed'
+
+_results = ResultCache(maxSize=max(RESULT_CACHE_SIZE, 1), ttl=RESULT_CACHE_TTL)
+_resultsInvalidatedAt = 0.0
+_listener = None
+_listenerPid = None
+
+'''
+Drop every cached summary and search result in this process
+'''
+def invalidateResultCache(channel=None, payload=None):
+    global _resultsInvalidatedAt
+    _resultsInvalidatedAt = time.monotonic()
+    _results.invalidate()
+
+'''
+This process's LISTEN connection, started on first use
+'''
+def getListener():
+    global _listener, _listenerPid
+    if _listener is None or _listenerPid != os.getpid():
+        with _poolLock:
+            if _listener is None or _listenerPid != os.getpid():
+                # Entries inherited from a parent process were never invalidated here
+                invalidateResultCache()
+                listener = ChangeListener(openConnection)
+                listener.subscribe(CHANGE_CHANNEL, invalidateResultCache)
+                listener.subscribe(CHANGE_CHANNEL, _onNamesChanged)
+                # Notifications sent while disconnected are lost
+                listener.onReconnect(invalidateResultCache)
+                listener.onReconnect(invalidateNameCache)
+                listener.start()
+                _listener = listener
+                _listenerPid = os.getpid()
+    return _listener
+
+# Returns (result, fingerprint); `load` must raise on failure so errors are never cached
+def _cachedResult(key, load):
+    if RESULT_CACHE_SIZE <= 0:
+        result = load()
+        return result, fingerprint(result)
+    if RESULT_CACHE_LISTEN and not getListener().connected:
+        # Another worker's write could go unnoticed, so do not trust the cache
+        result = load()
+        return result, fingerprint(result)
+    if REPLICA_DSNS and time.monotonic() - _resultsInvalidatedAt < READ_YOUR_WRITES_SECONDS:
+        # A replica may not have replayed the write yet; do not cache what it returns
+        result = load()
+        return result, fingerprint(result)
+    return _results.get(key, load)
+
+def getResultCacheStats():
+    return {'size': len(_results), 'hits': _results.hits, 'misses': _results.misses,
+            'invalidations': _results.invalidations,
+            'listening': bool(_listener is not None and _listener.connected)}
+
+# Username is case-insensitive; use LOWER() for uniform comparison
+LOGIN_STATEMENT = statements.register('sag_login', """
+SELECT UserName, FirstName, LastName, PasswordHash, Password
+FROM Salesperson
+WHERE LOWER(UserName) = LOWER(%(login)s)
+""", [('login', 'text')])
+
 '''
-Validate salesperson based on username and password
+Validate salesperson based on username and password.
+
+The row is found through the LOWER(UserName) index and the password is
+checked against its salted hash on the credentials hashing pool, after the
+connection has been returned. Legacy plaintext passwords and hashes made with
+an older work factor are replaced by a fresh hash on a successful login.
+Raises credentials.CredentialsBusy when too many logins are being verified.
 '''
+@operation
 def checkLogin(login, password):
-    conn = openConnection()
-    cursor = conn.cursor()
+    try:
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            statements.execute(cursor, LOGIN_STATEMENT, {'login': login})
+            user = cursor.fetchone()
 
+    except psycopg2.Error as e:
+        print("Login validation SQL error:", e.pgerror or e)
+        return None
+
+    if user is None:
+        # Spend the same time as for a real user, so logins do not reveal which names exist
+        credentials.verifyPassword(None, None, password)
+        return None
+
+    matched, newHash = credentials.verifyPassword(user[3], user[4], password)
+    if not matched:
+        # Return None if username or password is incorrect
+        return None
+
+    if newHash:
+        _storePasswordHash(user[0], newHash)
+
+    # Return matched user info
+    return [user[0], user[1], user[2]]
+
+def _storePasswordHash(username, passwordHash):
     try:
-        # Username is case-insensitive; use LOWER() for uniform comparison
-        query = """
-        SELECT Username, FirstName, LastName
-        FROM Salesperson
-        WHERE LOWER(Username) = LOWER(%s)
-          AND Password = %s
-        """
-        cursor.execute(query, (login, password))
-        user = cursor.fetchone()
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE Salesperson SET PasswordHash = %s, Password = NULL
+                WHERE UserName = %s
+            """, (passwordHash, username))
+            conn.commit()
+    except psycopg2.Error as e:
+        # The login still succeeds; the upgrade is retried next time
+        print("Failed to store password hash:", e.pgerror or e)
 
-        if user:
-            # Return matched user info
-            return [user[0], user[1], user[2]]
-        else:
-            # Return None if username or password is incorrect
-            return None
+'''
+Hash every remaining plaintext Salesperson password (the rows loaded by
+SAGschema.sql) and clear the plaintext. Returns the number of rows converted.
+'''
+@operation
+def hashLegacyPasswords():
+    try:
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT UserName, Password FROM Salesperson
+                WHERE PasswordHash IS NULL AND Password IS NOT NULL
+                FOR UPDATE
+            """)
+            rows = cursor.fetchall()
+            execute_values(cursor, """
+                UPDATE Salesperson s SET PasswordHash = v.hash, Password = NULL
+                FROM (VALUES %s) AS v(username, hash)
+                WHERE s.UserName = v.username
+            """, [(username, credentials.hashPassword(plaintext)) for username, plaintext in rows])
+            conn.commit()
+        return len(rows)
 
     except psycopg2.Error as e:
-        print("Login validation SQL error:", e.pgerror)
+        print("Password migration failed:", e.pgerror or e)
         return None
 
-    finally:
-        cursor.close()
-        conn.close()
-    
 
 
+# CarSalesSummary is kept current by a trigger on CarSales, so this is a
+# small primary-key ordered read instead of a GROUP BY over every sale
+SUMMARY_QUERY = """
+SELECT
+    s.MakeCode AS make,
+    s.ModelCode AS model,
+    s.AvailableUnits,
+    s.SoldUnits,
+    s.AllPrices,
+    s.SoldPrices,
+    s.LastSaleDate AS LastPurchasedAt
+FROM CarSalesSummary s
+ORDER BY s.MakeCode ASC, s.ModelCode ASC;
+"""
+
+SUMMARY_STATEMENT = statements.register('sag_summary', SUMMARY_QUERY)
+
+def _loadCarSalesSummary():
+    with readConnection() as conn, conn.cursor() as cursor:
+        statements.execute(cursor, SUMMARY_STATEMENT)
+        rows = cursor.fetchall()
+
+        if DIAGNOSTICS:
+            # Call stored function on the same connection: calculate_total_sales()
+            total_revenue = getTotalSoldRevenue(cursor)
+            print(f"[DEBUG] Current total sales revenue:${total_revenue:,.2f}")
+
+    return list(map(SummaryRecord, rows))
+
 """
     Retrieves the summary of car sales.
 
     This method fetches the summary of car sales from the database and returns it 
     as a collection of summary objects. Each summary contains key information 
-    about a particular car sale.
+    about a particular car sale. Results come from the result cache until
+    CarSales next changes; callers must not modify them.
 
-    :return: A list of car sale summaries.
+    :param withFingerprint: Also return a fingerprint of the result (for ETags).
+    :return: A list of car sale summaries, or (summaries, fingerprint).
 """
-def getCarSalesSummary():
-    conn = openConnection()
-    cursor = conn.cursor()
-
+@operation
+def getCarSalesSummary(withFingerprint=False):
     try:
-        query = """
-        SELECT
-            cs.MakeCode AS make,
-            cs.ModelCode AS model,
-            COUNT(*) FILTER (WHERE cs.IsSold = FALSE) AS AvailableUnits,
-            COUNT(*) FILTER (WHERE cs.IsSold = TRUE) AS SoldUnits,
-            COALESCE(SUM(cs.Price), 0) AS AllPrices,
-            COALESCE(SUM(cs.Price) FILTER (WHERE cs.IsSold = TRUE), 0) AS SoldPrices,
-            TO_CHAR(MAX(cs.SaleDate), 'DD-MM-YYYY') AS LastPurchasedAt
-        FROM CarSales cs
-        GROUP BY cs.MakeCode, cs.ModelCode
-        ORDER BY cs.MakeCode ASC, cs.ModelCode ASC;
-        """
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        summary, tag = _cachedResult(('summary',), _loadCarSalesSummary)
+    except Exception as e:
+        print("Summary function error:", e)
+        summary, tag = [], None
+    return (summary, tag) if withFingerprint else summary
 
-        result = []
-        for row in rows:
-            result.append({
-                'make': row[0],
-                'model': row[1],
-                'availableUnits': row[2],
-                'soldUnits': row[3],
-                'totalPrices': float(row[4]),
-                'soldTotalPrices': float(row[5]),
-                'lastPurchaseAt': row[6] if row[6] else 'N/A'
-            })
+"""
+    Streams the car sales summary rows through a server-side cursor.
 
-        # Call stored function: calculate_total_sales()
-        total_revenue = getTotalSoldRevenue()
-        print(f"[DEBUG] Current total sales revenue:${total_revenue:,.2f}")
+    Yields the same dicts as getCarSalesSummary, batchSize rows per round trip.
+    A database error part way through is logged and re-raised, so a caller
+    streaming the rows can tell the output is incomplete.
+"""
+@operation
+def iterCarSalesSummary(batchSize=2000):
+    try:
+        with readConnection() as conn:
+            with conn.cursor(name='summary_stream') as cursor:
+                cursor.itersize = batchSize
+                cursor.execute(SUMMARY_QUERY)
+                for row in cursor:
+                    yield SummaryRecord(row)
+    except psycopg2.Error as e:
+        print("Summary stream error:", e)
+        raise
 
-        return result
+'''
+Rebuild the CarSalesSummary table from the live CarSales aggregate.
+Returns the number of summary rows written, or None on failure.
+'''
+@operation
+def rebuildCarSalesSummary():
+    try:
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT rebuild_carsales_summary();")
+            count = cursor.fetchone()[0]
+            conn.commit()
+        return count
+    except Exception as e:
+        print("Failed to rebuild car sales summary:", e)
+        return None
 
+'''
+Compare the CarSalesSummary table against the live CarSales aggregate.
+Returns a list of mismatches (empty when they agree), or None on failure.
+'''
+@operation
+def verifyCarSalesSummary():
+    try:
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT * FROM verify_carsales_summary();")
+            rows = cursor.fetchall()
+        return [{'make': row[0], 'model': row[1], 'problem': row[2]} for row in rows]
     except Exception as e:
-        print("Summary function error:", e)
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+        print("Failed to verify car sales summary:", e)
+        return None
+
+# Search query for findCarSales.
+# Each branch of `matched` is served by an index: make/model codes are matched
+# against the small Make/Model tables and joined back through the CarSales code
+# indexes, and people names use the pg_trgm indexes on Customer/Salesperson.
+# A car is returned when any branch matches, as with the original OR of LIKEs.
+#
+# Rows are ordered by (IsSold, SaleDate NULLS FIRST, MakeCode, ModelCode) with
+# CarSaleID as a tiebreaker. SaleDate is compared through COALESCE(..., -infinity)
+# so the same key can be used for keyset pagination. For a page, every branch
+# applies the listing filter, the keyset, the ordering and the LIMIT itself, so
+# each one stops after a page of rows (the make/model branches read
+# CarSales_SearchOrder_idx in order) and only those few rows are merged.
+_SEARCH_SQL = """
+WITH matched AS (
+    (SELECT {key} FROM CarSales cs
+     WHERE cs.MakeCode IN (SELECT MakeCode FROM Make WHERE LOWER(MakeCode) LIKE %(kw)s)
+     {branch})
+    UNION
+    (SELECT {key} FROM CarSales cs
+     WHERE cs.ModelCode IN (SELECT ModelCode FROM Model WHERE LOWER(ModelCode) LIKE %(kw)s)
+     {branch})
+    UNION
+    (SELECT {key} FROM CarSales cs
+     JOIN Customer c ON cs.BuyerID = c.CustomerID
+     WHERE LOWER(c.FirstName || ' ' || c.LastName) LIKE %(kw)s
+     {branch})
+    UNION
+    (SELECT {key} FROM CarSales cs
+     JOIN Salesperson sp ON cs.SalespersonID = sp.UserName
+     WHERE LOWER(sp.FirstName || ' ' || sp.LastName) LIKE %(kw)s
+     {branch})
+)
+SELECT
+    cs.CarSaleID,
+    cs.MakeCode,
+    cs.ModelCode,
+    cs.BuiltYear,
+    cs.Odometer,
+    cs.Price,
+    cs.IsSold,
+    cs.SaleDate,
+    COALESCE(c.FirstName || ' ' || c.LastName, 'N/A') AS Buyer,
+    COALESCE(sp.FirstName || ' ' || sp.LastName, 'N/A') AS Salesperson
+FROM matched m
+JOIN CarSales cs ON cs.CarSaleID = m.CarSaleID
+LEFT JOIN Customer c ON cs.BuyerID = c.CustomerID
+LEFT JOIN Salesperson sp ON cs.SalespersonID = sp.Username
+ORDER BY
+    m.IsSold ASC,
+    m.SortDate ASC,
+    m.MakeCode ASC,
+    m.ModelCode ASC,
+    m.CarSaleID ASC
+{limit};
+"""
+
+# The sort key each branch of `matched` returns
+_SEARCH_KEY = """cs.CarSaleID, cs.IsSold, COALESCE(cs.SaleDate, '-infinity'::date) AS SortDate,
+            cs.MakeCode, cs.ModelCode"""
+
+# Appended to each branch's WHERE clause
+_SEARCH_BRANCH = """AND (cs.IsSold = FALSE OR
+          (cs.IsSold = TRUE AND cs.SaleDate >= CURRENT_DATE - INTERVAL '3 years'))
+     {keyset}
+     {page}"""
+
+_SEARCH_BRANCH_PAGE = """ORDER BY cs.IsSold, COALESCE(cs.SaleDate, '-infinity'::date),
+              cs.MakeCode, cs.ModelCode, cs.CarSaleID
+     LIMIT %(limit)s"""
+
+# Only rows strictly after the given sort key
+_SEARCH_KEYSET = """AND (cs.IsSold, COALESCE(cs.SaleDate, '-infinity'::date),
+          cs.MakeCode, cs.ModelCode, cs.CarSaleID)
+         > (%(k_sold)s, COALESCE(%(k_date)s::date, '-infinity'::date),
+            %(k_make)s, %(k_model)s, %(k_id)s)"""
+
+def _searchQuery(keyset='', paged=False):
+    branch = _SEARCH_BRANCH.format(keyset=keyset, page=_SEARCH_BRANCH_PAGE if paged else '')
+    return _SEARCH_SQL.format(key=_SEARCH_KEY, branch=branch,
+                              limit='LIMIT %(limit)s' if paged else '')
+
+SEARCH_QUERY = _searchQuery()
+
+SEARCH_FIRST_PAGE_QUERY = _searchQuery(paged=True)
+
+# One page of results starting strictly after the given sort key
+SEARCH_PAGE_QUERY = _searchQuery(keyset=_SEARCH_KEYSET, paged=True)
+
+_KEYSET_PARAMS = [('k_sold', 'boolean'), ('k_date', 'date'), ('k_make', 'text'),
+                  ('k_model', 'text'), ('k_id', 'integer')]
+SEARCH_STATEMENT = statements.register('sag_search', SEARCH_QUERY, [('kw', 'text')])
+SEARCH_FIRST_PAGE_STATEMENT = statements.register(
+    'sag_search_first_page', SEARCH_FIRST_PAGE_QUERY, [('kw', 'text'), ('limit', 'bigint')])
+SEARCH_PAGE_STATEMENT = statements.register(
+    'sag_search_page', SEARCH_PAGE_QUERY, [('kw', 'text'), ('limit', 'bigint')] + _KEYSET_PARAMS)
+
+# Encode the sort key of a search row as an opaque, URL-safe page cursor
+def _encodeCursor(row):
+    key = [row[6], row[7].isoformat() if row[7] else None, row[1], row[2], row[0]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def _decodeCursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    isSold, saleDate, make, model, carsaleId = json.loads(base64.urlsafe_b64decode(padded))
+    return {'k_sold': bool(isSold), 'k_date': saleDate, 'k_make': make,
+            'k_model': model, 'k_id': int(carsaleId)}
 
 """
     Finds car sales based on the provided search string.
 
-    This method searches the database for car sales that match the provided search 
+    This method searches the database for car sales that match the provided search
     string. See assignment description for search specification
 
     :param search_string: The search string to use for finding car sales in the database.
     :return: A list of car sales matching the search string.
 """
+@operation
 def findCarSales(searchString):
-    conn = openConnection()
-    cursor = conn.cursor()
+    def load():
+        with readConnection() as conn, conn.cursor() as cursor:
+            statements.execute(cursor, SEARCH_STATEMENT, {'kw': f"%{searchString.lower()}%"})
+            rows = cursor.fetchall()
+        return list(map(CarSaleRecord, rows))
 
     try:
-        keyword = f"%{searchString.lower()}%"
+        return _cachedResult(('search', searchString.lower()), load)[0]
+    except Exception as e:
+        print("Car sales query error:", e)
+        return []
 
-        query = """
-        SELECT 
-            cs.CarSaleID,
-            cs.MakeCode,
-            cs.ModelCode,
-            cs.BuiltYear,
-            cs.Odometer,
-            cs.Price,
-            cs.IsSold,
-            TO_CHAR(cs.SaleDate, 'DD-MM-YYYY') AS SaleDate,
-            COALESCE(c.FirstName || ' ' || c.LastName, 'N/A') AS Buyer,
-            COALESCE(sp.FirstName || ' ' || sp.LastName, 'N/A') AS Salesperson
-        FROM CarSales cs
-        LEFT JOIN Customer c ON cs.BuyerID = c.CustomerID
-        LEFT JOIN Salesperson sp ON cs.SalespersonID = sp.Username
-        WHERE 
-            (
-                LOWER(cs.MakeCode) LIKE %s OR
-                LOWER(cs.ModelCode) LIKE %s OR
-                LOWER(COALESCE(c.FirstName || ' ' || c.LastName, '')) LIKE %s OR
-                LOWER(COALESCE(sp.FirstName || ' ' || sp.LastName, '')) LIKE %s
-            )
-            AND (
-                cs.IsSold = FALSE OR 
-                (cs.IsSold = TRUE AND cs.SaleDate >= CURRENT_DATE - INTERVAL '3 years')
-            )
-        ORDER BY 
-            cs.IsSold ASC, 
-            cs.SaleDate ASC NULLS FIRST,
-            cs.MakeCode ASC,
-            cs.ModelCode ASC;
-        """
+"""
+    Finds one page of car sales matching the search string.
 
-        cursor.execute(query, (keyword, keyword, keyword, keyword))
-        rows = cursor.fetchall()
+    Uses keyset pagination on the search ordering, so every page costs the same
+    however deep into the results it is. Pages come from the result cache,
+    keyed by the lower-cased search string, until CarSales next changes.
 
-        result = []
-        for row in rows:
-            result.append({
-                'carsale_id': row[0],
-                'make': row[1],
-                'model': row[2],
-                'builtYear': row[3],
-                'odometer': row[4],
-                'price': float(row[5]),
-                'isSold': 'True' if row[6] else 'False',
-                'sale_date': row[7],
-                'buyer': row[8],
-                'salesperson': row[9]
-            })
-
-        return result
+    :param searchString: The search string, as for findCarSales.
+    :param pageSize: Maximum number of car sales to return.
+    :param after: Cursor returned with the previous page, or None for the first page.
+    :param withFingerprint: Also return a fingerprint of the page (for ETags).
+    :return: (car sales, cursor for the next page or None on the last page),
+             plus the fingerprint when asked for.
+"""
+@operation
+def findCarSalesPage(searchString, pageSize=50, after=None, withFingerprint=False):
+    keyword = searchString.lower()
 
+    def load():
+        params = {'kw': f"%{keyword}%", 'limit': pageSize + 1}
+        if after:
+            params.update(_decodeCursor(after))
+            statement = SEARCH_PAGE_STATEMENT
+        else:
+            statement = SEARCH_FIRST_PAGE_STATEMENT
+
+        with readConnection() as conn, conn.cursor() as cursor:
+            statements.execute(cursor, statement, params)
+            rows = cursor.fetchall()
+
+        nextCursor = _encodeCursor(rows[pageSize - 1]) if len(rows) > pageSize else None
+        return list(map(CarSaleRecord, rows[:pageSize])), nextCursor
+
+    try:
+        (carsales, nextCursor), tag = _cachedResult(('page', keyword, pageSize, after or ''), load)
+    except (ValueError, TypeError) as e:
+        print("Invalid car sales page cursor:", e)
+        carsales, nextCursor, tag = [], None, None
     except Exception as e:
         print("Car sales query error:", e)
-        return []
+        carsales, nextCursor, tag = [], None, None
+    return (carsales, nextCursor, tag) if withFingerprint else (carsales, nextCursor)
 
-    finally:
-        cursor.close()
-        conn.close()
+"""
+    Streams every car sale matching the search string.
+
+    Rows are read through a server-side (named) cursor in batches of `batchSize`,
+    so memory stays flat however many rows match. The pooled connection is held
+    until the generator is exhausted or closed. A database error part way
+    through is logged and re-raised.
+"""
+@operation
+def iterCarSales(searchString, batchSize=2000):
+    keyword = f"%{searchString.lower()}%"
+    try:
+        with readConnection() as conn:
+            with conn.cursor(name='carsales_stream') as cursor:
+                cursor.itersize = batchSize
+                cursor.execute(SEARCH_QUERY, {'kw': keyword})
+                for row in cursor:
+                    yield CarSaleRecord(row)
+    except psycopg2.Error as e:
+        print("Car sales stream error:", e)
+        raise
+
+CAR_SALE_STATEMENT = statements.register('sag_car_sale', """
+SELECT
+    cs.CarSaleID,
+    cs.MakeCode,
+    cs.ModelCode,
+    cs.BuiltYear,
+    cs.Odometer,
+    cs.Price,
+    cs.IsSold,
+    cs.SaleDate,
+    COALESCE(c.FirstName || ' ' || c.LastName, 'N/A') AS Buyer,
+    COALESCE(sp.FirstName || ' ' || sp.LastName, 'N/A') AS Salesperson
+FROM CarSales cs
+LEFT JOIN Customer c ON cs.BuyerID = c.CustomerID
+LEFT JOIN Salesperson sp ON cs.SalespersonID = sp.UserName
+WHERE cs.CarSaleID = %(carsale_id)s
+""", [('carsale_id', 'integer')])
+
+"""
+    Fetches one car sale by its CarSaleID.
+
+    :param carsale_id: The CarSaleID (an int or numeric string).
+    :return: A CarSaleRecord, or None if there is no such car or the query failed.
+"""
+@operation
+def getCarSale(carsale_id):
+    try:
+        carsale_id = int(str(carsale_id).strip())
+    except ValueError:
+        return None
+    try:
+        with readConnection() as conn, conn.cursor() as cursor:
+            statements.execute(cursor, CAR_SALE_STATEMENT, {'carsale_id': carsale_id})
+            row = cursor.fetchone()
+    except Exception as e:
+        print("Car sale lookup error:", e)
+        return None
+    return CarSaleRecord(row) if row else None
+
+# CarSales.Price is NUMERIC(10,2) with a CHECK (Price > 0)
+PRICE_CENTS = Decimal('0.01')
+PRICE_LIMIT = 10 ** 8
+
+'''
+Check one car's intake values the way the database will store them. Returns
+((make, model, builtYear, odometer, price), None) with the numbers parsed and
+the price a Decimal rounded to cents, or (None, the reason it is rejected).
+'''
+def parseCarSale(make, model, builtYear, odometer, price, thisYear=None):
+    if thisYear is None:
+        thisYear = date.today().year
+    if not make or not model:
+        return None, "Make and model are required."
+    fields = [str(value).strip() for value in (builtYear, odometer, price)] \
+        if None not in (builtYear, odometer, price) else None
+    # Python accepts 1_000 but PostgreSQL (before 16) does not
+    if fields is None or any('_' in field for field in fields):
+        return None, "Price, built year and odometer must be numbers."
+    try:
+        builtYear = int(fields[0])
+        odometer = int(fields[1])
+        price = Decimal(fields[2])
+    except (ValueError, InvalidOperation):
+        return None, "Price, built year and odometer must be numbers."
+    if not price.is_finite():
+        return None, "Price must be a finite number."
+    if price <= 0:
+        return None, "Price must be positive."
+    if price >= PRICE_LIMIT:
+        return None, "Price is too large."
+    price = price.quantize(PRICE_CENTS, rounding=ROUND_HALF_UP)
+    if price <= 0:
+        return None, "Price must be at least 0.01."
+    if price >= PRICE_LIMIT:
+        return None, "Price is too large."
+    if builtYear > thisYear:
+        return None, "BuiltYear cannot be in the future."
+    if builtYear < 1950:
+        return None, "BuiltYear cannot be before 1950."
+    if odometer < 0:
+        return None, "Odometer cannot be negative."
+    if odometer > 2 ** 31 - 1:
+        return None, "Odometer is too large."
+    return (make, model, builtYear, odometer, price), None
+
+'''
+Check one car's intake values. Returns the reason it would be rejected, or None.
+'''
+def validateCarSale(make, model, builtYear, odometer, price, thisYear=None):
+    return parseCarSale(make, model, builtYear, odometer, price, thisYear)[1]
 
 """
     Adds a new car sale to the database.
 
-    This method accepts a CarSale object, which contains all the necessary details 
-    for a new car sale. It inserts the data into the database and returns a confirmation 
+    This method accepts a CarSale object, which contains all the necessary details
+    for a new car sale. It inserts the data into the database and returns a confirmation
     of the operation.
 
     :param car_sale: The CarSale object to be added to the database.
     :return: A boolean indicating if the operation was successful or not.
 """
+@operation
 def addCarSale(make, model, builtYear, odometer, price):
 
-    if float(price) <= 0:
-        print("[ERROR] Price must be positive.")
-        return False
-    if int(builtYear) > date.today().year:
-        print("[ERROR] BuiltYear cannot be in the future.")
+    values, reason = parseCarSale(make, model, builtYear, odometer, price)
+    if reason:
+        print("[ERROR] " + reason)
         return False
-    if int(odometer) < 0:
-        print("[ERROR] Odometer cannot be negative.")
-        return False
-
-    conn = openConnection()
-    cursor = conn.cursor()
 
     try:
         query = """
@@ -228,23 +816,188 @@ def addCarSale(make, model, builtYear, odometer, price):
             MakeCode, ModelCode, BuiltYear, Odometer, Price, IsSold
         ) VALUES (%s, %s, %s, %s, %s, FALSE)
         """
-        cursor.execute(query, (make, model, builtYear, odometer, price))
-        conn.commit()
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, values)
+            conn.commit()
+            markWrite()
 
-        # Call stored function to get brand-wise total sales
-        make_sales = getSalesByMake()
-        print(f"[DEBUG] Sales totals by brand:{make_sales}")
+            if DIAGNOSTICS:
+                # Call stored function on the same connection to get brand-wise total sales
+                make_sales = getSalesByMake(cursor)
+                print(f"[DEBUG] Sales totals by brand:{make_sales}")
 
         return True
 
     except Exception as e:
+        # The pool rolls back any uncommitted work when the connection is returned
         print("Database insert failed:", e)
-        conn.rollback()
         return False
 
-    finally:
-        cursor.close()
-        conn.close()
+# Rows sent to the server per INSERT statement in addCarSales
+BULK_INSERT_PAGE_SIZE = 1000
+
+"""
+    Adds many new cars for sale in a single transaction.
+
+    Every row is validated first (the same checks as addCarSale, plus make and
+    model codes that must exist); the valid rows are then inserted with
+    multi-row INSERT statements and committed together.
+
+    :param rows: Iterable of (make, model, builtYear, odometer, price) tuples.
+    :param numbers: Number reported for each row in rejections, e.g. its line
+                    in an uploaded file; by default rows are numbered from 1.
+    :return: (number of cars inserted, list of (row number, reason) rejections).
+"""
+@operation
+def addCarSales(rows, numbers=None):
+    rejected = []
+    try:
+        rows = list(rows)
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            # Fetch the code lists once instead of letting a bad foreign key abort the batch
+            cursor.execute("SELECT MakeCode FROM Make")
+            makes = {r[0] for r in cursor.fetchall()}
+            cursor.execute("SELECT ModelCode FROM Model")
+            models = {r[0] for r in cursor.fetchall()}
+
+            thisYear = date.today().year
+            valid = []
+            numbers = numbers if numbers is not None else itertools.count(1)
+            for number, (make, model, builtYear, odometer, price) in zip(numbers, rows):
+                values, reason = parseCarSale(make, model, builtYear, odometer, price, thisYear)
+                if reason is None and make not in makes:
+                    reason = f"Unknown make '{make}'."
+                if reason is None and model not in models:
+                    reason = f"Unknown model '{model}'."
+                if reason:
+                    rejected.append((number, reason))
+                else:
+                    valid.append(values)
+
+            if valid:
+                execute_values(cursor, """
+                    INSERT INTO CarSales (
+                        MakeCode, ModelCode, BuiltYear, Odometer, Price, IsSold
+                    ) VALUES %s
+                """, valid, template="(%s, %s, %s, %s, %s, FALSE)",
+                    page_size=BULK_INSERT_PAGE_SIZE)
+                conn.commit()
+                markWrite()
+
+        return len(valid), rejected
+
+    except Exception as e:
+        # Nothing from the batch is kept when the transaction fails
+        print("Bulk insert failed:", e)
+        return 0, rejected + [(None, "Database insert failed; no cars were added.")]
+
+#####################################################
+##  Name resolution
+#####################################################
+
+# Customer / salesperson full name -> ID, as resolved by updateCarSale
+NAME_CACHE_SIZE = int(os.environ.get('SAG_NAME_CACHE_SIZE', '4096'))
+NAME_CACHE_TTL = float(os.environ.get('SAG_NAME_CACHE_TTL', '300'))
+
+_nameCache = TTLCache(maxSize=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL)
+
+'''
+Forget cached name -> ID resolutions. Every worker calls it when notified
+that Customer or Salesperson changed; call it directly after such a change
+made with notifications off. With no arguments the whole cache is cleared.
+'''
+def invalidateNameCache(customer=None, salesperson=None):
+    if customer is None and salesperson is None:
+        _nameCache.clear()
+        return
+    if customer is not None:
+        _nameCache.invalidate(('customer', customer.lower()))
+    if salesperson is not None:
+        _nameCache.invalidate(('salesperson', salesperson.lower()))
+
+# Change notification (payload: table name): a customer or salesperson may have
+# been renamed or removed, by any worker or by psql
+def _onNamesChanged(channel, payload):
+    if payload in ('customer', 'salesperson'):
+        invalidateNameCache()
+
+# Cached ID for a lower-cased customer/salesperson name, or None. While the
+# listener is down a rename elsewhere could go unnoticed, so the cache is not read.
+def _cachedNameId(kind, key):
+    if RESULT_CACHE_LISTEN and not getListener().connected:
+        return None
+    return _nameCache.get((kind, key))
+
+# Accepts a date, a YYYY-MM-DD or DD-MM-YYYY string, or None
+def _parseSaleDate(saledate):
+    if isinstance(saledate, str):
+        try:
+            # Try ISO format: YYYY-MM-DD
+            saledate = datetime.strptime(saledate.strip(), "%Y-%m-%d").date()
+        except ValueError:
+            try:
+                # Try AU format: DD-MM-YYYY
+                saledate = datetime.strptime(saledate.strip(), "%d-%m-%Y").date()
+            except ValueError:
+                print(f"[ERROR] Unrecognized date format: {saledate}")
+                saledate = None
+    return saledate
+
+_SALE_PARAMS = [('customer_id', 'text'), ('salesperson_id', 'text'), ('saledate', 'date')]
+
+UPDATE_SALE_STATEMENT = statements.register('sag_update_sale', """
+UPDATE CarSales
+SET
+    IsSold = TRUE,
+    BuyerID = %(customer_id)s,
+    SalespersonID = %(salesperson_id)s,
+    SaleDate = %(saledate)s
+WHERE CarSaleID = %(carsaleid)s
+""", _SALE_PARAMS + [('carsaleid', 'integer')])
+
+# Resolves BuyerID and SalespersonID from the lower-cased full names, using the
+# expression indexes on the normalised names
+UPDATE_SALE_RESOLVING_STATEMENT = statements.register('sag_update_sale_resolving', """
+UPDATE CarSales cs
+SET
+    IsSold = TRUE,
+    BuyerID = c.CustomerID,
+    SalespersonID = sp.UserName,
+    SaleDate = %(saledate)s
+FROM
+    (SELECT CustomerID FROM Customer
+     WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %(customer)s
+     LIMIT 1) c,
+    (SELECT UserName FROM Salesperson
+     WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %(salesperson)s
+     LIMIT 1) sp
+WHERE cs.CarSaleID = %(carsaleid)s
+RETURNING c.CustomerID, sp.UserName
+""", [('saledate', 'date'), ('customer', 'text'), ('salesperson', 'text'), ('carsaleid', 'integer')])
+
+RESOLVE_NAMES_STATEMENT = statements.register('sag_resolve_names', """
+SELECT
+    (SELECT CustomerID FROM Customer
+     WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %(customer)s LIMIT 1),
+    (SELECT UserName FROM Salesperson
+     WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %(salesperson)s LIMIT 1)
+""", [('customer', 'text'), ('salesperson', 'text')])
+
+LOCK_SALES_STATEMENT = statements.register('sag_lock_sales', """
+SELECT CarSaleID, IsSold FROM CarSales
+WHERE CarSaleID = ANY(%(ids)s)
+FOR UPDATE
+""", [('ids', 'integer[]')])
+
+UPDATE_SALES_STATEMENT = statements.register('sag_update_sales', """
+UPDATE CarSales
+SET
+    IsSold = TRUE,
+    BuyerID = %(customer_id)s,
+    SalespersonID = %(salesperson_id)s,
+    SaleDate = %(saledate)s
+WHERE CarSaleID = ANY(%(ids)s) AND NOT IsSold
+""", _SALE_PARAMS + [('ids', 'integer[]')])
 
 """
     Updates an existing car sale in the database.
@@ -256,103 +1009,190 @@ def addCarSale(make, model, builtYear, odometer, price):
     :param car_sale: The CarSale object containing updated details for the car sale.
     :return: A boolean indicating whether the update was successful or not.
 """
+@operation
 def updateCarSale(carsaleid, customer, salesperson, saledate):
-    conn = openConnection()
-    cursor = conn.cursor()
+    saledate = _parseSaleDate(saledate)
+
+    # Add future date validation
+    if saledate and saledate > date.today():
+        print(f"[ERROR] 销售日期 {saledate} 是未来日期，更新被拒绝。")
+        return False
+
+    customerKey = customer.lower()
+    salespersonKey = salesperson.lower()
+    customer_id = _cachedNameId('customer', customerKey)
+    salesperson_id = _cachedNameId('salesperson', salespersonKey)
 
     try:
-        if isinstance(saledate, str):
-            try:
-                # Try ISO format: YYYY-MM-DD
-                saledate = datetime.strptime(saledate.strip(), "%Y-%m-%d").date()
-            except ValueError:
-                try:
-                    # Try AU format: DD-MM-YYYY
-                    saledate = datetime.strptime(saledate.strip(), "%d-%m-%Y").date()
-                except ValueError:
-                    print(f"[ERROR] Unrecognized date format: {saledate}")
-                    saledate = None
-        
-        # Add future date validation
-        if saledate and saledate > date.today():
-            print(f"[ERROR] 销售日期 {saledate} 是未来日期，更新被拒绝。")
-            return False
-
-        # Step 1: Find BuyerID
-        cursor.execute("""
-            SELECT CustomerID FROM Customer 
-            WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %s
-            LIMIT 1
-        """, (customer.lower(),))
-        cust_result = cursor.fetchone()
-
-        if not cust_result:
-            print(f"[ERROR] Customer '{customer}' not found.")
-            return False
-        customer_id = cust_result[0]
-
-        # Step 2: Find SalespersonID
-        cursor.execute("""
-            SELECT UserName FROM Salesperson 
-            WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %s
-            LIMIT 1
-        """, (salesperson.lower(),))
-        sales_result = cursor.fetchone()
-
-        if not sales_result:
-            print(f"[ERROR] Salesperson '{salesperson}' not found.")
-            return False
-        salesperson_id = sales_result[0]
-
-        # Step 3: Build SQL update query
-        if saledate:
-            query = """
-                UPDATE CarSales
-                SET 
-                    IsSold = TRUE,
-                    BuyerID = %s,
-                    SalespersonID = %s,
-                    SaleDate = %s
-                WHERE CarSaleID = %s
-            """
-            params = (customer_id, salesperson_id, saledate, carsaleid)
-        else:
-            query = """
-                UPDATE CarSales
-                SET 
-                    IsSold = TRUE,
-                    BuyerID = %s,
-                    SalespersonID = %s,
-                    SaleDate = NULL
-                WHERE CarSaleID = %s
-            """
-            params = (customer_id, salesperson_id, carsaleid)
-
-        cursor.execute(query, params)
-
-        if cursor.rowcount == 0:
-            print(f"[ERROR] No car found with CarSaleID = {carsaleid}.")
-            conn.rollback()
-            return False
-
-        conn.commit()
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            if customer_id is not None and salesperson_id is not None:
+                # Both names already resolved: a plain primary-key update
+                statements.execute(cursor, UPDATE_SALE_STATEMENT,
+                                   {'customer_id': customer_id, 'salesperson_id': salesperson_id,
+                                    'saledate': saledate, 'carsaleid': carsaleid})
+
+                if cursor.rowcount == 0:
+                    print(f"[ERROR] No car found with CarSaleID = {carsaleid}.")
+                    return False
+            else:
+                # Resolve BuyerID and SalespersonID inside the UPDATE itself
+                statements.execute(cursor, UPDATE_SALE_RESOLVING_STATEMENT,
+                                   {'saledate': saledate, 'customer': customerKey,
+                                    'salesperson': salespersonKey, 'carsaleid': carsaleid})
+                updated = cursor.fetchone()
+
+                if not updated:
+                    # Only on failure: work out which of the three lookups missed
+                    cursor.execute("""
+                        SELECT
+                            EXISTS (SELECT 1 FROM Customer
+                                    WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %s),
+                            EXISTS (SELECT 1 FROM Salesperson
+                                    WHERE LOWER(TRIM(FirstName || ' ' || LastName)) = %s)
+                    """, (customerKey, salespersonKey))
+                    customerFound, salespersonFound = cursor.fetchone()
+                    if not customerFound:
+                        print(f"[ERROR] Customer '{customer}' not found.")
+                    elif not salespersonFound:
+                        print(f"[ERROR] Salesperson '{salesperson}' not found.")
+                    else:
+                        print(f"[ERROR] No car found with CarSaleID = {carsaleid}.")
+                    return False
+
+                _nameCache.set(('customer', customerKey), updated[0])
+                _nameCache.set(('salesperson', salespersonKey), updated[1])
+
+            conn.commit()
+            markWrite()
         print("[INFO] Car sale record updated successfully.")
         return True
 
     except Exception as e:
+        # A cached ID may have gone stale (e.g. a deleted customer); resolve again next time
+        _nameCache.invalidate(('customer', customerKey))
+        _nameCache.invalidate(('salesperson', salespersonKey))
+        # The pool rolls back any uncommitted work when the connection is returned
         print("[EXCEPTION] Failed to update car sale:", e)
-        conn.rollback()
         return False
 
-    finally:
-        cursor.close()
-        conn.close()
+
+# Outcomes reported per CarSaleID by updateCarSales
+SALE_SOLD = 'sold'
+SALE_SKIPPED = 'skipped'
+SALE_NOT_FOUND = 'not found'
+SALE_ALREADY_SOLD = 'already sold'
+SALE_FUTURE_DATE = 'future date'
+SALE_DUPLICATE = 'duplicate'
+SALE_INVALID_ID = 'invalid id'
+
+"""
+    Marks many cars sold to one buyer by one salesperson, in one transaction.
+
+    The customer and salesperson are resolved once, the cars are locked and
+    checked, and every sellable car is updated by a single set-based UPDATE.
+
+    :param carsaleIds: CarSaleIDs to sell (ints or numeric strings).
+    :param customer: The buyer's full name.
+    :param salesperson: The salesperson's full name.
+    :param saledate: The sale date (date, YYYY-MM-DD or DD-MM-YYYY string, or None).
+    :param allOrNothing: When True (the default) nothing is updated unless every
+                         car can be sold; the sellable cars are then reported
+                         as 'skipped'. When False the sellable cars are sold
+                         and the rest are reported.
+    :return: (number of cars updated, [(carsale id, outcome)] in input order,
+             error message or None). Outcomes are the SALE_* values.
+"""
+@operation
+def updateCarSales(carsaleIds, customer, salesperson, saledate, allOrNothing=True):
+    saledate = _parseSaleDate(saledate)
+
+    results = []
+    ids = []
+    for raw in carsaleIds:
+        try:
+            carsaleId = int(str(raw).strip())
+        except ValueError:
+            results.append((raw, SALE_INVALID_ID))
+            continue
+        if carsaleId in ids:
+            results.append((carsaleId, SALE_DUPLICATE))
+            continue
+        ids.append(carsaleId)
+        results.append((carsaleId, None))
+
+    if saledate and saledate > date.today():
+        return 0, [(i, outcome or SALE_FUTURE_DATE) for i, outcome in results], \
+            f"Sale date {saledate} is in the future."
+    if not ids:
+        return 0, results, "No car sale IDs given."
+
+    customerKey = customer.lower()
+    salespersonKey = salesperson.lower()
+
+    try:
+        with pooledConnection() as conn, conn.cursor() as cursor:
+            customer_id = _cachedNameId('customer', customerKey)
+            salesperson_id = _cachedNameId('salesperson', salespersonKey)
+            if customer_id is None or salesperson_id is None:
+                statements.execute(cursor, RESOLVE_NAMES_STATEMENT,
+                                   {'customer': customerKey, 'salesperson': salespersonKey})
+                customer_id, salesperson_id = cursor.fetchone()
+                if customer_id is None or salesperson_id is None:
+                    skipped = [(i, outcome or SALE_SKIPPED) for i, outcome in results]
+                    if customer_id is None:
+                        return 0, skipped, f"Customer '{customer}' not found."
+                    return 0, skipped, f"Salesperson '{salesperson}' not found."
+                _nameCache.set(('customer', customerKey), customer_id)
+                _nameCache.set(('salesperson', salespersonKey), salesperson_id)
+
+            # Lock the cars so none is sold by someone else between the check and the update
+            statements.execute(cursor, LOCK_SALES_STATEMENT, {'ids': ids})
+            found = dict(cursor.fetchall())
+
+            sellable = [i for i in ids if found.get(i) is False]
+            outcomes = {i: SALE_NOT_FOUND if i not in found else
+                           SALE_ALREADY_SOLD if found[i] else None for i in ids}
+            # A repeated ID is only reported; unknown or unsellable cars fail the batch
+            failed = len(sellable) < len(ids) or any(o == SALE_INVALID_ID for _, o in results)
+
+            if sellable and not (failed and allOrNothing):
+                statements.execute(cursor, UPDATE_SALES_STATEMENT,
+                                   {'customer_id': customer_id, 'salesperson_id': salesperson_id,
+                                    'saledate': saledate, 'ids': sellable})
+                updated = cursor.rowcount
+                conn.commit()
+                markWrite()
+                status = SALE_SOLD
+            else:
+                updated = 0
+                status = SALE_SKIPPED
+
+        results = [(i, outcome or outcomes[i] or status) for i, outcome in results]
+        if failed:
+            return updated, results, ("No cars were updated." if updated == 0 else
+                                      "Some cars could not be sold.")
+        return updated, results, None
+
+    except Exception as e:
+        _nameCache.invalidate(('customer', customerKey))
+        _nameCache.invalidate(('salesperson', salespersonKey))
+        # The pool rolls back any uncommitted work when the connection is returned
+        print("[EXCEPTION] Failed to update car sales:", e)
+        return 0, [(i, outcome or SALE_SKIPPED) for i, outcome in results], \
+            "Database update failed; no cars were updated."
 
     
 # Call function 1: calculate total sales
-def getTotalSoldRevenue():
-    conn = openConnection()
-    cursor = conn.cursor()
+# Pass the caller's cursor to run inside its connection and transaction.
+@operation
+def getTotalSoldRevenue(cursor=None):
+    if cursor is None:
+        try:
+            with readConnection() as conn, conn.cursor() as cursor:
+                return getTotalSoldRevenue(cursor)
+        except PoolError as e:
+            print("Failed to call calculate_total_sales():", e)
+            return 0.0
     try:
         cursor.execute("SELECT calculate_total_sales();")
         result = cursor.fetchone()
@@ -360,14 +1200,18 @@ def getTotalSoldRevenue():
     except Exception as e:
         print("Failed to call calculate_total_sales():", e)
         return 0.0
-    finally:
-        cursor.close()
-        conn.close()
 
 # Call function 2: return total sales by brand
-def getSalesByMake():
-    conn = openConnection()
-    cursor = conn.cursor()
+# Pass the caller's cursor to run inside its connection and transaction.
+@operation
+def getSalesByMake(cursor=None):
+    if cursor is None:
+        try:
+            with readConnection() as conn, conn.cursor() as cursor:
+                return getSalesByMake(cursor)
+        except PoolError as e:
+            print("Failed to call get_sales_by_make():", e)
+            return []
     try:
         cursor.execute("SELECT * FROM get_sales_by_make();")
         rows = cursor.fetchall()
@@ -375,6 +1219,75 @@ def getSalesByMake():
     except Exception as e:
         print("Failed to call get_sales_by_make():", e)
         return []
-    finally:
-        cursor.close()
-        conn.close()
\ No newline at end of file
+
+#####################################################
+##  Sales analytics
+#####################################################
+
+ROLLUP_BUCKETS = ('day', 'week', 'month', 'quarter', 'year')
+ROLLUP_GROUPS = ('total', 'make', 'model', 'salesperson')
+
+"""
+    Units sold and revenue per time bucket and group, from the SalesDaily rollup.
+
+    :param dateFrom: First sale date included (a date).
+    :param dateTo: Last sale date included (a date).
+    :param bucket: One of ROLLUP_BUCKETS.
+    :param groupBy: One of ROLLUP_GROUPS.
+    :return: A list of {'period', 'key', 'units', 'revenue'} dicts ordered by
+             period then key, or None if the query failed.
+    :raises ValueError: For an unknown bucket or group, or dateFrom after dateTo.
+"""
+@operation
+def getSalesRollup(dateFrom, dateTo, bucket='day', groupBy='make'):
+    if bucket not in ROLLUP_BUCKETS:
+        raise ValueError("bucket must be one of: " + ", ".join(ROLLUP_BUCKETS))
+    if groupBy not in ROLLUP_GROUPS:
+        raise ValueError("group must be one of: " + ", ".join(ROLLUP_GROUPS))
+    if dateFrom > dateTo:
+        raise ValueError("from must not be after to")
+
+    def load():
+        with readConnection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT * FROM sales_rollup(%s, %s, %s, %s)",
+                           (dateFrom, dateTo, bucket, groupBy))
+            rows = cursor.fetchall()
+        return [{'period': row[0].isoformat(), 'key': row[1], 'units': row[2],
+                 'revenue': float(row[3])} for row in rows]
+
+    try:
+        return _cachedResult(('rollup', dateFrom, dateTo, bucket, groupBy), load)[0]
+    except Exception as e:
+        print("Failed to call sales_rollup():", e)
+        return None
+
+#####################################################
+##  Search autocomplete
+#####################################################
+
+AUTOCOMPLETE_QUERY = """
+SELECT MakeCode, MakeName, 'make' FROM Make
+UNION ALL
+SELECT ModelCode, ModelName, 'model' FROM Model
+UNION ALL
+SELECT DISTINCT FirstName || ' ' || LastName, FirstName || ' ' || LastName, 'customer' FROM Customer
+UNION ALL
+SELECT FirstName || ' ' || LastName, FirstName || ' ' || LastName, 'salesperson' FROM Salesperson
+"""
+
+"""
+    Everything the search box can match, for the autocomplete index.
+
+    :return: A list of (value, label, kind) tuples, where `value` is the text
+             findCarSales matches (make and model codes, full names) and
+             `label` is what to show, or None if the query failed.
+"""
+@operation
+def getSearchTerms():
+    try:
+        with readConnection() as conn, conn.cursor() as cursor:
+            cursor.execute(AUTOCOMPLETE_QUERY)
+            return cursor.fetchall()
+    except Exception as e:
+        print("Failed to load search terms:", e)
+        return None
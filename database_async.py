@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import threading
+import time
+
+import database
+import instrument
+from records import CarSaleRecord, SummaryRecord
+
+try:
+    import psycopg
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:     # optional: pip install "psycopg[binary]" psycopg_pool
+    psycopg = None
+    AsyncConnectionPool = None
+
+#####################################################
+##  Async data access
+#####################################################
+
+'''
+Asyncio counterpart of the read queries in database.py, built on psycopg 3
+and its AsyncConnectionPool.
+
+The pool and its connections live on one event loop per worker process, run
+in a background thread. Coroutines here can be awaited from any event loop
+(e.g. a Flask async view, which gets a fresh loop per request). The query is
+handed to the database loop, so independent queries run concurrently and one
+worker keeps many slow round trips in flight on a few connections.
+
+    summary, total = await database_async.gather(
+        database_async.getCarSalesSummary(),
+        database_async.getTotalSoldRevenue())
+'''
+
+ASYNC_POOL_MIN_SIZE = int(os.environ.get('SAG_ASYNC_POOL_MIN_SIZE', '1'))
+ASYNC_POOL_MAX_SIZE = int(os.environ.get('SAG_ASYNC_POOL_MAX_SIZE', '10'))
+
+_lock = threading.Lock()
+_loop = None
+_loopPid = None
+_pool = None
+
+
+def _runLoop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def _conninfo():
+    params = {k: v for k, v in database.connectionParams().items() if v}
+    return psycopg.conninfo.make_conninfo(**params)
+
+# Start this process's database event loop and pool on first use
+def _ensureLoop():
+    global _loop, _loopPid, _pool
+    if _loop is not None and _loopPid == os.getpid():
+        return _loop
+    with _lock:
+        if _loop is None or _loopPid != os.getpid():
+            if AsyncConnectionPool is None:
+                raise RuntimeError("The async data-access layer needs psycopg 3 and psycopg_pool")
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=_runLoop, args=(loop,), name='sag-async-db', daemon=True).start()
+
+            async def openPool():
+                pool = AsyncConnectionPool(_conninfo(), min_size=ASYNC_POOL_MIN_SIZE,
+                                           max_size=ASYNC_POOL_MAX_SIZE, open=False)
+                await pool.open()
+                return pool
+
+            _pool = asyncio.run_coroutine_threadsafe(openPool(), loop).result()
+            _loop = loop
+            _loopPid = os.getpid()
+    return _loop
+
+
+async def _submit(coro):
+    loop = _ensureLoop()
+    if asyncio.get_running_loop() is loop:
+        coro.close()
+        raise RuntimeError("database_async coroutines must not be awaited on the database loop")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    return await asyncio.wrap_future(future)
+
+'''
+Run independent queries concurrently and return their results in order
+'''
+async def gather(*coros):
+    return await asyncio.gather(*coros)
+
+'''
+Run a coroutine from synchronous code and wait for its result
+'''
+def run(coro):
+    return asyncio.run(coro)
+
+'''
+Close this process's async pool, e.g. on shutdown
+'''
+def close():
+    global _loop, _pool
+    with _lock:
+        if _loop is not None and _loopPid == os.getpid():
+            asyncio.run_coroutine_threadsafe(_pool.close(), _loop).result()
+            _loop.call_soon_threadsafe(_loop.stop)
+        _loop = None
+        _pool = None
+
+
+# Runs on the database loop; timings are tagged like the sync layer's
+async def _fetch(name, route, query, params=None, one=False):
+    started = time.perf_counter()
+    try:
+        async with _pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, params)
+                rows = await cursor.fetchone() if one else await cursor.fetchall()
+    except Exception:
+        instrument.recordQuery(time.perf_counter() - started, error=True,
+                               operationName=name, route=route)
+        raise
+    instrument.recordQuery(time.perf_counter() - started, 1 if one else len(rows),
+                           operationName=name, route=route)
+    return rows
+
+
+async def _query(name, query, params=None, one=False):
+    return await _submit(_fetch(name, instrument.currentRoute(), query, params, one))
+
+"""
+    Async getCarSalesSummary: the car sales summary rows.
+"""
+async def getCarSalesSummary():
+    try:
+        rows = await _query('getCarSalesSummary', database.SUMMARY_QUERY)
+        return list(map(SummaryRecord, rows))
+    except Exception as e:
+        print("Summary function error:", e)
+        return []
+
+"""
+    Async findCarSalesPage: one page of car sales matching the search string.
+
+    :return: (car sales, cursor for the next page or None on the last page).
+"""
+async def findCarSalesPage(searchString, pageSize=50, after=None):
+    try:
+        params = {'kw': f"%{searchString.lower()}%", 'limit': pageSize + 1}
+        if after:
+            params.update(database._decodeCursor(after))
+            query = database.SEARCH_PAGE_QUERY
+        else:
+            query = database.SEARCH_FIRST_PAGE_QUERY
+        rows = await _query('findCarSalesPage', query, params)
+        nextCursor = database._encodeCursor(rows[pageSize - 1]) if len(rows) > pageSize else None
+        return list(map(CarSaleRecord, rows[:pageSize])), nextCursor
+    except (ValueError, TypeError) as e:
+        print("Invalid car sales page cursor:", e)
+        return [], None
+    except Exception as e:
+        print("Car sales query error:", e)
+        return [], None
+
+# Async calculate_total_sales()
+async def getTotalSoldRevenue():
+    try:
+        result = await _query('getTotalSoldRevenue', "SELECT calculate_total_sales();", one=True)
+        return float(result[0]) if result else 0.0
+    except Exception as e:
+        print("Failed to call calculate_total_sales():", e)
+        return 0.0
+
+# Async get_sales_by_make()
+async def getSalesByMake():
+    try:
+        rows = await _query('getSalesByMake', "SELECT * FROM get_sales_by_make();")
+        return [{'make': row[0], 'total': float(row[1])} for row in rows]
+    except Exception as e:
+        print("Failed to call get_sales_by_make():", e)
+        return []
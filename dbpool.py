@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+#####################################################
+##  Connection Pool
+#####################################################
+
+'''
+Raised when a connection cannot be checked out of the pool, either because
+the pool is exhausted for longer than the checkout timeout or because a new
+connection could not be opened.
+'''
+class PoolError(psycopg2.Error):
+    pass
+
+'''
+The PoolError raised when every connection stays checked out for longer than
+the checkout timeout: the pool is busy, but the database may be healthy.
+'''
+class PoolTimeout(PoolError):
+    pass
+
+
+'''
+A thread-safe pool of reusable psycopg2 connections.
+
+Connections are created lazily by calling `connect()` and handed out with
+`getconn()` / `putconn()` or the `connection()` context manager. Idle
+connections are health-checked on checkout and recycled once they are older
+than `maxLifetime` seconds.
+'''
+class ConnectionPool:
+
+    def __init__(self, connect, minSize=1, maxSize=10, maxLifetime=1800.0,
+                 checkoutTimeout=10.0, healthCheckAfter=30.0):
+        if minSize < 0 or maxSize < 1 or minSize > maxSize:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (minSize, maxSize))
+
+        self._connect = connect
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.maxLifetime = maxLifetime
+        self.checkoutTimeout = checkoutTimeout
+        self.healthCheckAfter = healthCheckAfter
+
+        self._lock = threading.Condition()
+        self._idle = deque()        # (conn, returned_at), most recently used on the right
+        self._born = {}             # id(conn) -> created_at
+        self._inUse = set()
+        self._pending = 0           # connections currently being opened
+        self._closed = False
+
+        # Metrics
+        self._checkouts = 0
+        self._checkoutFailures = 0
+        self._waitTotal = 0.0
+        self._waitMax = 0.0
+        self._opened = 0
+        self._recycled = 0
+
+    # Open a new connection and register it; caller must hold a reserved slot
+    def _open(self):
+        conn = self._connect()
+        if conn is None:
+            raise PoolError("Could not open a database connection")
+        with self._lock:
+            self._born[id(conn)] = time.monotonic()
+            self._opened += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._born.pop(id(conn), None)
+            self._recycled += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _size(self):
+        return len(self._idle) + len(self._inUse) + self._pending
+
+    # Decide whether an idle connection can be handed out again
+    def _usable(self, conn, returnedAt):
+        if conn.closed:
+            return False
+        age = time.monotonic() - self._born.get(id(conn), 0.0)
+        if self.maxLifetime and age > self.maxLifetime:
+            return False
+        if time.monotonic() - returnedAt < self.healthCheckAfter:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    '''
+    Open connections until the pool holds at least `minSize` of them.
+    '''
+    def warm(self):
+        while True:
+            with self._lock:
+                if self._closed or self._size() >= self.minSize:
+                    return
+                self._pending += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self._lock:
+                    self._pending -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._pending -= 1
+                self._idle.append((conn, time.monotonic()))
+                self._lock.notify()
+
+    '''
+    Check a connection out of the pool, waiting up to `checkoutTimeout`
+    seconds for one to become free.
+    '''
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.checkoutTimeout
+        while True:
+            conn = None
+            reserve = False
+            with self._lock:
+                if self._closed:
+                    self._checkoutFailures += 1
+                    raise PoolError("Connection pool is closed")
+                while not self._idle and self._size() >= self.maxSize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._checkoutFailures += 1
+                        raise PoolTimeout("Timed out waiting for a database connection")
+                    self._lock.wait(remaining)
+                if self._idle:
+                    conn, returnedAt = self._idle.pop()
+                    self._inUse.add(conn)
+                else:
+                    # Hold a slot while the new connection is being opened
+                    self._pending += 1
+                    reserve = True
+
+            if reserve:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self._pending -= 1
+                        self._checkoutFailures += 1
+                        self._lock.notify()
+                    raise
+                with self._lock:
+                    self._pending -= 1
+                    self._inUse.add(conn)
+            elif not self._usable(conn, returnedAt):
+                with self._lock:
+                    self._inUse.discard(conn)
+                self._discard(conn)
+                continue
+
+            waited = time.monotonic() - started
+            with self._lock:
+                self._checkouts += 1
+                self._waitTotal += waited
+                self._waitMax = max(self._waitMax, waited)
+            return conn
+
+    '''
+    Return a connection to the pool. Any open transaction is rolled back;
+    broken or expired connections are closed instead of being kept.
+    '''
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._lock:
+            self._inUse.discard(conn)
+            age = time.monotonic() - self._born.get(id(conn), 0.0)
+            expired = bool(self.maxLifetime) and age > self.maxLifetime
+            keep = not (discard or conn.closed or expired or self._closed)
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+        if not keep:
+            self._discard(conn)
+
+    '''
+    Context manager that checks a connection out and always returns it.
+    A connection that raised a database error is discarded rather than reused.
+    '''
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken or bool(conn.closed))
+
+    '''
+    Close every idle connection and refuse further checkouts.
+    '''
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._lock.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    '''
+    Snapshot of the pool metrics.
+    '''
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size(),
+                'idle': len(self._idle),
+                'inUse': len(self._inUse),
+                'maxSize': self.maxSize,
+                'checkouts': self._checkouts,
+                'checkoutFailures': self._checkoutFailures,
+                'waitSecondsTotal': self._waitTotal,
+                'waitSecondsMax': self._waitMax,
+                'opened': self._opened,
+                'recycled': self._recycled,
+            }
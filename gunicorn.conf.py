@@ -0,0 +1,46 @@
+# Gunicorn settings for serving wsgi:app in production.
+# Every value can be overridden through the environment.
+import multiprocessing
+import os
+
+bind = os.environ.get('SAG_BIND', '0.0.0.0:5001')
+
+# Processes give CPU parallelism; threads overlap requests waiting on PostgreSQL
+workers = int(os.environ.get('SAG_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('SAG_THREADS', '4'))
+worker_class = 'gthread'
+
+# Each worker opens its own connection pool on first use, sized to its threads
+os.environ.setdefault('SAG_POOL_MAX_SIZE', str(threads))
+# Live update streams (changefeed.py) each hold a thread; allow half of them
+os.environ.setdefault('SAG_EVENT_STREAMS', str(max(1, threads // 2)))
+
+timeout = int(os.environ.get('SAG_TIMEOUT', '30'))
+graceful_timeout = 30
+keepalive = 5
+
+# Build the app once in the master: workers fork with routes imported and
+# templates compiled. Connections must not cross the fork, so the pool is
+# warmed in each worker instead (post_fork below).
+preload_app = True
+os.environ.setdefault('SAG_WARM_POOL', '0')
+
+# Recycle workers now and then to bound memory growth
+max_requests = 5000
+max_requests_jitter = 500
+
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    import time
+    import application
+    worker.sag_forked_at = time.perf_counter()
+    application.warmInBackground()
+
+
+def post_worker_init(worker):
+    import time
+    import application
+    application.reportStartup(time.perf_counter() - worker.sag_forked_at,
+                              label='Worker %s ready in' % worker.pid)
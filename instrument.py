@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+import contextvars
+import functools
+import inspect
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+import statements
+
+#####################################################
+##  Query instrumentation
+#####################################################
+
+# Queries slower than this are written to the slow-query log with their plan
+SLOW_QUERY_MS = float(os.environ.get('SAG_SLOW_QUERY_MS', '200'))
+# Slow-query log file; unset logs to stderr
+SLOW_QUERY_LOG = os.environ.get('SAG_SLOW_QUERY_LOG', '')
+# Capture EXPLAIN output for slow queries
+SLOW_QUERY_EXPLAIN = os.environ.get('SAG_SLOW_QUERY_EXPLAIN', '1') == '1'
+# Latency samples kept per (operation, route) for the percentiles
+SAMPLE_SIZE = 1024
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_route = contextvars.ContextVar('sag_route', default='none')
+_operation = contextvars.ContextVar('sag_operation', default='other')
+
+_EXECUTE = re.compile(r'^\s*EXECUTE\s+(\w+)', re.IGNORECASE)
+
+slowLog = logging.getLogger('sag.slowquery')
+if not slowLog.handlers:
+    _handler = logging.FileHandler(SLOW_QUERY_LOG) if SLOW_QUERY_LOG else logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slowLog.addHandler(_handler)
+    slowLog.setLevel(logging.INFO)
+    slowLog.propagate = False
+
+
+class _Series:
+    __slots__ = ('count', 'errors', 'rows', 'total', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+
+_lock = threading.Lock()
+_queries = {}       # (operation, route) -> _Series
+_acquires = {}      # route -> _Series
+_startup = []       # (phase, seconds) in the order they finished
+
+
+def _series(table, key):
+    series = table.get(key)
+    if series is None:
+        series = table[key] = _Series()
+    return series
+
+'''
+Tag the queries issued from now on in this context with a Flask route name
+'''
+def setRoute(name):
+    _route.set(name or 'none')
+
+def currentRoute():
+    return _route.get()
+
+'''
+Decorator naming the queries a database function issues, for the metrics
+'''
+def operation(fn):
+    name = fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def genWrapper(*args, **kwargs):
+            previous = _operation.get()
+            _operation.set(name)
+            try:
+                yield from fn(*args, **kwargs)
+            finally:
+                _operation.set(previous)
+        return genWrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _operation.set(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _operation.reset(token)
+    return wrapper
+
+
+def recordQuery(elapsed, rows=0, error=False, operationName=None, route=None):
+    key = (operationName or _operation.get(), route or _route.get())
+    with _lock:
+        series = _series(_queries, key)
+        series.count += 1
+        series.total += elapsed
+        series.samples.append(elapsed)
+        if error:
+            series.errors += 1
+        elif rows and rows > 0:
+            series.rows += rows
+
+
+def recordAcquire(elapsed, error=False):
+    with _lock:
+        series = _series(_acquires, _route.get())
+        series.count += 1
+        series.total += elapsed
+        series.samples.append(elapsed)
+        if error:
+            series.errors += 1
+
+
+'''
+Record how long one startup phase took (see application.py)
+'''
+def recordStartup(phase, seconds):
+    with _lock:
+        _startup.append((phase, seconds))
+
+def startupPhases():
+    with _lock:
+        return list(_startup)
+
+
+def _explain(cursor, query, vars):
+    statement = cursor.mogrify(query, vars).decode('utf-8', 'replace')
+    words = statement.split(None, 1)
+    # EXPLAIN EXECUTE shows the plan a prepared statement (statements.py) runs with
+    if not words or words[0].upper() not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'EXECUTE'):
+        return None
+    # A plain base-class cursor so the EXPLAIN itself is not instrumented, inside a
+    # savepoint so a failure cannot abort the caller's transaction
+    plain = extensions.cursor(cursor.connection)
+    inTransaction = not cursor.connection.autocommit
+    try:
+        if inTransaction:
+            plain.execute("SAVEPOINT sag_explain")
+        plain.execute("EXPLAIN " + statement)
+        plan = "\n".join(row[0] for row in plain.fetchall())
+        if inTransaction:
+            plain.execute("RELEASE SAVEPOINT sag_explain")
+        return plan
+    except psycopg2.Error as e:
+        if inTransaction:
+            plain.execute("ROLLBACK TO SAVEPOINT sag_explain")
+        return "EXPLAIN failed: {}".format(e)
+    finally:
+        plain.close()
+
+# The query as logged; an EXECUTE is followed by the prepared statement's name and SQL
+def _describe(query):
+    if not isinstance(query, str):
+        return query
+    text = query.strip()
+    match = _EXECUTE.match(text)
+    statement = statements.get(match.group(1)) if match else None
+    if statement is not None:
+        return "%s\n-- prepared statement %s:\n%s" % (text, statement.name, statement.sql.strip())
+    return text
+
+'''
+Cursor that times every execute(), counts rows and errors, and logs slow
+queries with their plan. Used as the cursor_factory of every connection.
+'''
+class InstrumentedCursor(extensions.cursor):
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            recordQuery(time.perf_counter() - started, error=True)
+            raise
+        elapsed = time.perf_counter() - started
+        recordQuery(elapsed, self.rowcount)
+
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            plan = None
+            # Named cursors only DECLARE here, so there is nothing useful to explain
+            if SLOW_QUERY_EXPLAIN and self.name is None:
+                plan = _explain(self, query, vars)
+            slowLog.info("slow query %.1fms operation=%s route=%s rows=%s\n%s%s",
+                         elapsed * 1000, _operation.get(), _route.get(), self.rowcount,
+                         _describe(query),
+                         "\n" + plan if plan else "")
+        return result
+
+
+def _quantile(ordered, q):
+    if not ordered:
+        return 0.0
+    # Nearest-rank percentile
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _summaryLines(name, table, labelsOf):
+    lines = []
+    for key, series in sorted(table.items()):
+        labels = labelsOf(key)
+        ordered = sorted(series.samples)
+        for q in QUANTILES:
+            lines.append('%s{%s,quantile="%s"} %.6f' % (name, labels, q, _quantile(ordered, q)))
+        lines.append('%s_sum{%s} %.6f' % (name, labels, series.total))
+        lines.append('%s_count{%s} %d' % (name, labels, series.count))
+    return lines
+
+'''
+Render the collected metrics in the Prometheus text exposition format.
+`poolStats` and `cacheStats` are the dicts from database.getPoolStats() and
+database.getResultCacheStats(), if available.
+'''
+def renderPrometheus(poolStats=None, cacheStats=None):
+    with _lock:
+        queries = dict(_queries)
+        acquires = dict(_acquires)
+
+        def queryLabels(key):
+            return 'operation="%s",route="%s"' % (_escape(key[0]), _escape(key[1]))
+
+        lines = ['# HELP sag_db_query_duration_seconds Query execution time per database operation and route.',
+                 '# TYPE sag_db_query_duration_seconds summary']
+        lines += _summaryLines('sag_db_query_duration_seconds', queries, queryLabels)
+
+        lines += ['# HELP sag_db_query_errors_total Queries that raised an error.',
+                  '# TYPE sag_db_query_errors_total counter']
+        lines += ['sag_db_query_errors_total{%s} %d' % (queryLabels(k), v.errors)
+                  for k, v in sorted(queries.items())]
+
+        lines += ['# HELP sag_db_query_rows_total Rows returned or affected.',
+                  '# TYPE sag_db_query_rows_total counter']
+        lines += ['sag_db_query_rows_total{%s} %d' % (queryLabels(k), v.rows)
+                  for k, v in sorted(queries.items())]
+
+        lines += ['# HELP sag_db_acquire_duration_seconds Time to check a connection out of the pool.',
+                  '# TYPE sag_db_acquire_duration_seconds summary']
+        lines += _summaryLines('sag_db_acquire_duration_seconds', acquires,
+                               lambda route: 'route="%s"' % _escape(route))
+        lines += ['# HELP sag_db_acquire_errors_total Failed connection checkouts.',
+                  '# TYPE sag_db_acquire_errors_total counter']
+        lines += ['sag_db_acquire_errors_total{route="%s"} %d' % (_escape(k), v.errors)
+                  for k, v in sorted(acquires.items())]
+
+    startup = startupPhases()
+    if startup:
+        lines += ['# HELP sag_startup_phase_seconds Time spent in each startup phase of this worker.',
+                  '# TYPE sag_startup_phase_seconds gauge']
+        lines += ['sag_startup_phase_seconds{phase="%s"} %.6f' % (_escape(phase), seconds)
+                  for phase, seconds in startup]
+
+    if poolStats:
+        for name, key, kind in (('sag_db_pool_size', 'size', 'gauge'),
+                                ('sag_db_pool_idle', 'idle', 'gauge'),
+                                ('sag_db_pool_in_use', 'inUse', 'gauge'),
+                                ('sag_db_pool_max_size', 'maxSize', 'gauge'),
+                                ('sag_db_pool_checkouts_total', 'checkouts', 'counter'),
+                                ('sag_db_pool_checkout_failures_total', 'checkoutFailures', 'counter'),
+                                ('sag_db_pool_wait_seconds_total', 'waitSecondsTotal', 'counter'),
+                                ('sag_db_pool_opened_total', 'opened', 'counter'),
+                                ('sag_db_pool_recycled_total', 'recycled', 'counter')):
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %s' % (name, poolStats[key]))
+
+    if cacheStats:
+        for name, key, kind in (('sag_result_cache_size', 'size', 'gauge'),
+                                ('sag_result_cache_hits_total', 'hits', 'counter'),
+                                ('sag_result_cache_misses_total', 'misses', 'counter'),
+                                ('sag_result_cache_invalidations_total', 'invalidations', 'counter'),
+                                ('sag_result_cache_listening', 'listening', 'gauge')):
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %d' % (name, cacheStats[key]))
+
+    return "\n".join(lines) + "\n"
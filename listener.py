@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import select
+import threading
+
+import psycopg2
+
+#####################################################
+##  LISTEN / NOTIFY
+#####################################################
+
+'''
+One background thread holding a dedicated connection that LISTENs on a set of
+PostgreSQL channels and calls the subscribed callbacks for each notification.
+
+`connect()` must return a new psycopg2 connection (or None on failure). When
+the connection is lost the thread reconnects every `retryAfter` seconds;
+because notifications sent while disconnected are lost, every callback in
+`onReconnect` is called once the channels are listened on again. `connected`
+is True only while notifications are actually being received.
+'''
+class ChangeListener:
+
+    def __init__(self, connect, retryAfter=5.0, pollTimeout=1.0):
+        self._connect = connect
+        self.retryAfter = retryAfter
+        self.pollTimeout = pollTimeout
+
+        self._lock = threading.Lock()
+        self._subscribers = {}      # channel -> [callback(channel, payload)]
+        self._listening = set()
+        self._reconnectCallbacks = []
+        self._thread = None
+        self._stopped = threading.Event()
+        self.connected = False
+        self.received = 0
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def onReconnect(self, callback):
+        with self._lock:
+            self._reconnectCallbacks.append(callback)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sag-listener', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _listenNew(self, conn):
+        with self._lock:
+            channels = [c for c in self._subscribers if c not in self._listening]
+        if channels:
+            with conn.cursor() as cursor:
+                for channel in channels:
+                    cursor.execute('LISTEN "{}"'.format(channel.replace('"', '""')))
+            self._listening.update(channels)
+
+    def _dispatch(self, notify):
+        self.received += 1
+        with self._lock:
+            callbacks = list(self._subscribers.get(notify.channel, ()))
+        for callback in callbacks:
+            try:
+                callback(notify.channel, notify.payload)
+            except Exception as e:
+                print("Notification handler error:", e)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            conn = self._connect()
+            if conn is None:
+                self._stopped.wait(self.retryAfter)
+                continue
+            try:
+                conn.autocommit = True
+                self._listening = set()
+                self._listenNew(conn)
+                with self._lock:
+                    callbacks = list(self._reconnectCallbacks)
+                for callback in callbacks:
+                    callback()
+                self.connected = True
+
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], self.pollTimeout) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self._dispatch(conn.notifies.pop(0))
+                    # Pick up channels subscribed after the thread started
+                    self._listenNew(conn)
+            except (psycopg2.Error, OSError) as e:
+                print("Notification listener lost its connection:", e)
+            finally:
+                self.connected = False
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            self._stopped.wait(self.retryAfter)
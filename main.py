@@ -1,4 +1,9 @@
-from routes import *
+import os
+from application import create_app
+
+# The development server may run without SAG_SECRET_KEY: sessions are then
+# signed with a random key, so restarting it logs everyone out
+app = create_app(randomSecret=True)
 
 # Starting the Python application
 if __name__ == '__main__':
@@ -11,4 +16,6 @@ if __name__ == '__main__':
              http://127.0.0.1:{}""".format(PORT_NUMBER))
     print("-"*70)
     # Note, you're going to have to change the PORT number
-    app.run(debug=True, host='0.0.0.0', port=PORT_NUMBER)
+    # This is the development server; use wsgi.py with gunicorn in production
+    debug = os.environ.get('SAG_DEBUG', '1') == '1'
+    app.run(debug=debug, host='0.0.0.0', port=PORT_NUMBER, threaded=True)
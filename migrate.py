@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import re
+
+import psycopg2
+
+import database
+
+#####################################################
+##  Schema migrations
+#####################################################
+
+'''
+Versioned schema migrations.
+
+SAGschema.sql is the baseline (version 1). Every later schema change is a
+file in migrations/ named NNNN_description.sql, applied in version order and
+recorded in the SchemaMigrations table, so an existing database is brought
+up to date without being dropped and recreated:
+
+    flask --app main migrate                    # apply pending migrations
+    flask --app main migrate --status
+    flask --app main migrate --with 0003        # also apply an optional one
+
+A migration runs in one transaction unless its first lines contain
+`-- migrate: no-transaction` (needed for CREATE INDEX CONCURRENTLY); its
+statements then run one at a time in autocommit mode and must be safe to
+re-run. An interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index
+behind, which IF NOT EXISTS would keep: the runner drops such an index before
+building it again and fails if the new build is not valid. Migrations marked `-- migrate: optional` are only applied when named
+with --with. An advisory lock keeps concurrent runs (e.g. several workers
+starting at once) from applying the same migration twice.
+'''
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SAGschema.sql')
+BASELINE_VERSION = 1
+
+# pg_advisory_lock key held while migrating
+LOCK_KEY = 9120001
+
+# What a database must already have to be adopted as the SAGschema.sql baseline.
+# Earlier copies of SAGschema.sql lacked these, and the app fails without them.
+BASELINE_RELATIONS = ['carsalessummary', 'carsalessummarylive', 'salesperson_usernamelower_idx',
+                      'carsales_makemodelsaledate_idx', 'carsales_modelcode_idx',
+                      'customer_fullname_trgm_idx', 'salesperson_fullname_trgm_idx',
+                      'customer_fullnamenorm_idx', 'salesperson_fullnamenorm_idx']
+BASELINE_FUNCTIONS = ['carsales_summary_apply', 'carsales_summary_trigger',
+                      'carsales_notify_changed', 'rebuild_carsales_summary',
+                      'verify_carsales_summary']
+BASELINE_TRIGGERS = ['carsales_summary_maintain', 'carsales_notify_changed', 'make_notify_changed',
+                     'model_notify_changed', 'customer_notify_changed', 'salesperson_notify_changed']
+
+_FILE_NAME = re.compile(r'^(\d{4})_(\w+)\.sql$')
+_DIRECTIVE = re.compile(r'^--\s*migrate:\s*([\w-]+)\s*$', re.MULTILINE)
+_CONCURRENT_INDEX = re.compile(
+    r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration:
+    __slots__ = ('version', 'name', 'path', 'sql', 'checksum', 'transactional', 'optional')
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        with open(path, encoding='utf-8') as f:
+            self.sql = f.read()
+        self.checksum = hashlib.sha1(self.sql.encode('utf-8')).hexdigest()
+        # Directives are only read from the header comment block
+        header = self.sql.split('\n\n', 1)[0]
+        directives = set(_DIRECTIVE.findall(header))
+        self.transactional = 'no-transaction' not in directives
+        self.optional = 'optional' in directives
+
+    @property
+    def label(self):
+        return '%04d_%s' % (self.version, self.name)
+
+
+'''
+Every known migration in version order, starting with the SAGschema.sql baseline
+'''
+def available():
+    migrations = [Migration(BASELINE_VERSION, 'baseline', BASELINE_PATH)]
+    for fileName in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = _FILE_NAME.match(fileName)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version <= BASELINE_VERSION or version == migrations[-1].version:
+            raise MigrationError("Duplicate or reserved migration version: " + fileName)
+        migrations.append(Migration(version, match.group(2), os.path.join(MIGRATIONS_DIR, fileName)))
+    return migrations
+
+
+def _ensureTable(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaMigrations (
+            Version INTEGER PRIMARY KEY,
+            Name TEXT NOT NULL,
+            Checksum TEXT NOT NULL,
+            AppliedAt TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+
+'''
+Version -> checksum of every migration recorded as applied
+'''
+def applied(cursor):
+    _ensureTable(cursor)
+    cursor.execute("SELECT Version, Checksum FROM SchemaMigrations ORDER BY Version")
+    return dict(cursor.fetchall())
+
+
+'''
+The baseline objects missing from an existing database, as "kind name" strings
+'''
+def missingBaselineObjects(cursor):
+    missing = []
+    for name in BASELINE_RELATIONS:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+        if not cursor.fetchone()[0]:
+            missing.append('relation ' + name)
+    for name in BASELINE_FUNCTIONS:
+        cursor.execute("SELECT to_regproc(%s) IS NOT NULL", (name,))
+        if not cursor.fetchone()[0]:
+            missing.append('function ' + name)
+    cursor.execute("SELECT LOWER(tgname) FROM pg_trigger WHERE NOT tgisinternal")
+    triggers = {row[0] for row in cursor.fetchall()}
+    missing += ['trigger ' + name for name in BASELINE_TRIGGERS if name not in triggers]
+    cursor.execute("""SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                      WHERE table_name = 'salesperson' AND column_name = 'passwordhash')""")
+    if not cursor.fetchone()[0]:
+        missing.append('column salesperson.passwordhash')
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    if not cursor.fetchone()[0]:
+        missing.append('extension pg_trgm')
+    return missing
+
+
+def _record(cursor, migration, checksum=None):
+    cursor.execute("INSERT INTO SchemaMigrations (Version, Name, Checksum) VALUES (%s, %s, %s)",
+                   (migration.version, migration.name, checksum or migration.checksum))
+
+# Split a script into statements, keeping quoted strings, $$ bodies and comments intact
+def _statements(sql):
+    statements, current = [], []
+    i, n = 0, len(sql)
+    quote = None
+    while i < n:
+        ch = sql[i]
+        if quote:
+            if sql.startswith(quote, i):
+                current.append(quote)
+                i += len(quote)
+                quote = None
+                continue
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = n if end < 0 else end
+            continue
+        elif ch == "'":
+            quote = "'"
+        elif ch == '$':
+            match = re.match(r'\$\w*\$', sql[i:])
+            if match:
+                quote = match.group(0)
+                current.append(quote)
+                i += len(quote)
+                continue
+        elif ch == ';':
+            statement = ''.join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+            i += 1
+            continue
+        current.append(ch)
+        i += 1
+    statement = ''.join(current).strip()
+    if statement:
+        statements.append(statement)
+    return statements
+
+
+# True/False for a valid/invalid index, None when there is no such index
+def _indexValid(cursor, name):
+    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _applyStatement(cursor, statement):
+    match = _CONCURRENT_INDEX.match(statement)
+    if match is None:
+        cursor.execute(statement)
+        return
+    name = match.group(1)
+    if _indexValid(cursor, name) is False:
+        print("[WARN] Dropping invalid index %s left by an interrupted build" % name)
+        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+    cursor.execute(statement)
+    if not _indexValid(cursor, name):
+        raise MigrationError("Index %s was not built; it is missing or INVALID" % name)
+
+
+def _apply(conn, migration):
+    if migration.transactional:
+        with conn.cursor() as cursor:
+            cursor.execute(migration.sql)
+            _record(cursor, migration)
+        conn.commit()
+        return
+
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for statement in _statements(migration.sql):
+                _applyStatement(cursor, statement)
+            _record(cursor, migration)
+    finally:
+        conn.autocommit = False
+
+'''
+Apply the pending migrations in version order. Optional migrations are only
+applied when their version is in `include`. Returns the migrations applied
+(or that would be applied, with dryRun).
+'''
+def migrate(conn=None, include=(), dryRun=False):
+    include = {int(v) for v in include}
+    ownConnection = conn is None
+    if ownConnection:
+        conn = database.openConnection()
+        if conn is None:
+            raise MigrationError("Could not connect to the database")
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        try:
+            with conn.cursor() as cursor:
+                done = applied(cursor)
+                if not done:
+                    # A database created by running SAGschema.sql directly is at the baseline
+                    cursor.execute("SELECT to_regclass('carsales') IS NOT NULL")
+                    if cursor.fetchone()[0]:
+                        # ... but only if it was created from the current SAGschema.sql
+                        missing = missingBaselineObjects(cursor)
+                        if missing:
+                            raise MigrationError(
+                                "The database predates the SAGschema.sql baseline and cannot be "
+                                "adopted; it is missing: " + ", ".join(missing) + ". Recreate it "
+                                "from SAGschema.sql (this drops the data) or add the missing "
+                                "objects by hand, then run migrate again.")
+                        _record(cursor, available()[0], checksum='adopted')
+                        done = {BASELINE_VERSION: 'adopted'}
+            conn.commit()
+
+            pending = []
+            for migration in available():
+                if migration.version in done:
+                    if done[migration.version] not in (migration.checksum, 'adopted'):
+                        print("[WARN] Migration %s changed after it was applied" % migration.label)
+                    continue
+                if migration.optional and migration.version not in include:
+                    continue
+                pending.append(migration)
+
+            if not dryRun:
+                for migration in pending:
+                    print("[INFO] Applying migration %s" % migration.label)
+                    try:
+                        _apply(conn, migration)
+                    except psycopg2.Error as e:
+                        conn.rollback()
+                        raise MigrationError("Migration %s failed: %s" % (migration.label, e.pgerror or e))
+            return pending
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+            conn.commit()
+    finally:
+        if ownConnection:
+            conn.close()
+
+'''
+(migration, applied?) for every known migration
+'''
+def status(conn=None):
+    ownConnection = conn is None
+    if ownConnection:
+        conn = database.openConnection()
+        if conn is None:
+            raise MigrationError("Could not connect to the database")
+    try:
+        with conn.cursor() as cursor:
+            done = applied(cursor)
+        conn.commit()
+        return [(migration, migration.version in done) for migration in available()]
+    finally:
+        if ownConnection:
+            conn.close()
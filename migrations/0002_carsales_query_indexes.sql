@@ -0,0 +1,37 @@
+-- migrate: no-transaction
+-- Indexes matched to the CarSales query shapes in database.py and the
+-- stored functions. Built CONCURRENTLY so a live database keeps taking sales.
+
+-- calculate_total_sales() / get_sales_by_make(): SUM(Price) over sold cars,
+-- grouped by make, answered from the index alone
+CREATE INDEX CONCURRENTLY IF NOT EXISTS CarSales_SoldMake_idx
+    ON CarSales (MakeCode) INCLUDE (Price) WHERE IsSold;
+
+-- findCarSales keeps "IsSold = FALSE OR (IsSold AND SaleDate >= CURRENT_DATE - 3 years)".
+-- Each half of that predicate gets its own partial index, so the planner can
+-- BitmapOr them instead of filtering every matched row.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS CarSales_Unsold_idx
+    ON CarSales (MakeCode, ModelCode) WHERE NOT IsSold;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS CarSales_SoldSaleDate_idx
+    ON CarSales (SaleDate) WHERE IsSold;
+
+-- The search ordering, so keyset pages (findCarSalesPage) read the next rows
+-- in index order instead of sorting every match
+CREATE INDEX CONCURRENTLY IF NOT EXISTS CarSales_SearchOrder_idx
+    ON CarSales (IsSold, (COALESCE(SaleDate, '-infinity'::date)), MakeCode, ModelCode, CarSaleID);
+
+-- Per-buyer and per-salesperson history in SaleDate order (read backwards for
+-- newest first). Unsold cars have no buyer or salesperson, so these partial
+-- indexes still serve every BuyerID = x / SalespersonID = x lookup, including
+-- the foreign key checks when a customer or salesperson is deleted.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS CarSales_BuyerSaleDate_idx
+    ON CarSales (BuyerID, SaleDate) WHERE BuyerID IS NOT NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS CarSales_SalespersonSaleDate_idx
+    ON CarSales (SalespersonID, SaleDate) WHERE SalespersonID IS NOT NULL;
+
+-- Superseded by the two partial indexes above. The rows they leave out have a
+-- NULL BuyerID/SalespersonID, which no equality lookup matches.
+DROP INDEX CONCURRENTLY IF EXISTS CarSales_BuyerID_idx;
+DROP INDEX CONCURRENTLY IF EXISTS CarSales_SalespersonID_idx;
+
+ANALYZE CarSales;
@@ -0,0 +1,171 @@
+-- migrate: optional
+-- Range-partition CarSales by SaleDate: one partition per sale year plus a
+-- default partition, which holds the unsold cars (SaleDate IS NULL). Old
+-- years can then be detached and archived without a bulk DELETE.
+-- Apply with: flask --app main migrate --with 0003
+-- The table is copied under an exclusive lock, so run it in a quiet period.
+
+-- A partitioned table's primary key has to include the partition key, and
+-- SaleDate is NULL for unsold cars, so CarSales cannot have a primary key on
+-- CarSaleID. The sequence still assigns the ids, and a trigger keeps each id in
+-- the unpartitioned CarSaleIDs table, whose primary key rejects a duplicate.
+--
+-- Selling a car moves its row out of the default partition, which PostgreSQL
+-- runs as a DELETE plus an INSERT: the row triggers see those rather than an
+-- UPDATE (see carsales_notify_row in 0005).
+
+LOCK TABLE CarSales IN ACCESS EXCLUSIVE MODE;
+
+-- Every trigger on CarSales now, including those added by later migrations,
+-- is recreated on the partitioned table below
+CREATE TEMP TABLE carsales_triggers ON COMMIT DROP AS
+SELECT pg_get_triggerdef(t.oid) AS definition
+FROM pg_trigger t
+WHERE t.tgrelid = 'carsales'::regclass AND NOT t.tgisinternal;
+
+DROP VIEW CarSalesSummaryLive;
+ALTER TABLE CarSales RENAME TO CarSales_unpartitioned;
+
+CREATE TABLE CarSales (
+  CarSaleID INTEGER NOT NULL DEFAULT nextval('carsales_carsaleid_seq'),
+  MakeCode VARCHAR(10) NOT NULL REFERENCES Make(MakeCode),
+  ModelCode VARCHAR(10) NOT NULL REFERENCES Model(ModelCode),
+  BuiltYear INTEGER NOT NULL CHECK (BuiltYear BETWEEN 1950 AND EXTRACT(YEAR FROM CURRENT_DATE)),
+  Odometer INTEGER NOT NULL,
+  Price Decimal(10,2) NOT NULL CHECK (Price > 0),
+  IsSold Boolean NOT NULL,
+  BuyerID VARCHAR(10) REFERENCES Customer,
+  SalespersonID VARCHAR(10) REFERENCES Salesperson,
+  SaleDate Date
+) PARTITION BY RANGE (SaleDate);
+
+ALTER SEQUENCE carsales_carsaleid_seq OWNED BY CarSales.CarSaleID;
+
+CREATE TABLE CarSales_default PARTITION OF CarSales DEFAULT;
+
+-- Add the partition for one sale year, moving any of that year's sales out of
+-- the default partition first. Run it for next year before the year starts.
+CREATE OR REPLACE FUNCTION create_carsales_partition(p_year INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    part TEXT := 'carsales_' || p_year;
+    low DATE := make_date(p_year, 1, 1);
+    high DATE := make_date(p_year + 1, 1, 1);
+    moved INTEGER;
+BEGIN
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE CarSales INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part);
+    EXECUTE format('WITH gone AS (DELETE FROM CarSales_default WHERE SaleDate >= %L AND SaleDate < %L RETURNING *)
+                    INSERT INTO %I SELECT * FROM gone', low, high, part);
+    GET DIAGNOSTICS moved = ROW_COUNT;
+    EXECUTE format('ALTER TABLE CarSales ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', part, low, high);
+    IF moved > 0 THEN
+        -- The DELETE above took the moved cars out of CarSaleIDs, the summary and
+        -- the daily rollup (migration 0004); put them back
+        EXECUTE format('INSERT INTO CarSaleIDs SELECT CarSaleID FROM %I', part);
+        EXECUTE format('SELECT carsales_summary_apply(MakeCode, ModelCode, 1, Price, IsSold, SaleDate) FROM %I', part);
+        IF to_regproc('sales_daily_apply') IS NOT NULL THEN
+            EXECUTE format('SELECT sales_daily_apply(SaleDate, MakeCode, ModelCode, SalespersonID, 1, Price)
+                            FROM %I WHERE IsSold AND SaleDate IS NOT NULL', part);
+        END IF;
+        PERFORM pg_notify('sag_carsales_changed', 'carsales');
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Detach every yearly partition before p_year. The detached tables keep their
+-- rows (archive or drop them); the summary is rebuilt without them. Their ids
+-- stay in CarSaleIDs, so they are never reused.
+CREATE OR REPLACE FUNCTION detach_carsales_partitions_before(p_year INTEGER)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    part RECORD;
+BEGIN
+    FOR part IN
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'carsales'::regclass
+          AND c.relname ~ '^carsales_[0-9]{4}$'
+          AND substring(c.relname FROM 10)::INTEGER < p_year
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE CarSales DETACH PARTITION %I', part.relname);
+        RETURN NEXT part.relname;
+    END LOOP;
+    PERFORM rebuild_carsales_summary();
+    PERFORM pg_notify('sag_carsales_changed', 'carsales');
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_carsales_partition(y)
+FROM generate_series(
+    (SELECT COALESCE(EXTRACT(YEAR FROM MIN(SaleDate)), EXTRACT(YEAR FROM CURRENT_DATE))::INTEGER
+     FROM CarSales_unpartitioned),
+    EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER + 1) AS y;
+
+-- The triggers are recreated after the copy: the summary and rollups already count these rows
+INSERT INTO CarSales SELECT * FROM CarSales_unpartitioned;
+DROP TABLE CarSales_unpartitioned;
+
+DO $$
+DECLARE
+    definition TEXT;
+BEGIN
+    FOR definition IN SELECT t.definition FROM carsales_triggers t LOOP
+        EXECUTE definition;
+    END LOOP;
+END;
+$$;
+
+CREATE TABLE CarSaleIDs (
+  CarSaleID INTEGER PRIMARY KEY
+);
+INSERT INTO CarSaleIDs SELECT CarSaleID FROM CarSales;
+
+CREATE OR REPLACE FUNCTION carsales_id_maintain()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO CarSaleIDs VALUES (NEW.CarSaleID);
+    ELSIF TG_OP = 'DELETE' THEN
+        DELETE FROM CarSaleIDs WHERE CarSaleID = OLD.CarSaleID;
+    ELSIF NEW.CarSaleID <> OLD.CarSaleID THEN
+        UPDATE CarSaleIDs SET CarSaleID = NEW.CarSaleID WHERE CarSaleID = OLD.CarSaleID;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A sale that moves a row fires DELETE then INSERT, which remove and re-add its id
+CREATE TRIGGER carsales_id_maintain
+AFTER INSERT OR UPDATE OR DELETE ON CarSales
+FOR EACH ROW EXECUTE FUNCTION carsales_id_maintain();
+
+CREATE VIEW CarSalesSummaryLive AS
+SELECT
+    cs.MakeCode,
+    cs.ModelCode,
+    (COUNT(*) FILTER (WHERE cs.IsSold = FALSE))::INTEGER AS AvailableUnits,
+    (COUNT(*) FILTER (WHERE cs.IsSold = TRUE))::INTEGER AS SoldUnits,
+    COALESCE(SUM(cs.Price), 0) AS AllPrices,
+    COALESCE(SUM(cs.Price) FILTER (WHERE cs.IsSold = TRUE), 0) AS SoldPrices,
+    MAX(cs.SaleDate) AS LastSaleDate
+FROM CarSales cs
+GROUP BY cs.MakeCode, cs.ModelCode;
+
+-- The indexes of SAGschema.sql and 0002, created on every partition
+CREATE INDEX CarSales_CarSaleID_idx ON CarSales (CarSaleID);
+CREATE INDEX CarSales_MakeModelSaleDate_idx ON CarSales (MakeCode, ModelCode, SaleDate);
+CREATE INDEX CarSales_ModelCode_idx ON CarSales (ModelCode);
+CREATE INDEX CarSales_SoldMake_idx ON CarSales (MakeCode) INCLUDE (Price) WHERE IsSold;
+CREATE INDEX CarSales_Unsold_idx ON CarSales (MakeCode, ModelCode) WHERE NOT IsSold;
+CREATE INDEX CarSales_SoldSaleDate_idx ON CarSales (SaleDate) WHERE IsSold;
+CREATE INDEX CarSales_SearchOrder_idx
+    ON CarSales (IsSold, (COALESCE(SaleDate, '-infinity'::date)), MakeCode, ModelCode, CarSaleID);
+CREATE INDEX CarSales_BuyerSaleDate_idx ON CarSales (BuyerID, SaleDate) WHERE BuyerID IS NOT NULL;
+CREATE INDEX CarSales_SalespersonSaleDate_idx
+    ON CarSales (SalespersonID, SaleDate) WHERE SalespersonID IS NOT NULL;
+
+ANALYZE CarSales;
@@ -0,0 +1,122 @@
+-- Daily sales rollup for the analytics API (/api/sales).
+-- One row per sale date, make, model and salesperson, kept current by a
+-- trigger as cars are sold, so date-range reports read a few rollup rows
+-- instead of scanning CarSales. Sold cars without a SaleDate are not in it.
+
+CREATE TABLE SalesDaily (
+    SaleDate DATE NOT NULL,
+    MakeCode VARCHAR(10) NOT NULL,
+    ModelCode VARCHAR(10) NOT NULL,
+    -- '' when the sale has no salesperson
+    SalespersonID VARCHAR(10) NOT NULL,
+    Units INTEGER NOT NULL,
+    Revenue NUMERIC(14,2) NOT NULL,
+    PRIMARY KEY (SaleDate, MakeCode, ModelCode, SalespersonID)
+);
+
+-- Add (p_sign = 1) or remove (p_sign = -1) one sale from its rollup row
+CREATE OR REPLACE FUNCTION sales_daily_apply(
+    p_date DATE, p_make VARCHAR, p_model VARCHAR, p_salesperson VARCHAR,
+    p_sign INTEGER, p_price NUMERIC)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO SalesDaily AS d (SaleDate, MakeCode, ModelCode, SalespersonID, Units, Revenue)
+    VALUES (p_date, p_make, p_model, COALESCE(p_salesperson, ''), p_sign, p_sign * p_price)
+    ON CONFLICT (SaleDate, MakeCode, ModelCode, SalespersonID) DO UPDATE SET
+        Units = d.Units + EXCLUDED.Units,
+        Revenue = d.Revenue + EXCLUDED.Revenue;
+
+    DELETE FROM SalesDaily
+    WHERE SaleDate = p_date AND MakeCode = p_make AND ModelCode = p_model
+      AND SalespersonID = COALESCE(p_salesperson, '') AND Units = 0;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Handles each operation on its own, so it stays correct on a partitioned
+-- CarSales (migration 0003), where a sale that moves a row out of the default
+-- partition arrives as a DELETE of the old row and an INSERT of the new one.
+CREATE OR REPLACE FUNCTION sales_daily_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.IsSold AND OLD.SaleDate IS NOT NULL THEN
+        PERFORM sales_daily_apply(OLD.SaleDate, OLD.MakeCode, OLD.ModelCode,
+                                  OLD.SalespersonID, -1, OLD.Price);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.IsSold AND NEW.SaleDate IS NOT NULL THEN
+        PERFORM sales_daily_apply(NEW.SaleDate, NEW.MakeCode, NEW.ModelCode,
+                                  NEW.SalespersonID, 1, NEW.Price);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER sales_daily_maintain
+AFTER INSERT OR UPDATE OR DELETE ON CarSales
+FOR EACH ROW EXECUTE FUNCTION sales_daily_trigger();
+
+-- Rebuild the rollup from scratch (e.g. after a bulk load with triggers off)
+CREATE OR REPLACE FUNCTION rebuild_sales_daily()
+RETURNS INTEGER AS $$
+DECLARE
+    n INTEGER;
+BEGIN
+    LOCK TABLE CarSales IN SHARE MODE;
+    DELETE FROM SalesDaily;
+    INSERT INTO SalesDaily (SaleDate, MakeCode, ModelCode, SalespersonID, Units, Revenue)
+    SELECT SaleDate, MakeCode, ModelCode, COALESCE(SalespersonID, ''), COUNT(*), SUM(Price)
+    FROM CarSales
+    WHERE IsSold AND SaleDate IS NOT NULL
+    GROUP BY SaleDate, MakeCode, ModelCode, COALESCE(SalespersonID, '');
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_sales_daily();
+
+-- Units and revenue per time bucket and group over [p_from, p_to].
+-- p_bucket: day, week, month, quarter or year (weeks start on Monday).
+-- p_group: total, make, model or salesperson.
+CREATE OR REPLACE FUNCTION sales_rollup(
+    p_from DATE, p_to DATE, p_bucket TEXT, p_group TEXT)
+RETURNS TABLE (Period DATE, GroupKey VARCHAR, Units BIGINT, Revenue NUMERIC) AS $$
+BEGIN
+    IF p_bucket NOT IN ('day', 'week', 'month', 'quarter', 'year') THEN
+        RAISE EXCEPTION 'invalid bucket: %', p_bucket USING ERRCODE = '22023';
+    END IF;
+    IF p_group NOT IN ('total', 'make', 'model', 'salesperson') THEN
+        RAISE EXCEPTION 'invalid group: %', p_group USING ERRCODE = '22023';
+    END IF;
+
+    RETURN QUERY
+    SELECT
+        date_trunc(p_bucket, d.SaleDate::TIMESTAMP)::DATE,
+        (CASE p_group
+            WHEN 'make' THEN d.MakeCode
+            WHEN 'model' THEN d.ModelCode
+            WHEN 'salesperson' THEN d.SalespersonID
+            ELSE 'total'
+        END)::VARCHAR,
+        SUM(d.Units)::BIGINT,
+        SUM(d.Revenue)
+    FROM SalesDaily d
+    WHERE d.SaleDate BETWEEN p_from AND p_to
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- The all-time totals are exact in CarSalesSummary, which is a few rows per
+-- make/model, so answer from it instead of summing every sold car
+CREATE OR REPLACE FUNCTION calculate_total_sales()
+RETURNS NUMERIC AS $$
+    SELECT COALESCE(SUM(SoldPrices), 0) FROM CarSalesSummary;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION get_sales_by_make()
+RETURNS TABLE (MakeCode VARCHAR, TotalSales NUMERIC) AS $$
+    SELECT s.MakeCode, SUM(s.SoldPrices)
+    FROM CarSalesSummary s
+    GROUP BY s.MakeCode
+    HAVING SUM(s.SoldUnits) > 0;
+$$ LANGUAGE sql STABLE;
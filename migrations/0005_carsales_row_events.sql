@@ -0,0 +1,71 @@
+-- Row-level change events for the live inventory feed (/events/carsales).
+-- Each car added and each sale recorded sends one JSON notification on the
+-- sag_carsales_events channel, which the web workers fan out to browsers so
+-- the summary and car sales pages update without reloading. Notifications
+-- are delivered on commit; rolled back changes send nothing.
+--
+-- The statement-level sag_carsales_changed notifications (cache invalidation)
+-- are unchanged. Bulk loads that disable the CarSales triggers send no row
+-- events; benchmarks/synthetic.py notifies sag_carsales_changed instead.
+--
+-- On a partitioned CarSales (migration 0003) selling a car moves its row to
+-- another partition, which fires the row triggers as a DELETE followed by an
+-- INSERT rather than an UPDATE. The DELETE remembers the old row in the
+-- transaction-local sag.carsale_moved setting, and the INSERT of the same
+-- CarSaleID is then reported as the sale it is.
+
+-- Event ids: every worker receives the same notification, so a browser can
+-- resume from its last event id on whichever worker it reconnects to
+CREATE SEQUENCE carsales_event_seq;
+
+CREATE OR REPLACE FUNCTION carsales_notify_row()
+RETURNS TRIGGER AS $$
+DECLARE
+    payload JSON;
+    moved JSON;
+    was_sold BOOLEAN;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM set_config('sag.carsale_moved',
+                           json_build_object('id', OLD.CarSaleID, 'sold', OLD.IsSold)::TEXT, true);
+        RETURN NULL;
+    ELSIF TG_OP = 'UPDATE' THEN
+        was_sold := OLD.IsSold;
+    ELSE
+        moved := NULLIF(current_setting('sag.carsale_moved', true), '')::JSON;
+        IF moved IS NOT NULL AND (moved->>'id')::INTEGER = NEW.CarSaleID THEN
+            PERFORM set_config('sag.carsale_moved', '', true);
+            was_sold := (moved->>'sold')::BOOLEAN;
+        END IF;
+    END IF;
+
+    IF was_sold IS NULL THEN
+        payload := json_build_object(
+            'event_id', nextval('carsales_event_seq'), 'op', 'insert', 'id', NEW.CarSaleID,
+            'make', NEW.MakeCode, 'model', NEW.ModelCode,
+            'year', NEW.BuiltYear, 'odometer', NEW.Odometer, 'price', NEW.Price,
+            'sold', NEW.IsSold, 'sale_date', NEW.SaleDate);
+    -- A moved row always has a new SaleDate, so it is a sale whenever it is sold
+    ELSIF NEW.IsSold AND (TG_OP = 'INSERT' OR NOT OLD.IsSold
+                          OR NEW.SaleDate IS DISTINCT FROM OLD.SaleDate
+                          OR NEW.BuyerID IS DISTINCT FROM OLD.BuyerID
+                          OR NEW.SalespersonID IS DISTINCT FROM OLD.SalespersonID) THEN
+        payload := json_build_object(
+            'event_id', nextval('carsales_event_seq'), 'op', 'sale', 'id', NEW.CarSaleID,
+            'make', NEW.MakeCode, 'model', NEW.ModelCode, 'price', NEW.Price,
+            'was_sold', was_sold, 'sale_date', NEW.SaleDate,
+            'buyer', (SELECT FirstName || ' ' || LastName FROM Customer
+                      WHERE CustomerID = NEW.BuyerID),
+            'salesperson', (SELECT FirstName || ' ' || LastName FROM Salesperson
+                            WHERE UserName = NEW.SalespersonID));
+    ELSE
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify('sag_carsales_events', payload::TEXT);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER carsales_notify_row
+AFTER INSERT OR UPDATE OR DELETE ON CarSales
+FOR EACH ROW EXECUTE FUNCTION carsales_notify_row();
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+from operator import itemgetter
+
+#####################################################
+##  Row records
+#####################################################
+
+'''
+Compact, read-only records for query results.
+
+A record is a tuple subclass with no per-instance __dict__, built straight
+from the tuple psycopg2 returns, so a row costs about as much memory as the
+row itself instead of a dict plus converted values. Raw columns are read
+through C-level itemgetters; conversions (Decimal to float, formatting
+dates) run only when a template or export actually reads the field.
+
+Records still index and compare like the original row tuple. Use asDict()
+where a real dict is needed (JSON, csv.DictWriter).
+'''
+class Record(tuple):
+    __slots__ = ()
+
+    # Field names in asDict() order
+    _fields = ()
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in self._fields else default
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (name, getattr(self, name)) for name in self._fields))
+
+
+def _column(index):
+    return property(itemgetter(index))
+
+
+def _formatDate(value):
+    return value.strftime('%d-%m-%Y') if value is not None else None
+
+'''
+A row of database.SEARCH_QUERY and its paged variants
+'''
+class CarSaleRecord(Record):
+    __slots__ = ()
+    _fields = ('carsale_id', 'make', 'model', 'builtYear', 'odometer', 'price',
+               'isSold', 'sale_date', 'buyer', 'salesperson')
+
+    carsale_id = _column(0)
+    make = _column(1)
+    model = _column(2)
+    builtYear = _column(3)
+    odometer = _column(4)
+    buyer = _column(8)
+    salesperson = _column(9)
+
+    @property
+    def price(self):
+        return float(self[5])
+
+    @property
+    def isSold(self):
+        return 'True' if self[6] else 'False'
+
+    @property
+    def sale_date(self):
+        return _formatDate(self[7])
+
+'''
+A row of database.SUMMARY_QUERY
+'''
+class SummaryRecord(Record):
+    __slots__ = ()
+    _fields = ('make', 'model', 'availableUnits', 'soldUnits', 'totalPrices',
+               'soldTotalPrices', 'lastPurchaseAt')
+
+    make = _column(0)
+    model = _column(1)
+    availableUnits = _column(2)
+    soldUnits = _column(3)
+
+    @property
+    def totalPrices(self):
+        return float(self[4])
+
+    @property
+    def soldTotalPrices(self):
+        return float(self[5])
+
+    @property
+    def lastPurchaseAt(self):
+        return _formatDate(self[6]) or 'N/A'
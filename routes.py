@@ -1,15 +1,135 @@
 # Importing the frameworks
 from flask import *
-from datetime import datetime
+from datetime import datetime, timedelta
+import csv
+import glob
+import hashlib
+import hmac
+import io
+import json
+import os
+import click
+import assets
+import credentials
 import database
+import instrument
 
-user_details = {}
-session = {}
-page = {}
+# Car sales shown per page on /list_carsales
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 
 # Initialise the application
+# Per-user state (login, user details, flash messages) lives in Flask's signed
+# cookie session, so any worker process or thread can serve any request.
+# Every worker must share the same secret key; application.create_app()
+# refuses to start without one.
 app = Flask(__name__)
-app.secret_key = 'aab12124d346928d14710610f'
+app.secret_key = os.environ.get('SAG_SECRET_KEY') or None
+
+
+def current_user():
+    return session.get('user', {})
+
+
+# Tag every database query issued while handling a request with its route
+@app.before_request
+def tag_request_queries():
+    instrument.setRoute(request.endpoint)
+
+# Read-your-writes: after a user's own write their reads go to the primary for a
+# few seconds. The deadline travels in the session so any worker honours it.
+# Static files never read the session, so they are not marked Vary: Cookie
+SESSIONLESS_ENDPOINTS = ('static', 'asset')
+
+@app.before_request
+def restore_read_your_writes():
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return
+    database.setPrimaryUntil(session.get('primary_until', 0.0))
+
+@app.after_request
+def save_read_your_writes(response):
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return response
+    until = database.getPrimaryUntil()
+    if until > session.get('primary_until', 0.0):
+        session['primary_until'] = until
+    return response
+
+
+#####################################################
+##  Conditional GET
+#####################################################
+
+# Changes whenever a template does, so a deploy invalidates browsers' copies
+def template_fingerprint():
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(app.root_path, 'templates', '*.html'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+TEMPLATE_FINGERPRINT = template_fingerprint()
+
+# ETag for a page rendered from a cached database result. It covers the result
+# fingerprint, the templates, the user and the query string, so it is the same
+# in every worker. Pages with pending flash messages are never tagged.
+def page_etag(fingerprint):
+    if fingerprint is None or request.method != 'GET' or '_flashes' in session:
+        return None
+    key = '|'.join([request.endpoint, request.query_string.decode('latin-1'),
+                    current_user().get('login', ''), fingerprint, TEMPLATE_FINGERPRINT,
+                    assets.version()])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def tagged_response(etag, render):
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    if etag is not None:
+        response.set_etag(etag)
+        # Browsers may keep the page but must revalidate it on every visit
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    return response
+
+
+#####################################################
+##  Static assets
+#####################################################
+
+# Hashed bundle files never change, so browsers may keep them for a year without revalidating
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# URLs to link for a bundle in assets.BUNDLES: its hashed build, or the
+# source files when it has not been built
+@app.template_global()
+def asset_urls(name):
+    file_name = assets.bundleFile(name)
+    if file_name:
+        return [url_for('asset', filename=file_name)]
+    return [url_for('static', filename=source) for source in assets.BUNDLES[name]]
+
+# Serves the brotli or gzip build when the browser accepts it
+@app.route('/assets/<filename>')
+def asset(filename):
+    if not assets.isBundleFile(filename):
+        abort(404)
+    mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+    encoding, suffix = None, ''
+    for name, candidate in assets.ENCODINGS:
+        if request.accept_encodings[name] and \
+                os.path.isfile(os.path.join(assets.DIST_DIR, filename + candidate)):
+            encoding, suffix = name, candidate
+            break
+    response = send_from_directory(assets.DIST_DIR, filename + suffix, mimetype=mimetype,
+                                   max_age=ASSET_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % ASSET_MAX_AGE
+    return response
 
 
 #####################################################
@@ -21,11 +141,10 @@ def index():
     # Check if the user is logged in
     if('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
-    page['title'] = 'The Sydney Automotive Group'
-    
+
     return redirect(url_for('summary'))
 
-    #return render_template('index.html', session=session, page=page, user=user_details)
+    #return render_template('index.html', session=session, user=current_user())
 
 #####################################################
 ##  LOGIN
@@ -36,27 +155,29 @@ def login():
     # Check if they are submitting details, or they are just logging in
     if (request.method == 'POST'):
         # submitting details
-        login_return_data = check_login(request.form['id'], request.form['password'])
+        try:
+            login_return_data = check_login(request.form['id'], request.form['password'])
+        except credentials.CredentialsBusy:
+            flash("The login service is busy, please try again in a moment.", 'error')
+            return redirect(url_for('login'))
 
         # If they have incorrect details
         if login_return_data is None:
-            page['bar'] = False
-            flash("Incorrect login info, please try again.")
+            flash("Incorrect login info, please try again.", 'error')
             return redirect(url_for('login'))
 
-        # Log them in
-        page['bar'] = True
+        # Log them in, starting from a fresh session
+        session.clear()
         welcomestr = 'Welcome back, ' + login_return_data['firstName'] + ' ' + login_return_data['lastName']
-        flash(welcomestr)
+        flash(welcomestr, 'info')
         session['logged_in'] = True
 
         # Store the user details
-        global user_details
-        user_details = login_return_data
+        session['user'] = login_return_data
         return redirect(url_for('index'))
 
     elif (request.method == 'GET'):
-        return(render_template('login.html', page=page))
+        return(render_template('login.html'))
 
 #####################################################
 ##  LOGOUT
@@ -64,9 +185,9 @@ def login():
 
 @app.route('/logout')
 def logout():
+    session.pop('user', None)
     session['logged_in'] = False
-    page['bar'] = True
-    flash('You have been logged out. See you soon!')
+    flash('You have been logged out. See you soon!', 'info')
     return redirect(url_for('index'))
 
 #####################################################
@@ -78,12 +199,12 @@ def summary():
     if ('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
     
-    summary = database.getCarSalesSummary()
+    summary, fingerprint = database.getCarSalesSummary(withFingerprint=True)
     if (summary is None):
         summary = []
-        flash("There are no summary in the system for " + user_details['firstName'] + " " + user_details['lastName'])
-        page['bar'] = False
-    return render_template('summary.html', summary=summary, session=session, page=page)
+        flash("There are no summary in the system for " + current_user()['firstName'] + " " + current_user()['lastName'], 'error')
+    return tagged_response(page_etag(fingerprint),
+                           lambda: render_template('summary.html', summary=summary, session=session))
 
 #####################################################
 ##  List Car Sales
@@ -94,26 +215,108 @@ def list_carsales():
     if ('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
 
-    # User selects a row in the Car Sales Summary
+    # Results are paged with a keyset cursor; page_size is capped to keep pages small
+    page_size = request.values.get('page_size', PAGE_SIZE, type=int)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    after = request.args.get('after')
+
+    # User selects a row in the Car Sales Summary, or follows a page link
     if (request.method == 'GET'):
         search = request.args.get('search')
-        carsale_list = database.findCarSales(search)
+        if search is None:
+            search = ''
+        carsale_list, next_cursor, fingerprint = database.findCarSalesPage(
+            search, page_size, after, withFingerprint=True)
         if (carsale_list is None):
             carsale_list = []
-            flash('There are no records in the system for search key word "' + user_details['firstName'] + " " + user_details['lastName'])
-            page['bar'] = False
-        return render_template('list_carsales.html', carsale_list=carsale_list, session=session, page=page)
+            flash('There are no records in the system for search key word "' + current_user()['firstName'] + " " + current_user()['lastName'], 'error')
+        return tagged_response(page_etag(fingerprint),
+                               lambda: render_template('list_carsales.html', carsale_list=carsale_list,
+                                                       search=search, page_size=page_size, after=after,
+                                                       next_cursor=next_cursor, session=session))
     elif (request.method == 'POST'): # Users is searching
         search_term = request.form['search']
         if (search_term == ''): # Searching with a blank or empty keyword field
-            carsale_list_find = database.findCarSales(f"{user_details['firstName']} {user_details['lastName']}")
-        else:    
-            carsale_list_find = database.findCarSales(search_term)
+            search_term = f"{current_user()['firstName']} {current_user()['lastName']}"
+        carsale_list_find, next_cursor = database.findCarSalesPage(search_term, page_size)
         if (carsale_list_find is None):
             carsale_list_find = []
-            flash("Searching \'{}\' does not return any result".format(request.form['search']))
-            page['bar'] = False
-    return render_template('list_carsales.html', carsale_list=carsale_list_find, session=session, page=page)
+            flash("Searching \'{}\' does not return any result".format(request.form['search']), 'error')
+    return render_template('list_carsales.html', carsale_list=carsale_list_find, search=search_term,
+                           page_size=page_size, after=None, next_cursor=next_cursor,
+                           session=session)
+
+
+#####################################################
+##  Export
+#####################################################
+
+CARSALE_FIELDS = ['carsale_id', 'make', 'model', 'builtYear', 'odometer', 'price',
+                  'isSold', 'sale_date', 'buyer', 'salesperson']
+SUMMARY_FIELDS = ['make', 'model', 'availableUnits', 'soldUnits', 'totalPrices',
+                  'soldTotalPrices', 'lastPurchaseAt']
+
+# Rows written to the response per chunk
+EXPORT_CHUNK_ROWS = 500
+
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Last line of an export that failed part way through
+EXPORT_ERROR_LINES = {'csv': '#ERROR export incomplete\n',
+                      'ndjson': json.dumps({'error': 'export incomplete'}) + '\n'}
+
+# Rows are records.Record objects: csv reads fields with row.get(), NDJSON needs a dict.
+# The status line has already been sent when a row fails, so a failure ends the
+# output with an error marker and is re-raised: the server then drops the
+# connection without finishing the chunked body, and clients see a truncated transfer.
+def export_lines(rows, fields, fmt):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+    if fmt == 'csv':
+        writer.writeheader()
+
+    count = 0
+    try:
+        for row in rows:
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(row.asDict()))
+                buffer.write('\n')
+            count += 1
+            if count % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    except Exception:
+        yield buffer.getvalue() + EXPORT_ERROR_LINES[fmt]
+        raise
+    yield buffer.getvalue()
+
+def export_response(rows, fields, fmt, filename):
+    response = Response(stream_with_context(export_lines(rows, fields, fmt)),
+                        mimetype=EXPORT_MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(filename, fmt)
+    return response
+
+# Stream car sales matching ?search= (blank exports every listed car) as CSV or NDJSON
+@app.route('/export/carsales.<fmt>')
+def export_carsales(fmt):
+    if ('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+    if fmt not in EXPORT_MIMETYPES:
+        abort(404)
+    search = request.args.get('search', '')
+    return export_response(database.iterCarSales(search), CARSALE_FIELDS, fmt, 'carsales')
+
+# Stream the car sales summary as CSV or NDJSON
+@app.route('/export/summary.<fmt>')
+def export_summary(fmt):
+    if ('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+    if fmt not in EXPORT_MIMETYPES:
+        abort(404)
+    return export_response(database.iterCarSalesSummary(), SUMMARY_FIELDS, fmt, 'summary')
 
 
 #####################################################
@@ -129,7 +332,7 @@ def new_carsale():
     # If we're just looking at the 'new carsale' page
     if(request.method == 'GET'):
         times = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23]
-        return render_template('new_carsale.html', user=user_details, times=times, session=session, page=page)
+        return render_template('new_carsale.html', user=current_user(), times=times, session=session)
 
 	# If we're adding a new car sale
     success = database.addCarSale(request.form['make'],
@@ -138,14 +341,85 @@ def new_carsale():
                                 request.form['odometer'],
                                 request.form['price'])
     if(success == True):
-        page['bar'] = True
-        flash("New car added for sale!")
+        flash("New car added for sale!", 'info')
         return(redirect(url_for('index')))
     else:
-        page['bar'] = False
-        flash("There was an error adding a new car for sale.")
+        flash("There was an error adding a new car for sale.", 'error')
         return(redirect(url_for('new_carsale')))
 
+#####################################################
+##  Bulk car intake
+#####################################################
+
+# Columns expected in an uploaded intake CSV (header names are case-insensitive)
+INTAKE_COLUMNS = ['make', 'model', 'builtyear', 'odometer', 'price']
+
+# Decodes an upload one line at a time, so a byte that is not UTF-8 is reported
+# at its own line (a newline byte never occurs inside a UTF-8 character)
+def decode_lines(stream):
+    for number, line in enumerate(stream, start=1):
+        try:
+            yield line.decode('utf-8-sig' if number == 1 else 'utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("line {} is not UTF-8 text".format(number))
+
+@app.route('/upload_carsales', methods=['GET', 'POST'])
+def upload_carsales():
+    # Check if the user is logged in
+    if ('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+
+    if (request.method == 'GET'):
+        return render_template('upload_carsales.html', rejected=None, session=session)
+
+    upload = request.files.get('carsales_file')
+    if upload is None or upload.filename == '':
+        flash("Please choose a CSV file to upload.", 'error')
+        return redirect(url_for('upload_carsales'))
+
+    reader = csv.reader(decode_lines(upload.stream), strict=True)
+    rows, lines, malformed = [], [], []
+    try:
+        header = [h.strip().lower() for h in next(reader, [])]
+        missing = [c for c in INTAKE_COLUMNS if c not in header]
+        if missing:
+            flash("The CSV file is missing the column(s): " + ", ".join(missing), 'error')
+            return redirect(url_for('upload_carsales'))
+        columns = [header.index(c) for c in INTAKE_COLUMNS]
+
+        while True:
+            # A quoted field may span lines; rows are reported by their first line
+            line = reader.line_num + 1
+            try:
+                row = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as e:
+                malformed.append((line, "Malformed CSV: {}.".format(e)))
+                continue
+            if not row:
+                continue
+            if len(row) != len(header):
+                malformed.append((line, "Wrong number of fields: expected {}, found {}.".format(
+                    len(header), len(row))))
+                continue
+            make, model, builtyear, odometer, price = [row[i] for i in columns]
+            rows.append((make.strip(), model.strip(), builtyear, odometer, price))
+            lines.append(line)
+    except ValueError as e:
+        flash("Could not read the CSV file: {}. No cars were added.".format(e), 'error')
+        return redirect(url_for('upload_carsales'))
+    except csv.Error as e:
+        flash("Could not read the CSV file at line {}: {}. No cars were added.".format(reader.line_num, e), 'error')
+        return redirect(url_for('upload_carsales'))
+    inserted, rejected = database.addCarSales(rows, lines)
+    rejected = sorted(malformed + rejected, key=lambda r: (r[0] is None, r[0] or 0))
+
+    flash("{} car(s) added for sale, {} row(s) rejected.".format(inserted, len(rejected)),
+          'error' if rejected else 'info')
+    return render_template('upload_carsales.html', rejected=rejected, session=session)
+
+
 #####################################################
 ## Update Sale
 #####################################################
@@ -158,42 +432,31 @@ def update_carsale():
     # If we're just looking at the 'update carsale' page
     if (request.method == 'GET'):
 
-        # datelen = len(request.args.get('sale_date'))
-        # if (datelen > 0):
-        #     sale_date = datetime.strptime(request.args.get('sale_date'), '%d-%m-%Y').date()
-        # else:
-        #     sale_date = ''
-        raw_date = request.args.get('sale_date')
-
-        if raw_date and raw_date.strip() != '':
-            try:
-                sale_date = datetime.strptime(raw_date.strip(), '%d-%m-%Y').date()
-            except ValueError:
-                sale_date = None
-        else:
-            sale_date = None
-
-        # Get the carsale
-        carsale = {
-            'carsale_id': request.args.get('carsale_id'),
-            'make': request.args.get('make'),
-            'model': request.args.get('model'),
-            'customer_name': request.args.get('customer'),
-			'salesperson_name': request.args.get('salesperson'),
-            'sale_date': sale_date
-        }
-
         # If there is no carsale
-        if carsale['carsale_id'] is None:
-            carsale = []
+        carsale_id = request.args.get('carsale_id')
+        if carsale_id is None:
 		    # Do not allow viewing if there is no admission to update
-            page['bar'] = False
-            flash("You do not have access to update that record!")
+            flash("You do not have access to update that record!", 'error')
+            return(redirect(url_for('index')))
+
+        # Get the carsale by its ID (one primary-key lookup)
+        record = database.getCarSale(carsale_id)
+        if record is None:
+            flash("There is no car sale with ID {}.".format(carsale_id), 'error')
             return(redirect(url_for('index')))
+        carsale = {
+            'carsale_id': record.carsale_id,
+            'make': record.make,
+            'model': record.model,
+            'customer_name': record.buyer,
+			'salesperson_name': record.salesperson,
+            # The raw SaleDate, as the date input expects
+            'sale_date': record[7]
+        }
 
 	    # Otherwise, if admission details can be retrieved
         times = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23]
-        return render_template('update_carsale.html', carsaleInfo=carsale, user=user_details, times=times, session=session, page=page)
+        return render_template('update_carsale.html', carsaleInfo=carsale, user=current_user(), times=times, session=session)
 
     # If we're updating sale
     sale_date = request.form['sale_date']
@@ -205,15 +468,48 @@ def update_carsale():
                                         request.form['salesperson'],
                                         sale_date)
     if (success == True):
-        page['bar'] = True
-        flash("Sale record updated!")
+        flash("Sale record updated!", 'info')
         return(redirect(url_for('index')))
     else:
-        page['bar'] = False
-        flash("There was an error updating the carsale.")
+        flash("There was an error updating the carsale.", 'error')
         return(redirect(url_for('index')))
 
 
+#####################################################
+## Batch Sale
+#####################################################
+
+@app.route('/update_carsales', methods=['GET', 'POST'])
+def update_carsales():
+    # Check if the user is logged in
+    if ('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+
+    if (request.method == 'GET'):
+        form = {'carsale_ids': ', '.join(request.args.getlist('carsale_id')),
+                'customer': '', 'salesperson': '', 'sale_date': '', 'all_or_nothing': True}
+        return render_template('update_carsales.html', form=form, results=None, session=session)
+
+    form = {'carsale_ids': request.form.get('carsale_ids', ''),
+            'customer': request.form.get('customer', ''),
+            'salesperson': request.form.get('salesperson', ''),
+            'sale_date': request.form.get('sale_date', ''),
+            'all_or_nothing': request.form.get('all_or_nothing') == '1'}
+    # IDs may be separated by commas, spaces or new lines
+    carsale_ids = form['carsale_ids'].replace(',', ' ').split()
+
+    updated, results, error = database.updateCarSales(carsale_ids,
+                                                      form['customer'],
+                                                      form['salesperson'],
+                                                      form['sale_date'] or None,
+                                                      allOrNothing=form['all_or_nothing'])
+    if error:
+        flash("{} car(s) sold. {}".format(updated, error), 'error')
+    else:
+        flash("{} car(s) sold!".format(updated), 'info')
+    return render_template('update_carsales.html', form=form, results=results, session=session)
+
+
 def check_login(login, password):
     userInfo = database.checkLogin(login, password)
 
@@ -226,3 +522,172 @@ def check_login(login, password):
             'lastName': userInfo[2]
         }
         return tuples
+
+#####################################################
+##  Async JSON API
+#####################################################
+
+# Summary rows, total revenue and per-make totals, fetched concurrently
+@app.route('/api/summary')
+async def api_summary():
+    if ('logged_in' not in session or not session['logged_in']):
+        abort(401)
+    # psycopg 3 is only imported once the async API is actually used
+    import database_async
+    summary, total_revenue, sales_by_make = await database_async.gather(
+        database_async.getCarSalesSummary(),
+        database_async.getTotalSoldRevenue(),
+        database_async.getSalesByMake())
+    return jsonify(summary=[row.asDict() for row in summary],
+                   totalRevenue=total_revenue, salesByMake=sales_by_make)
+
+# One page of search results, paged like /list_carsales
+@app.route('/api/search')
+async def api_search():
+    if ('logged_in' not in session or not session['logged_in']):
+        abort(401)
+    import database_async
+    page_size = max(1, min(request.args.get('page_size', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    carsales, next_cursor = await database_async.findCarSalesPage(
+        request.args.get('search', ''), page_size, request.args.get('after'))
+    return jsonify(carsales=[row.asDict() for row in carsales], next=next_cursor)
+
+# Units and revenue per day/week/month/quarter/year, grouped by make, model,
+# salesperson or in total, over ?from=YYYY-MM-DD&to=YYYY-MM-DD (default: the
+# last 30 days), answered from the daily rollup
+@app.route('/api/sales')
+def api_sales():
+    if ('logged_in' not in session or not session['logged_in']):
+        abort(401)
+    try:
+        date_to = datetime.strptime(request.args['to'], '%Y-%m-%d').date() \
+            if 'to' in request.args else datetime.now().date()
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d').date() \
+            if 'from' in request.args else date_to - timedelta(days=30)
+        bucket = request.args.get('bucket', 'day')
+        group = request.args.get('group', 'make')
+        rows = database.getSalesRollup(date_from, date_to, bucket, group)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if rows is None:
+        return jsonify(error="Sales analytics are unavailable."), 503
+    return jsonify(start=date_from.isoformat(), end=date_to.isoformat(),
+                   bucket=bucket, group=group, rows=rows)
+
+# Search-box suggestions for ?q=<prefix>: makes, models, customers and
+# salespeople, answered from the in-memory prefix index
+@app.route('/api/autocomplete')
+def api_autocomplete():
+    if ('logged_in' not in session or not session['logged_in']):
+        abort(401)
+    # Imported on first use, like the other optional features
+    import autocomplete
+    limit = request.args.get('limit', 10, type=int)
+    response = jsonify(suggestions=autocomplete.suggest(request.args.get('q', ''), limit))
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
+#####################################################
+##  Live updates
+#####################################################
+
+# Server-sent events for cars added and sold, pushed from the database's row
+# notifications; the summary and car sales pages patch their rows from them
+@app.route('/events/carsales')
+def carsale_events():
+    if ('logged_in' not in session or not session['logged_in']):
+        abort(401)
+    import changefeed
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    stream = changefeed.openStream(last_event_id)
+    if stream is None:
+        # Every stream this worker allows is taken; the page retries later
+        return Response(status=503, headers={'Retry-After': '30'})
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+#####################################################
+##  Metrics
+#####################################################
+
+# Bearer token a scraper must send for /metrics. Without one, /metrics only
+# answers requests made directly from this host (not through a proxy).
+METRICS_TOKEN = os.environ.get('SAG_METRICS_TOKEN', '')
+
+def metrics_allowed():
+    if METRICS_TOKEN:
+        sent = request.headers.get('Authorization', '')
+        return hmac.compare_digest(sent.encode('utf-8'), ('Bearer ' + METRICS_TOKEN).encode('utf-8'))
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+# Per-query latency percentiles, row and error counts, pool and result cache state, in the
+# Prometheus text format
+@app.route('/metrics')
+def metrics():
+    if not metrics_allowed():
+        abort(403)
+    body = instrument.renderPrometheus(database.getPoolStats(), database.getResultCacheStats())
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+#####################################################
+##  CLI commands
+#####################################################
+
+@app.cli.command('rebuild-summary')
+@click.option('--verify-only', is_flag=True, help='Only compare the summary table with the live aggregate.')
+def rebuild_summary(verify_only):
+    """Rebuild and/or verify the CarSalesSummary table."""
+    if not verify_only:
+        count = database.rebuildCarSalesSummary()
+        if count is None:
+            raise click.ClickException("Rebuild failed.")
+        click.echo("Rebuilt summary: {} make/model rows.".format(count))
+
+    mismatches = database.verifyCarSalesSummary()
+    if mismatches is None:
+        raise click.ClickException("Verification failed.")
+    for m in mismatches:
+        click.echo("{make}/{model}: {problem}".format(**m))
+    if mismatches:
+        raise click.ClickException("{} summary rows differ from CarSales.".format(len(mismatches)))
+    click.echo("Summary table matches CarSales.")
+
+@app.cli.command('build-assets')
+@click.option('--clean', is_flag=True, help='Delete the files of earlier builds.')
+def build_assets(clean):
+    """Minify, bundle, compress and hash the static CSS and JavaScript."""
+    manifest = assets.build(clean=clean)
+    for name, entry in sorted(manifest.items()):
+        sizes = ", ".join("{} {:,}".format(encoding, entry[encoding])
+                          for encoding, _ in assets.ENCODINGS if encoding in entry)
+        click.echo("{} -> {}: {:,} bytes from {:,} ({})".format(
+            name, entry['file'], entry['bytes'], entry['sourceBytes'], sizes))
+
+@app.cli.command('hash-passwords')
+def hash_passwords():
+    """Replace the remaining plaintext salesperson passwords with salted hashes."""
+    count = database.hashLegacyPasswords()
+    if count is None:
+        raise click.ClickException("Password migration failed.")
+    click.echo("Hashed {} plaintext password(s).".format(count))
+
+@app.cli.command('migrate')
+@click.option('--status', 'show_status', is_flag=True, help='List migrations and whether they are applied.')
+@click.option('--with', 'include', multiple=True, metavar='VERSION', help='Also apply this optional migration.')
+@click.option('--dry-run', is_flag=True, help='Only list the migrations that would be applied.')
+def migrate(show_status, include, dry_run):
+    """Apply pending schema migrations from migrations/."""
+    import migrate as migrations
+    try:
+        if show_status:
+            for migration, done in migrations.status():
+                click.echo("{} {}{}".format('applied' if done else 'pending', migration.label,
+                                            ' (optional)' if migration.optional and not done else ''))
+            return
+        applied = migrations.migrate(include=include, dryRun=dry_run)
+    except migrations.MigrationError as e:
+        raise click.ClickException(str(e))
+    for migration in applied:
+        click.echo(("Would apply " if dry_run else "Applied ") + migration.label)
+    if not applied:
+        click.echo("Schema is up to date.")
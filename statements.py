@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import re
+import threading
+import weakref
+
+from psycopg2 import errors
+
+#####################################################
+##  Prepared statements
+#####################################################
+
+'''
+Named server-side prepared statements.
+
+A Statement is PREPAREd on a connection the first time it runs there and is
+then sent as `EXECUTE name (...)`, so PostgreSQL parses and analyses the
+query once per pooled connection instead of on every call, and after a few
+executions can reuse a generic plan instead of planning again. Which
+statements each connection has prepared is tracked per connection object, so
+a connection the pool replaces simply prepares them again.
+
+Statements use the same named %(param)s placeholders as the rest of
+database.py and declare each parameter's type. Set SAG_PREPARED_STATEMENTS=0
+to run the same SQL unprepared, e.g. behind a transaction-pooling PgBouncer
+where a session's prepared statements are not kept.
+'''
+
+ENABLED = os.environ.get('SAG_PREPARED_STATEMENTS', '1') == '1'
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+
+class Statement:
+    __slots__ = ('name', 'sql', 'params', 'prepareSql', 'executeSql')
+
+    '''
+    :param name: Prepared statement name, unique in the registry.
+    :param sql: The query, with %(param)s placeholders.
+    :param params: (name, SQL type) of each parameter, in EXECUTE order.
+    '''
+    def __init__(self, name, sql, params=()):
+        self.name = name
+        self.sql = sql
+        self.params = tuple(params)
+        positions = {param: i + 1 for i, (param, _) in enumerate(self.params)}
+        missing = set(_PLACEHOLDER.findall(sql)) - set(positions)
+        if missing:
+            raise ValueError("Statement %s has no type for: %s" % (name, ', '.join(sorted(missing))))
+        # PREPARE is sent without parameters, so %% is not unescaped for it
+        body = _PLACEHOLDER.sub(lambda m: '$%d' % positions[m.group(1)], sql).replace('%%', '%')
+        if self.params:
+            self.prepareSql = 'PREPARE %s (%s) AS %s' % (
+                name, ', '.join(kind for _, kind in self.params), body)
+            self.executeSql = 'EXECUTE %s (%s)' % (
+                name, ', '.join('%%(%s)s' % param for param, _ in self.params))
+        else:
+            self.prepareSql = 'PREPARE %s AS %s' % (name, body)
+            self.executeSql = 'EXECUTE %s' % name
+
+
+_registry = {}
+_lock = threading.Lock()
+# connection -> names of the statements prepared on it
+_prepared = weakref.WeakKeyDictionary()
+# Connections whose prepared statements must be dropped before preparing again
+_stale = weakref.WeakSet()
+
+'''
+Add a statement to the registry and return it
+'''
+def register(name, sql, params=()):
+    statement = Statement(name, sql, params)
+    with _lock:
+        if name in _registry:
+            raise ValueError("Statement %s is already registered" % name)
+        _registry[name] = statement
+    return statement
+
+def registered():
+    return list(_registry.values())
+
+'''
+The registered statement called `name`, or None
+'''
+def get(name):
+    return _registry.get(name)
+
+'''
+Run a registered statement on `cursor` with a dict of parameters,
+preparing it on the cursor's connection first if needed.
+'''
+def execute(cursor, statement, params=None):
+    if not ENABLED:
+        return cursor.execute(statement.sql, params)
+
+    conn = cursor.connection
+    with _lock:
+        prepared = _prepared.get(conn)
+        if prepared is None:
+            prepared = _prepared[conn] = set()
+        stale = conn in _stale
+        _stale.discard(conn)
+    if stale:
+        cursor.execute('DEALLOCATE ALL')
+    if statement.name not in prepared:
+        cursor.execute(statement.prepareSql)
+        prepared.add(statement.name)
+
+    try:
+        return cursor.execute(statement.executeSql, params)
+    except errors.InvalidSqlStatementName:
+        # The session lost its statements (e.g. DISCARD ALL); prepare them again next time
+        prepared.clear()
+        raise
+    except errors.FeatureNotSupported:
+        # "cached plan must not change result type" after a schema change
+        prepared.clear()
+        with _lock:
+            _stale.add(conn)
+        raise
@@ -0,0 +1,50 @@
+// Live updates pushed from /events/carsales (server-sent events).
+//
+// sagLiveFeed(url, onCarSale, onReset) calls onCarSale(car) for every car added
+// ("op": "insert") or sold ("op": "sale"), and onReset() when updates were
+// missed and the page should be loaded again instead.
+function sagLiveFeed(url, onCarSale, onReset) {
+    if (!window.EventSource) {
+        return;
+    }
+    var source, lastEventId = null;
+    function connect() {
+        // A stream the browser reopens itself sends Last-Event-ID; one reopened
+        // here passes it in the query string
+        source = new EventSource(lastEventId ? url + "?last_event_id=" + encodeURIComponent(lastEventId) : url);
+        source.addEventListener("carsale", function(e) {
+            lastEventId = e.lastEventId;
+            onCarSale(JSON.parse(e.data));
+        });
+        source.addEventListener("reset", function() {
+            source.close();
+            onReset();
+        });
+        source.onerror = function() {
+            // Refused (e.g. the worker's streams are all taken): try again later
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(connect, 30000);
+            }
+        };
+    }
+    connect();
+}
+
+// YYYY-MM-DD as the pages show dates (DD-MM-YYYY)
+function sagFormatDate(iso) {
+    return iso ? iso.split("-").reverse().join("-") : null;
+}
+
+// A number as the pages show floats (Python's str(float))
+function sagFormatFloat(x) {
+    var s = String(Number(x));
+    return /[.e]/.test(s) ? s : s + ".0";
+}
+
+// Briefly highlight a row that was just updated
+function sagHighlight(row) {
+    row.css("background-color", "#fff3b0");
+    setTimeout(function() {
+        row.css("background-color", "white");
+    }, 2000);
+}
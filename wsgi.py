@@ -0,0 +1,8 @@
+# WSGI entry point for production serving, e.g.
+#
+#     gunicorn -c gunicorn.conf.py wsgi:app
+#
+# See README.md for the concurrency model.
+from application import create_app
+
+app = create_app()